@@ -0,0 +1,113 @@
+"""
+Content-addressed blob store for EncrypTalk uploads
+Each unique file is stored once under its SHA-256, in two levels of
+sharded directories (ab/cd/abcd...), with a reference count in MongoDB.
+Messages, stickers and NAS entries each hold one reference; the file is
+removed when the last one is released.
+"""
+
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from pymongo import ReturnDocument
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class BlobStore:
+    """SHA-256 addressed files on disk, reference counted in a Mongo collection"""
+
+    def __init__(self, root: Path, collection):
+        self.root = root
+        self.collection = collection
+        self.staging_dir = root / "staging"
+        self.trash_dir = root / "trash"
+        for dir_path in (self.root, self.staging_dir, self.trash_dir):
+            dir_path.mkdir(parents=True, exist_ok=True)
+        self.stored = 0
+        self.deduplicated = 0
+        self.collected = 0
+
+    def path_for(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def staging_path(self) -> Path:
+        """Where an upload is written while its hash is still unknown (same filesystem as the blobs)"""
+        return self.staging_dir / uuid.uuid4().hex
+
+    async def _incref(self, digest: str, size: int) -> Dict[str, Any]:
+        now = datetime.now(timezone.utc).isoformat()
+        return await self.collection.find_one_and_update(
+            {"_id": digest},
+            {"$inc": {"refs": 1}, "$set": {"updated_at": now}, "$setOnInsert": {"size": size, "created_at": now}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def commit(self, staged: Path, digest: str, size: int):
+        """Take a reference on `digest` and move the staged file into place unless it is already stored"""
+        # Reference first, so a concurrent release cannot collect the blob under us
+        await self._incref(digest, size)
+        path = self.path_for(digest)
+        if path.exists():
+            staged.unlink(missing_ok=True)
+            self.deduplicated += 1
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staged, path)
+        self.stored += 1
+
+    async def add_ref(self, digest: str) -> bool:
+        """Reference an already stored blob without uploading it again; False if unknown"""
+        if not DIGEST_RE.fullmatch(digest or ""):
+            return False
+        result = await self.collection.update_one(
+            {"_id": digest, "refs": {"$gt": 0}},
+            {"$inc": {"refs": 1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        if result.modified_count and self.path_for(digest).exists():
+            self.deduplicated += 1
+            return True
+        if result.modified_count:
+            await self.release(digest)
+        return False
+
+    async def release(self, digest: Optional[str]):
+        """Drop one reference and delete the file once nothing refers to it"""
+        if not digest:
+            return
+        doc = await self.collection.find_one_and_update(
+            {"_id": digest, "refs": {"$gt": 0}},
+            {"$inc": {"refs": -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc or doc["refs"] > 0:
+            return
+
+        # Move the file aside before deleting the record; if a concurrent upload
+        # re-referenced the blob meanwhile, put it back (the content is identical).
+        path = self.path_for(digest)
+        trashed = self.trash_dir / f"{digest}.{uuid.uuid4().hex}"
+        try:
+            os.replace(path, trashed)
+        except FileNotFoundError:
+            trashed = None
+        result = await self.collection.delete_one({"_id": digest, "refs": {"$lte": 0}})
+        if trashed is None:
+            return
+        if result.deleted_count:
+            trashed.unlink(missing_ok=True)
+            self.collected += 1
+        else:
+            os.replace(trashed, path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "collected": self.collected,
+        }
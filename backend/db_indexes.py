@@ -0,0 +1,128 @@
+"""
+MongoDB index bootstrap for EncrypTalk
+Creates the indexes every API route relies on; safe to run repeatedly
+"""
+
+from typing import Any, Dict, List, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+# (collection, keys, options) - one entry per filter/sort shape used by the API.
+# Index names are fixed so re-runs can tell "already present" from "created".
+INDEX_SPECS: List[Tuple[str, List[Tuple[str, int]], Dict[str, Any]]] = [
+    # get_current_user, get_user_profile, delete_user
+    ("users", [("id", ASCENDING)], {"name": "users_id", "unique": True}),
+    # login, register uniqueness check
+    ("users", [("username", ASCENDING)], {"name": "users_username", "unique": True}),
+    # register uniqueness loop, find_user_by_code. Partial rather than sparse: sparse
+    # still indexes explicit nulls, which older accounts have, and the build would fail
+    ("users", [("user_code", ASCENDING)],
+     {"name": "users_user_code", "unique": True, "partialFilterExpression": {"user_code": {"$type": "string"}}}),
+    # add_friend_by_kurd (older accounts have no kurd_code until next login)
+    ("users", [("kurd_code", ASCENDING)],
+     {"name": "users_kurd_code", "unique": True, "partialFilterExpression": {"kurd_code": {"$type": "string"}}}),
+    # presence reaper: users with a session on a given worker
+    ("users", [("online_workers", ASCENDING)], {"name": "users_online_workers", "sparse": True}),
+
+    ("conversations", [("id", ASCENDING)], {"name": "conversations_id", "unique": True}),
+    # get_conversations, membership checks, $all lookups
+    ("conversations", [("participants", ASCENDING)], {"name": "conversations_participants"}),
+    # get_conversations: the caller's conversations, most recently active first
+    ("conversations", [("participants", ASCENDING), ("last_message_at", DESCENDING)],
+     {"name": "conversations_participants_last_message"}),
+    # admin metadata paging
+    ("conversations", [("created_at", DESCENDING), ("id", DESCENDING)], {"name": "conversations_created"}),
+
+    ("messages", [("id", ASCENDING)], {"name": "messages_id", "unique": True}),
+    # get_messages keyset pagination (both directions), admin metadata, export
+    ("messages", [("conversation_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+     {"name": "messages_conversation_timestamp"}),
+    # get_uploaded_file access check and ETag lookup (only attachment messages carry a file_url)
+    ("messages", [("metadata.file_url", ASCENDING)], {"name": "messages_file_url", "sparse": True}),
+    # send_message forwarding check: messages holding a given blob
+    ("messages", [("blob", ASCENDING)], {"name": "messages_blob", "sparse": True}),
+    # search_messages: blind-token match within a conversation, newest first
+    ("messages", [("conversation_id", ASCENDING), ("search_tokens", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+     {"name": "messages_search_tokens"}),
+    # retention worker: messages older than the cutoff
+    ("messages", [("timestamp", ASCENDING)], {"name": "messages_timestamp"}),
+    # get_backup_status
+    ("messages", [("sender_id", ASCENDING)], {"name": "messages_sender"}),
+
+    ("nas_files", [("id", ASCENDING)], {"name": "nas_files_id", "unique": True}),
+    # get_nas_file download lookup
+    ("nas_files", [("filepath", ASCENDING)], {"name": "nas_files_filepath", "unique": True}),
+    # get_nas_files visibility filter ($or branches)
+    ("nas_files", [("uploaded_by", ASCENDING)], {"name": "nas_files_uploaded_by"}),
+    ("nas_files", [("allowed_users", ASCENDING)], {"name": "nas_files_allowed_users"}),
+    ("nas_files", [("is_public", ASCENDING)], {"name": "nas_files_is_public"}),
+
+    ("calls", [("id", ASCENDING)], {"name": "calls_id", "unique": True}),
+    # start_call / get_pending_call
+    ("calls", [("conversation_id", ASCENDING), ("status", ASCENDING)], {"name": "calls_conversation_status"}),
+    # TTL: finished calls carry a BSON date expires_at (retention_days after they end)
+    ("calls", [("expires_at", ASCENDING)], {"name": "calls_expires_at", "expireAfterSeconds": 0}),
+    # retention worker: finished calls from before expires_at was set
+    ("calls", [("status", ASCENDING), ("created_at", ASCENDING)], {"name": "calls_status_created"}),
+
+    # read receipt watermarks: upsert target and per-conversation listing
+    ("read_watermarks", [("conversation_id", ASCENDING), ("user_id", ASCENDING)],
+     {"name": "read_watermarks_conversation_user", "unique": True}),
+
+    # get_sticker: only registered sticker files are served
+    ("stickers", [("filepath", ASCENDING)], {"name": "stickers_filepath"}),
+
+    ("admin_settings", [("type", ASCENDING)], {"name": "admin_settings_type", "unique": True}),
+]
+
+
+def _same_definition(existing: Dict[str, Any], options: Dict[str, Any]) -> bool:
+    """Whether an index from index_information() was built with these options"""
+    return (bool(existing.get("unique")) == bool(options.get("unique"))
+            and bool(existing.get("sparse")) == bool(options.get("sparse"))
+            and dict(existing.get("partialFilterExpression") or {}) == options.get("partialFilterExpression", {}))
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Create missing (or outdated) indexes and report what was created, already present or failed.
+
+    `failed_unique` lists the unique indexes that could not be built: the
+    uniqueness they guarantee (ids, usernames, codes) is then not enforced.
+    """
+    report: Dict[str, List[str]] = {"created": [], "existing": [], "failed": [], "failed_unique": []}
+    existing_by_collection: Dict[str, Dict[str, Any]] = {}
+
+    for collection, keys, options in INDEX_SPECS:
+        name = options["name"]
+        label = f"{collection}.{name}"
+
+        if collection not in existing_by_collection:
+            existing_by_collection[collection] = await db[collection].index_information()
+        existing = existing_by_collection[collection]
+
+        if name in existing:
+            if _same_definition(existing[name], options):
+                report["existing"].append(label)
+                continue
+
+        try:
+            if name in existing:
+                # Same name, older definition (e.g. sparse before it became partial)
+                await db[collection].drop_index(name)
+            await db[collection].create_index(keys, **options)
+            existing[name] = {"key": keys, **options}
+            report["created"].append(label)
+        except OperationFailure as e:
+            # Typically duplicate data blocking a unique index - keep going
+            report["failed"].append(f"{label}: {e.details.get('errmsg', str(e)) if e.details else str(e)}")
+            if options.get("unique"):
+                report["failed_unique"].append(label)
+
+    return report
+
+
+def format_index_report(report: Dict[str, List[str]]) -> str:
+    """One-line summary of an ensure_indexes report"""
+    return (f"{len(report['created'])} created, {len(report['existing'])} already present, "
+            f"{len(report['failed'])} failed ({len(report['failed_unique'])} unique)")
@@ -5,98 +5,216 @@ Provides end-to-end encryption for all sensitive data
 
 import os
 import secrets
-from cryptography.fernet import Fernet
+from functools import lru_cache
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
 import json
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Sequence
 
 # Master encryption key derived from SECRET_KEY
-SECRET_KEY = os.environ.get("SECRET_KEY", secrets.token_urlsafe(64))
 ENCRYPTION_SALT = b'secure_chat_encryption_2025'
+KDF_ITERATIONS = 480000
 
-kdf = PBKDF2HMAC(
-    algorithm=hashes.SHA256(),
-    length=32,
-    salt=ENCRYPTION_SALT,
-    iterations=480000,
-)
-ENCRYPTION_KEY = base64.urlsafe_b64encode(kdf.derive(SECRET_KEY.encode()))
-cipher_suite = Fernet(ENCRYPTION_KEY)
+_fallback_secret_key = None
+
+
+def get_secret_key() -> str:
+    """Return SECRET_KEY from the environment, or one random key shared by the whole process"""
+    global _fallback_secret_key
+    secret_key = os.environ.get("SECRET_KEY")
+    if secret_key:
+        return secret_key
+    if _fallback_secret_key is None:
+        _fallback_secret_key = secrets.token_urlsafe(64)
+    return _fallback_secret_key
+
+
+def derive_fernet_key(secret_key: str) -> bytes:
+    """Run the PBKDF2 derivation (slow by design - use get_fernet_key instead)"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=ENCRYPTION_SALT,
+        iterations=KDF_ITERATIONS,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(secret_key.encode()))
+
+
+@lru_cache(maxsize=None)
+def get_fernet_key() -> bytes:
+    """
+    Master Fernet key, resolved once per process.
+    A pre-derived key from FERNET_KEY or FERNET_KEY_FILE skips PBKDF2 entirely;
+    it must be the output of derive_fernet_key(SECRET_KEY) or stored data becomes unreadable.
+    """
+    key = os.environ.get("FERNET_KEY", "").strip()
+    key_file = os.environ.get("FERNET_KEY_FILE", "").strip()
+    if not key and key_file:
+        with open(key_file, "r") as f:
+            key = f.read().strip()
+    
+    if key:
+        try:
+            Fernet(key.encode())
+        except ValueError:
+            raise RuntimeError("FERNET_KEY / FERNET_KEY_FILE does not contain a valid Fernet key")
+        return key.encode()
+    
+    return derive_fernet_key(get_secret_key())
+
+
+@lru_cache(maxsize=None)
+def get_cipher() -> Fernet:
+    """Shared Fernet instance for the master key"""
+    return Fernet(get_fernet_key())
+
+
+def generate_conversation_key() -> str:
+    """New per-conversation Fernet key, wrapped with the master key for storage"""
+    return get_cipher().encrypt(Fernet.generate_key()).decode()
+
+
+def is_wrapped_key(stored_key: str) -> bool:
+    """False for legacy keys stored unwrapped (and exposed to clients and backups before)"""
+    return stored_key.startswith("gAAAAA")
+
+
+def retire_conversation_key(stored_key: str) -> str:
+    """Wrap a legacy conversation key so it can be kept, for decryption only"""
+    key = base64.urlsafe_b64encode(base64.b64decode(stored_key))
+    return get_cipher().encrypt(key).decode()
+
+
+def conversation_cipher(stored_key: str, retired_keys: Sequence[str] = ()) -> MultiFernet:
+    """
+    Cipher for a conversation's stored encryption_key.
+    Encrypts with the conversation key; decryption falls back to its retired
+    keys, then to the master key for messages written before per-conversation keys.
+    """
+    if is_wrapped_key(stored_key):
+        key = get_cipher().decrypt(stored_key.encode())
+    else:
+        # Legacy: unwrapped standard-base64 random bytes
+        key = base64.urlsafe_b64encode(base64.b64decode(stored_key))
+    retired = [Fernet(get_cipher().decrypt(wrapped.encode())) for wrapped in retired_keys]
+    return MultiFernet([Fernet(key), *retired, get_cipher()])
+
+
+def decrypt_tokens(cipher: MultiFernet, tokens: List[Optional[str]]) -> List[Optional[str]]:
+    """Decrypt a batch of message tokens; values that are not valid tokens are returned as-is"""
+    results = []
+    for token in tokens:
+        if not token:
+            results.append(token)
+            continue
+        try:
+            results.append(cipher.decrypt(token.encode()).decode())
+        except (InvalidToken, ValueError):
+            results.append(token)
+    return results
+
+
+# Every field name that has ever been encrypted at rest
+SENSITIVE_FIELDS = frozenset({
+    'bio', 'email', 'filename', 'title',
+    'description', 'content', 'message', 'primary_color',
+    'secondary_color', 'app_title', 'logo_url', 'banner_url',
+    'uploaded_by_username', 'profile_picture'
+})
+
+# Encrypted fields per collection, so each document only visits its own fields
+FIELD_SCHEMAS: Dict[str, frozenset] = {
+    "users": frozenset({'bio', 'email', 'profile_picture'}),
+    "nas_files": frozenset({'filename', 'title', 'description', 'uploaded_by_username'}),
+    "admin_settings": frozenset({'primary_color', 'secondary_color', 'app_title', 'logo_url', 'banner_url'}),
+}
+
+# Fernet tokens are already URL-safe base64 and always start with this prefix
+# (version byte 0x80 + timestamp); older values were base64-encoded a second time.
+FERNET_TOKEN_PREFIX = "gAAAAA"
 
 
 def encrypt_string(text: str) -> str:
-    """Encrypt a string and return base64-encoded ciphertext"""
+    """Encrypt a string and return the Fernet token as text"""
     if not text:
         return ""
-    ciphertext = cipher_suite.encrypt(text.encode())
-    return base64.b64encode(ciphertext).decode()
+    return get_cipher().encrypt(text.encode()).decode()
 
 
 def decrypt_string(encrypted_text: str) -> str:
-    """Decrypt a base64-encoded ciphertext and return original string"""
+    """Decrypt a Fernet token (or a legacy base64-wrapped one) and return the original string"""
     if not encrypted_text:
         return ""
     try:
-        ciphertext = base64.b64decode(encrypted_text.encode())
-        plaintext = cipher_suite.decrypt(ciphertext).decode()
-        return plaintext
+        if encrypted_text.startswith(FERNET_TOKEN_PREFIX):
+            token = encrypted_text.encode()
+        else:
+            token = base64.b64decode(encrypted_text.encode())
+        return get_cipher().decrypt(token).decode()
     except Exception as e:
         print(f"Decryption error: {e}")
         return ""
 
 
+def _transform_value(value: Any, fields: frozenset, transform) -> Any:
+    if isinstance(value, str):
+        return transform(value)
+    if isinstance(value, dict):
+        return _transform_fields(dict(value), fields, transform)
+    if isinstance(value, list):
+        return [_transform_value(item, fields, transform) if isinstance(item, (str, dict)) else item
+                for item in value]
+    return value
+
+
+def _transform_fields(doc: Dict[str, Any], fields: frozenset, transform) -> Dict[str, Any]:
+    """Apply transform in place to the schema fields present in doc (single pass)"""
+    for field in fields:
+        value = doc.get(field)
+        if value:
+            doc[field] = _transform_value(value, fields, transform)
+    return doc
+
+
+def _schema(collection: Optional[str]) -> frozenset:
+    return FIELD_SCHEMAS[collection] if collection else SENSITIVE_FIELDS
+
+
+def encrypt_fields(doc: Dict[str, Any], collection: Optional[str] = None) -> Dict[str, Any]:
+    """Return a copy of doc with the collection's sensitive fields encrypted"""
+    return _transform_fields(dict(doc), _schema(collection), encrypt_string)
+
+
+def decrypt_fields(doc: Dict[str, Any], collection: Optional[str] = None) -> Dict[str, Any]:
+    """Decrypt the collection's sensitive fields of doc in place and return it"""
+    return _transform_fields(doc, _schema(collection), decrypt_string)
+
+
+def decrypt_many(docs: List[Dict[str, Any]], collection: str) -> List[Dict[str, Any]]:
+    """Decrypt a list of documents read from `collection` in place"""
+    fields = FIELD_SCHEMAS[collection]
+    for doc in docs:
+        _transform_fields(doc, fields, decrypt_string)
+    return docs
+
+
 def encrypt_dict(data: Dict[str, Any]) -> Dict[str, Any]:
-    """Encrypt selected fields in a dictionary"""
-    encrypted = data.copy()
-    # Fields to encrypt
-    sensitive_fields = [
-        'bio', 'email', 'filename', 'title', 
-        'description', 'content', 'message', 'primary_color', 
-        'secondary_color', 'app_title', 'logo_url', 'banner_url',
-        'uploaded_by_username', 'profile_picture'
-    ]
-    
-    for field in sensitive_fields:
-        if field in encrypted and encrypted[field]:
-            if isinstance(encrypted[field], str):
-                encrypted[field] = encrypt_string(encrypted[field])
-            elif isinstance(encrypted[field], dict):
-                encrypted[field] = encrypt_dict(encrypted[field])
-            elif isinstance(encrypted[field], list):
-                encrypted[field] = [
-                    encrypt_string(item) if isinstance(item, str) else 
-                    encrypt_dict(item) if isinstance(item, dict) else 
-                    item
-                    for item in encrypted[field]
-                ]
-    
-    return encrypted
+    """Encrypt selected fields in a dictionary (all known sensitive fields)"""
+    return encrypt_fields(data)
 
 
 def decrypt_dict(data: Dict[str, Any]) -> Dict[str, Any]:
-    """Decrypt selected fields in a dictionary"""
-    decrypted = data.copy()
-    sensitive_fields = [
-        'bio', 'email', 'filename', 'title',
-        'description', 'content', 'message', 'primary_color',
-        'secondary_color', 'app_title', 'logo_url', 'banner_url',
-        'uploaded_by_username', 'profile_picture'
-    ]
-    
-    for field in sensitive_fields:
-        if field in decrypted and decrypted[field]:
-            if isinstance(decrypted[field], str):
-                decrypted[field] = decrypt_string(decrypted[field])
-            elif isinstance(decrypted[field], dict):
-                decrypted[field] = decrypt_dict(decrypted[field])
-            elif isinstance(decrypted[field], list):
-                decrypted[field] = [
-                    decrypt_string(item) if isinstance(item, str) else 
-                    decrypt_dict(item) if isinstance(item, dict) else 
-                    item
-                    for item in decrypted[field]
-                ]
-    
-    return decrypted
\ No newline at end of file
+    """Decrypt selected fields in a dictionary (all known sensitive fields)"""
+    return decrypt_fields(dict(data))
+
+
+if __name__ == "__main__":
+    # Print the derived key so it can be stored in FERNET_KEY / FERNET_KEY_FILE
+    from dotenv import load_dotenv
+    from pathlib import Path
+    load_dotenv(Path(__file__).parent / '.env')
+    if not os.environ.get("SECRET_KEY"):
+        raise SystemExit("SECRET_KEY is not set - a random key cannot be pre-derived")
+    print(derive_fernet_key(os.environ["SECRET_KEY"]).decode())
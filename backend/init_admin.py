@@ -1,15 +1,16 @@
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
-from argon2 import PasswordHasher
 import os
 import sys
 from dotenv import load_dotenv
 from pathlib import Path
+from db_indexes import ensure_indexes, format_index_report
+from passwords import build_password_hasher
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-pwd_hasher = PasswordHasher()
+pwd_hasher = build_password_hasher()
 
 async def create_admin():
     """Create default admin user if it doesn't exist"""
@@ -34,6 +35,14 @@ async def create_admin():
         await db.command("ping")
         print("✓ Connected to MongoDB")
         
+        # Bootstrap indexes (idempotent)
+        report = await ensure_indexes(db)
+        print(f"✓ Indexes: {format_index_report(report)}")
+        for name in report["created"]:
+            print(f"  + {name}")
+        for failure in report["failed"]:
+            print(f"  ⚠️  {failure}")
+        
         # Check if admin exists
         existing_admin = await db.users.find_one({"username": "admin"})
         if existing_admin:
@@ -0,0 +1,92 @@
+"""
+Password hashing for EncrypTalk
+Argon2 runs on a small dedicated thread pool so it never blocks the event loop
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError, VerifyMismatchError
+
+
+def build_password_hasher() -> PasswordHasher:
+    """PasswordHasher using ARGON2_TIME_COST, ARGON2_MEMORY_COST (KiB) and ARGON2_PARALLELISM if set"""
+    defaults = PasswordHasher()
+    return PasswordHasher(
+        time_cost=int(os.environ.get("ARGON2_TIME_COST", defaults.time_cost)),
+        memory_cost=int(os.environ.get("ARGON2_MEMORY_COST", defaults.memory_cost)),
+        parallelism=int(os.environ.get("ARGON2_PARALLELISM", defaults.parallelism)),
+    )
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when the hashing queue is full; callers should ask the client to retry"""
+
+
+class PasswordPool:
+    """Bounded Argon2 executor with admission control and queue-depth metrics"""
+
+    def __init__(self, hasher: PasswordHasher, workers: int = 2, max_pending: int = 64):
+        self.hasher = hasher
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+        self.pending = 0  # queued + running
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self.total_seconds += time.monotonic() - started
+
+    def _verify(self, hashed_password: str, plain_password: str) -> bool:
+        try:
+            return self.hasher.verify(hashed_password, plain_password)
+        except (VerifyMismatchError, VerificationError, InvalidHashError):
+            return False
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.hasher.hash, password)
+
+    async def verify(self, hashed_password: str, plain_password: str) -> bool:
+        return await self._run(self._verify, hashed_password, plain_password)
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """True if the hash was made with different Argon2 parameters than the current ones"""
+        try:
+            return self.hasher.check_needs_rehash(hashed_password)
+        except InvalidHashError:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "queued": max(self.pending - self.workers, 0),
+            "peak_pending": self.peak_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+            "argon2": {
+                "time_cost": self.hasher.time_cost,
+                "memory_cost": self.hasher.memory_cost,
+                "parallelism": self.hasher.parallelism,
+            },
+        }
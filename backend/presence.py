@@ -0,0 +1,134 @@
+"""
+Presence tracking for EncrypTalk
+Keeps every Socket.IO session of every user on this worker and writes
+online/last_seen changes to MongoDB in periodic bulk updates.
+
+users.online_workers lists the workers holding at least one session for the
+user, so a user stays online while any worker (or device) is connected.
+users.online_changed_at is set only when `online` actually flips, which is
+what callers broadcast.
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+from pymongo import UpdateOne
+
+
+class PresenceService:
+    """Per-worker session index (user -> sids, sid -> user) with coalesced presence writes"""
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self._sessions: Dict[str, Set[str]] = {}
+        self._sid_user: Dict[str, str] = {}
+        # user id -> whether this worker currently holds a session, pending the next flush
+        self._dirty: Dict[str, bool] = {}
+        self.connects = 0
+        self.disconnects = 0
+        self.flushed = 0
+        self.flushes = 0
+
+    def connect(self, sid: str, user_id: str):
+        previous = self._sid_user.get(sid)
+        if previous == user_id:
+            return
+        if previous:
+            self.disconnect(sid)
+        self._sid_user[sid] = user_id
+        self._sessions.setdefault(user_id, set()).add(sid)
+        self._dirty[user_id] = True
+        self.connects += 1
+
+    def disconnect(self, sid: str) -> Optional[str]:
+        """Forget a session; returns its user id if it was known"""
+        user_id = self._sid_user.pop(sid, None)
+        if user_id is None:
+            return None
+        sids = self._sessions.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._sessions[user_id]
+        self._dirty[user_id] = user_id in self._sessions
+        self.disconnects += 1
+        return user_id
+
+    def touch(self, user_id: str):
+        """Record activity (e.g. an HTTP login) without changing this worker's sessions"""
+        self._dirty[user_id] = user_id in self._sessions
+
+    def user_for(self, sid: str) -> Optional[str]:
+        return self._sid_user.get(sid)
+
+    def sessions(self, user_id: str) -> Set[str]:
+        return set(self._sessions.get(user_id, ()))
+
+    def release_all(self):
+        """Mark every local session gone, e.g. before a graceful shutdown flush"""
+        for user_id in self._sessions:
+            self._dirty[user_id] = False
+        self._sessions.clear()
+        self._sid_user.clear()
+
+    def _operation(self, user_id: str, connected: bool, now: str) -> UpdateOne:
+        workers = {"$ifNull": ["$online_workers", []]}
+        online_workers = ({"$setUnion": [workers, [self.worker_id]]} if connected
+                          else {"$setDifference": [workers, [self.worker_id]]})
+        return UpdateOne({"id": user_id}, [
+            {"$set": {"online_workers": online_workers, "last_seen": now}},
+            {"$set": {
+                "online_changed_at": {"$cond": [
+                    {"$ne": [{"$gt": [{"$size": "$online_workers"}, 0]}, {"$ifNull": ["$online", False]}]},
+                    now, "$online_changed_at"
+                ]},
+                "online": {"$gt": [{"$size": "$online_workers"}, 0]}
+            }}
+        ])
+
+    async def flush(self, users) -> List[Dict[str, Any]]:
+        """Write pending changes in one bulk update; returns users whose online state flipped"""
+        pending, self._dirty = self._dirty, {}
+        if not pending:
+            return []
+        now = datetime.now(timezone.utc).isoformat()
+        await users.bulk_write([self._operation(u, c, now) for u, c in pending.items()], ordered=False)
+        self.flushed += len(pending)
+        self.flushes += 1
+        return await users.find(
+            {"id": {"$in": list(pending)}, "online_changed_at": now},
+            {"_id": 0, "id": 1, "online": 1, "last_seen": 1}
+        ).to_list(len(pending))
+
+    @staticmethod
+    async def drop_worker(users, worker_id: str) -> List[Dict[str, Any]]:
+        """Remove a dead worker from every user's online_workers; returns users now offline"""
+        user_ids = await users.distinct("id", {"online_workers": worker_id})
+        if not user_ids:
+            return []
+        now = datetime.now(timezone.utc).isoformat()
+        await users.update_many({"id": {"$in": user_ids}, "online_workers": worker_id}, [
+            {"$set": {"online_workers": {"$setDifference": ["$online_workers", [worker_id]]}}},
+            {"$set": {
+                "online_changed_at": {"$cond": [
+                    {"$and": [{"$eq": [{"$size": "$online_workers"}, 0]}, {"$ifNull": ["$online", False]}]},
+                    now, "$online_changed_at"
+                ]},
+                "online": {"$gt": [{"$size": "$online_workers"}, 0]}
+            }}
+        ])
+        return await users.find(
+            {"id": {"$in": user_ids}, "online_changed_at": now},
+            {"_id": 0, "id": 1, "online": 1, "last_seen": 1}
+        ).to_list(len(user_ids))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "users": len(self._sessions),
+            "sessions": len(self._sid_user),
+            "pending": len(self._dirty),
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+        }
@@ -0,0 +1,66 @@
+"""
+Blind search index for EncrypTalk messages
+Message content is encrypted at rest, so each text message also stores a set
+of keyed hashes of its words. A query is hashed the same way and matched with
+$all, without decrypting anything.
+
+Tokens are keyed per conversation, so the same word produces unrelated tokens
+in different conversations. Within a conversation the index still reveals
+which messages share a word, which is the usual blind-index trade-off.
+"""
+
+import hashlib
+import hmac
+import re
+import unicodedata
+from functools import lru_cache
+from typing import List, Optional
+
+from encryption import get_fernet_key
+
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64
+MAX_TOKENS_PER_MESSAGE = 256
+MAX_QUERY_TOKENS = 8
+TOKEN_BYTES = 12  # truncated HMAC-SHA256, plenty to keep collisions negligible
+
+WORD_RE = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=None)
+def get_search_key() -> bytes:
+    """Search key derived from the master key, kept separate from the encryption key"""
+    return hmac.new(get_fernet_key(), b"encryptalk-search-index-v1", hashlib.sha256).digest()
+
+
+def normalize_words(text: Optional[str]) -> List[str]:
+    """Unique, case- and accent-folded words of `text` in first-seen order"""
+    if not text:
+        return []
+    # Drop combining marks so "İstanbul" and "istanbul", "Dünya" and "dunya" match
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    words = []
+    seen = set()
+    for word in WORD_RE.findall(text):
+        if MIN_TOKEN_LENGTH <= len(word) <= MAX_TOKEN_LENGTH and word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def blind_token(conversation_id: str, word: str) -> str:
+    digest = hmac.new(get_search_key(), f"{conversation_id}\x00{word}".encode(), hashlib.sha256).digest()
+    return digest[:TOKEN_BYTES].hex()
+
+
+def message_tokens(conversation_id: str, text: Optional[str]) -> List[str]:
+    """Tokens to store on a message in `search_tokens`"""
+    words = normalize_words(text)[:MAX_TOKENS_PER_MESSAGE]
+    return [blind_token(conversation_id, word) for word in words]
+
+
+def query_tokens(conversation_id: str, query: str) -> List[str]:
+    """Tokens a message must all contain to match `query` (whole words, any order)"""
+    words = normalize_words(query)[:MAX_QUERY_TOKENS]
+    return [blind_token(conversation_id, word) for word in words]
@@ -1,32 +1,45 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Request, Response, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
 from datetime import datetime, timezone, timedelta
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError, VerificationError
 from jose import JWTError, jwt
 import socketio
 import base64
 import aiofiles
 import json
+import mimetypes
+import zlib
 import shutil
 import hashlib
 import hmac
+import re
 import secrets
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from encryption import encrypt_string, decrypt_string, encrypt_dict, decrypt_dict
+import time
+from collections import OrderedDict
+from cryptography.fernet import MultiFernet
+from encryption import (
+    encrypt_string, decrypt_string, encrypt_fields, decrypt_fields, decrypt_many, get_secret_key, get_cipher,
+    generate_conversation_key, conversation_cipher, decrypt_tokens, is_wrapped_key, retire_conversation_key
+)
+from db_indexes import ensure_indexes, format_index_report
+from socket_manager import create_client_manager, on_remote_emit
+from passwords import PasswordPool, PasswordPoolBusy, build_password_hasher
+from search_index import message_tokens, query_tokens
+from blob_store import BlobStore, DIGEST_RE
+from presence import PresenceService
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -37,23 +50,22 @@ client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_hasher = PasswordHasher()
-SECRET_KEY = os.environ.get("SECRET_KEY", secrets.token_urlsafe(64))
+# Argon2 runs off the event loop on a bounded pool (see passwords.py)
+password_pool = PasswordPool(
+    build_password_hasher(),
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+    max_pending=int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64))
+)
+SECRET_KEY = get_secret_key()
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
 
-# Encryption key for message content (derived from SECRET_KEY)
-ENCRYPTION_SALT = b'secure_chat_encryption_2025'
-kdf = PBKDF2HMAC(
-    algorithm=hashes.SHA256(),
-    length=32,
-    salt=ENCRYPTION_SALT,
-    iterations=480000,
-)
-FERNET_KEY = base64.urlsafe_b64encode(kdf.derive(SECRET_KEY.encode()))
-fernet = Fernet(FERNET_KEY)
+# Encryption key for message content (derived from SECRET_KEY once per process, shared with encryption.py)
+fernet = get_cipher()
 
 security = HTTPBearer()
+# File routes also accept signed URLs, so the bearer token is optional there
+optional_security = HTTPBearer(auto_error=False)
 
 # ==================== SECURITY HEADERS ====================
 
@@ -65,13 +77,19 @@ PROFILE_PICS_DIR = UPLOAD_DIR / "profiles"
 FILES_DIR = UPLOAD_DIR / "files"
 STICKERS_DIR = UPLOAD_DIR / "stickers"
 NAS_DIR = UPLOAD_DIR / "nas"
+BLOBS_DIR = UPLOAD_DIR / "blobs"
 
 for dir_path in [UPLOAD_DIR, PROFILE_PICS_DIR, FILES_DIR, STICKERS_DIR, NAS_DIR]:
     dir_path.mkdir(parents=True, exist_ok=True)
 
-# Socket.IO server
+# Attachments, stickers and NAS files are stored once per unique content (see blob_store.py);
+# FILES_DIR, STICKERS_DIR and NAS_DIR only hold files uploaded before that
+blob_store = BlobStore(BLOBS_DIR, db.blobs)
+
+# Socket.IO server - SOCKETIO_MESSAGE_QUEUE shares rooms across workers/nodes (see socket_manager.py)
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=create_client_manager(os.environ.get('SOCKETIO_MESSAGE_QUEUE')),
     cors_allowed_origins='*',
     logger=False,
     engineio_logger=False
@@ -80,7 +98,12 @@ sio = socketio.AsyncServer(
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
-active_connections: Dict[str, str] = {}
+# Identifies this worker process in job leases and presence
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}"
+
+def user_room(user_id: str) -> str:
+    """Per-user Socket.IO room, used for targeted emits that must work across workers"""
+    return f"user:{user_id}"
 
 # ==================== GLOBAL EXCEPTION HANDLER ====================
 
@@ -159,6 +182,7 @@ class Message(BaseModel):
     pinned: bool = False
     edited: bool = False
     reactions: Optional[Dict[str, List[str]]] = None
+    reaction_counts: Optional[Dict[str, int]] = None
     read_by: List[str] = []
 
 class Conversation(BaseModel):
@@ -168,8 +192,10 @@ class Conversation(BaseModel):
     participant_usernames: List[str]
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     last_message_at: Optional[datetime] = None
-    encryption_key: Optional[str] = None
+    encryption_key: Optional[str] = Field(default=None, exclude=True)  # wrapped with the master key, never sent to clients
     pinned_messages: List[str] = []
+    last_message: Optional[Dict[str, Any]] = None  # preview kept up to date by send_message
+    unread_count: int = 0  # for the requesting user, from the denormalized `unread` map
 
 class NASFile(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -177,6 +203,7 @@ class NASFile(BaseModel):
     filename: str
     filepath: str
     size: int
+    file_hash: Optional[str] = None  # SHA-256 of the stored content
     mime_type: str
     uploaded_by: str
     uploaded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -191,6 +218,9 @@ class Sticker(BaseModel):
     created_by: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class FileSignRequest(BaseModel):
+    paths: List[str]  # /api/files/... paths as stored on messages, stickers and NAS files
+
 class AdminSettings(BaseModel):
     model_config = ConfigDict(extra="ignore")
     app_title: str = "EncrypTalk"
@@ -203,52 +233,306 @@ class AdminSettings(BaseModel):
     enable_message_search: bool = True
     enable_encryption: bool = True
     enable_read_receipts: bool = True
-    retention_days: int = 30
+    retention_days: int = 0  # 0 keeps everything; purging is opt-in
     max_group_members: int = 100
 
 # ==================== ENCRYPTION HELPERS ====================
 
-def encrypt_message(content: str) -> str:
-    """Encrypt message content using Fernet symmetric encryption"""
+def encrypt_message(content: str, cipher) -> str:
+    """Encrypt message content with the conversation's Fernet cipher"""
     if not content:
         return content
     try:
-        return fernet.encrypt(content.encode()).decode()
+        return cipher.encrypt(content.encode()).decode()
     except Exception as e:
         logger.error(f"Encryption error: {e}")
         return content
 
-def decrypt_message(encrypted_content: str) -> str:
-    """Decrypt message content"""
-    if not encrypted_content:
-        return encrypted_content
-    try:
-        return fernet.decrypt(encrypted_content.encode()).decode()
-    except Exception as e:
-        # Return as-is if not encrypted (backwards compatibility)
-        return encrypted_content
+# Small pages are cheaper to decrypt inline than to hand to a thread
+DECRYPT_INLINE_MAX = 8
+
+MESSAGE_PREVIEW_CHARS = 120
 
-def generate_conversation_key() -> str:
-    """Generate a unique encryption key for conversation"""
-    return base64.urlsafe_b64encode(secrets.token_bytes(32)).decode()
+def build_message_preview(message: Dict[str, Any], plaintext: Optional[str], cipher) -> Dict[str, Any]:
+    """Denormalized last-message summary stored on the conversation, content encrypted"""
+    return {
+        "id": message['id'],
+        "sender_id": message['sender_id'],
+        "sender_username": message['sender_username'],
+        "message_type": message.get('message_type', 'text'),
+        "content": encrypt_message((plaintext or '')[:MESSAGE_PREVIEW_CHARS], cipher),
+        "timestamp": message['timestamp']
+    }
+
+async def decrypt_messages(conversation_id: str, messages: List[Dict[str, Any]]):
+    """Decrypt the content of a page of messages in place, as one batch off the event loop"""
+    encrypted = [msg for msg in messages if msg.get('encrypted', False) and msg.get('content')]
+    if not encrypted:
+        return
+    cipher = await get_conversation_cipher(conversation_id)
+    tokens = [msg['content'] for msg in encrypted]
+    if len(tokens) <= DECRYPT_INLINE_MAX:
+        plaintexts = decrypt_tokens(cipher, tokens)
+    else:
+        plaintexts = await asyncio.to_thread(decrypt_tokens, cipher, tokens)
+    for msg, plaintext in zip(encrypted, plaintexts):
+        msg['content'] = plaintext
+
+# Enough of a conversation document to build its cipher
+CONVERSATION_KEY_PROJECTION = {"_id": 0, "encryption_key": 1, "retired_keys": 1}
+
+async def ensure_conversation_key(conversation_id: str, conv: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Give a conversation without a wrapped key a new one; returns its key fields as stored"""
+    stored_key = conv.get('encryption_key')
+    if stored_key and is_wrapped_key(stored_key):
+        return conv
+    update: Dict[str, Any] = {"$set": {"encryption_key": generate_conversation_key()}}
+    if stored_key:
+        # Legacy keys were sent to clients and written into backups: keep them for reading old messages only
+        update["$push"] = {"retired_keys": retire_conversation_key(stored_key)}
+    # Only if unchanged, then re-read so concurrent callers agree on one key
+    await db.conversations.update_one({"id": conversation_id, "encryption_key": stored_key}, update)
+    return await db.conversations.find_one({"id": conversation_id}, CONVERSATION_KEY_PROJECTION)
+
+async def cipher_for_conversation(conv: Dict[str, Any]):
+    """Cipher for a loaded conversation document, without re-reading its key"""
+    cipher = conversation_ciphers.get(conv['id'])
+    if cipher is not None:
+        return cipher
+    keys = await ensure_conversation_key(conv['id'], conv)
+    if keys is None:
+        return MultiFernet([get_cipher()])
+    cipher = conversation_cipher(keys['encryption_key'], keys.get('retired_keys') or [])
+    conversation_ciphers.set(conv['id'], cipher)
+    return cipher
+
+async def get_conversation_cipher(conversation_id: str):
+    """Per-conversation cipher, created lazily for conversations that predate keys"""
+    cipher = conversation_ciphers.get(conversation_id)
+    if cipher is not None:
+        return cipher
+    conv = await db.conversations.find_one({"id": conversation_id}, CONVERSATION_KEY_PROJECTION)
+    if conv is None:
+        # Master key only, and not cached: the conversation may be created a moment later
+        return MultiFernet([get_cipher()])
+    return await cipher_for_conversation({"id": conversation_id, **conv})
 
 def hash_file_content(content: bytes) -> str:
     """Generate SHA-256 hash of file content for integrity verification"""
     return hashlib.sha256(content).hexdigest()
 
-# ==================== HELPERS ====================
+# ==================== CACHES ====================
+
+class TTLCache:
+    """Small in-process LRU cache with per-entry expiry and hit/miss counters"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
 
-# ==================== HELPERS ====================
+# Validated users by id; saves the users lookup on every authenticated request.
+# Entries are dropped by routes that change a user, and expire quickly so
+# changes made through other workers show up within USER_CACHE_TTL seconds.
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 30))
+)
 
-def verify_password(plain_password, hashed_password):
-    try:
-        pwd_hasher.verify(hashed_password, plain_password)
+# Decrypted /users directory pages keyed by (q, after, limit, fields). A profile
+# change clears the whole cache, since one user can appear on many pages;
+# presence (online/last_seen) is not cached and is merged in per request.
+user_directory_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_DIRECTORY_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('USER_DIRECTORY_CACHE_TTL', 10))
+)
+
+def invalidate_user(user_id: str, profile_changed: bool = True):
+    """Drop cached copies of a user after it changes; the directory only for profile changes"""
+    user_cache.invalidate(user_id)
+    if profile_changed:
+        user_directory_cache.clear()
+
+# User id -> (conversation ids they belong to, monotonic load time), for Socket.IO room checks
+membership_cache = TTLCache(
+    maxsize=int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('MEMBERSHIP_CACHE_TTL', 300))
+)
+# A join for a room missing from the cached set re-reads Mongo at most this often per user
+MEMBERSHIP_RELOAD_SECONDS = 2.0
+
+async def load_memberships(user_id: str) -> frozenset:
+    conversation_ids = await db.conversations.distinct("id", {"participants": user_id})
+    memberships = frozenset(conversation_ids)
+    membership_cache.set(user_id, (memberships, time.monotonic()))
+    return memberships
+
+async def is_conversation_member(user_id: str, conversation_id: str) -> bool:
+    """Membership check served from cache; misses reload (rate-limited) to pick up new conversations"""
+    entry = membership_cache.get(user_id)
+    if entry is None:
+        return conversation_id in await load_memberships(user_id)
+    memberships, loaded_at = entry
+    if conversation_id in memberships:
         return True
-    except (VerifyMismatchError, VerificationError):
+    if time.monotonic() - loaded_at < MEMBERSHIP_RELOAD_SECONDS:
         return False
+    return conversation_id in await load_memberships(user_id)
+
+def invalidate_memberships(user_ids: List[str]):
+    for user_id in user_ids:
+        membership_cache.invalidate(user_id)
+
+# Conversation id -> participant ids (participants never change after creation)
+conversation_participants = TTLCache(
+    maxsize=int(os.environ.get('CONVERSATION_CACHE_SIZE', 10000)), ttl=3600
+)
+
+async def get_conversation_participants(conversation_id: str) -> Optional[List[str]]:
+    participants = conversation_participants.get(conversation_id)
+    if participants is None:
+        conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0, "participants": 1})
+        if conv is None:
+            return None
+        participants = conv['participants']
+        conversation_participants.set(conversation_id, participants)
+    return participants
+
+# Global AdminSettings document, decrypted (single key: "global")
+settings_cache = TTLCache(maxsize=1, ttl=float(os.environ.get('SETTINGS_CACHE_TTL', 30)))
+
+# Conversation id -> MultiFernet built from its (immutable) stored key
+conversation_ciphers = TTLCache(maxsize=int(os.environ.get('CONVERSATION_KEY_CACHE_SIZE', 4096)), ttl=3600)
+
+# ==================== HELPERS ====================
 
-def get_password_hash(password):
-    return pwd_hasher.hash(password)
+async def load_admin_settings() -> AdminSettings:
+    """Current admin settings (defaults if never saved), cached briefly"""
+    settings = settings_cache.get("global")
+    if settings is None:
+        doc = await db.admin_settings.find_one({"type": "global"}, {"_id": 0})
+        settings = AdminSettings(**decrypt_fields(doc, "admin_settings")) if doc else AdminSettings()
+        settings_cache.set("global", settings)
+    return settings
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+async def get_max_upload_bytes() -> int:
+    settings = await load_admin_settings()
+    return settings.max_upload_size * 1024 * 1024
+
+async def save_upload_stream(file: UploadFile, dest: Path, max_bytes: int) -> tuple:
+    """Stream an upload to dest in fixed-size chunks and return (size, sha256 hex).
+
+    Data goes to a temporary file next to dest which is renamed into place only
+    once the whole upload has been written, so readers never see partial files.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+    
+    tmp_path = dest.with_name(f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as out_file:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+                digest.update(chunk)
+                await out_file.write(chunk)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    
+    return size, digest.hexdigest()
+
+async def store_upload(file: UploadFile) -> tuple:
+    """Stream an upload into the blob store and return (size, sha256 hex)"""
+    staged = blob_store.staging_path()
+    size, digest = await save_upload_stream(file, staged, await get_max_upload_bytes())
+    await blob_store.commit(staged, digest, size)
+    return size, digest
+
+def blob_filename(digest: str, original_name: Optional[str]) -> str:
+    """Public file name for a blob: the digest, plus the original extension for content-type sniffing"""
+    suffix = Path(original_name or "").suffix.lower()
+    return f"{digest}{suffix}" if re.fullmatch(r"\.[a-z0-9]{1,10}", suffix) else digest
+
+def resolve_upload_path(directory: Path, filename: str) -> Path:
+    """Blob path for digest-named files, legacy per-upload path otherwise"""
+    digest = filename.split('.', 1)[0]
+    if DIGEST_RE.fullmatch(digest):
+        return blob_store.path_for(digest)
+    return directory / filename
+
+def password_pool_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry",
+        headers={"Retry-After": "1"}
+    )
+
+async def verify_password(plain_password, hashed_password):
+    try:
+        return await password_pool.verify(hashed_password, plain_password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
+
+async def get_password_hash(password):
+    try:
+        return await password_pool.hash(password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -261,30 +545,43 @@ def generate_kurd_code(username: str) -> str:
     random_part = ''.join(secrets.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(5))
     return f"{username.upper()[:8]}-{random_part}"
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-    )
+async def user_from_token(token: str) -> Optional[User]:
+    """User for a valid access token, or None; shared by HTTP routes and Socket.IO connect"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    
-    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+        return None
+    user_id: Optional[str] = payload.get("sub")
+    if user_id is None:
+        return None
+    return await get_cached_user(user_id)
+
+async def get_cached_user(user_id: str) -> Optional[User]:
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user.model_copy()
+    
+    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "hashed_password": 0, "security_passphrase_hash": 0})
     if user_doc is None:
-        raise credentials_exception
+        return None
     
     if isinstance(user_doc.get('created_at'), str):
         user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
     if user_doc.get('last_seen') and isinstance(user_doc['last_seen'], str):
         user_doc['last_seen'] = datetime.fromisoformat(user_doc['last_seen'])
     
-    return User(**user_doc)
+    user = User(**user_doc)
+    user_cache.set(user_id, user)
+    return user.model_copy()
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    user = await user_from_token(credentials.credentials)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+        )
+    return user
 
 def generate_user_code():
     """Generate unique 5-digit KURD code"""
@@ -297,6 +594,34 @@ def generate_user_code():
     digits = ''.join([c for c in hash_digest if c.isdigit()])[:5]
     return f"KURD{digits}"
 
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 200
+
+def encode_cursor(timestamp: str, item_id: str) -> str:
+    """Encode a (timestamp, id) keyset position as an opaque URL-safe cursor"""
+    raw = json.dumps([timestamp, item_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor produced by encode_cursor, raising 400 if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, item_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(timestamp, str) or not isinstance(item_id, str):
+            raise ValueError("cursor fields must be strings")
+        return timestamp, item_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(cursor: str, direction: str) -> dict:
+    """Build a Mongo filter selecting items strictly before/after a (timestamp, id) cursor"""
+    timestamp, item_id = decode_cursor(cursor)
+    op = "$lt" if direction == "before" else "$gt"
+    return {"$or": [
+        {"timestamp": {op: timestamp}},
+        {"timestamp": timestamp, "id": {op: item_id}}
+    ]}
+
 def sanitize_input(text: str) -> str:
     """Basic XSS protection - sanitize but preserve readability"""
     if not text:
@@ -336,23 +661,33 @@ async def register(user_data: UserCreate):
     )
     
     doc = user.model_dump()
-    doc['hashed_password'] = get_password_hash(user_data.password)
-    doc['security_passphrase_hash'] = get_password_hash(user_data.security_passphrase or "default")
+    doc['hashed_password'] = await get_password_hash(user_data.password)
+    doc['security_passphrase_hash'] = await get_password_hash(user_data.security_passphrase or "default")
     doc['created_at'] = doc['created_at'].isoformat()
     if doc.get('last_seen'):
         doc['last_seen'] = doc['last_seen'].isoformat()
     
     await db.users.insert_one(doc)
+    user_directory_cache.clear()
     return user
 
 @api_router.post("/auth/login", response_model=LoginResponse)
 async def login(login_data: LoginRequest):
     user_doc = await db.users.find_one({"username": login_data.username}, {"_id": 0})
-    if not user_doc or not verify_password(login_data.password, user_doc['hashed_password']):
+    if not user_doc or not await verify_password(login_data.password, user_doc['hashed_password']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade the stored hash when operators change the Argon2 parameters
+    if password_pool.needs_rehash(user_doc['hashed_password']):
+        try:
+            new_hash = await password_pool.hash(login_data.password)
+            await db.users.update_one({"id": user_doc['id']}, {"$set": {"hashed_password": new_hash}})
+        except PasswordPoolBusy:
+            pass  # try again on a later login
+    
     # KURD code generate et (eğer yoksa)
-    if not user_doc.get('kurd_code'):
+    kurd_code_created = not user_doc.get('kurd_code')
+    if kurd_code_created:
         kurd_code = generate_kurd_code(user_doc['username'])
         await db.users.update_one(
             {"id": user_doc['id']},
@@ -360,10 +695,8 @@ async def login(login_data: LoginRequest):
         )
         user_doc['kurd_code'] = kurd_code
     
-    await db.users.update_one(
-        {"id": user_doc['id']},
-        {"$set": {"last_seen": datetime.now(timezone.utc).isoformat(), "online": True}}
-    )
+    # Online state follows the user's sockets; a login only counts as activity
+    presence.touch(user_doc['id'])
     
     if isinstance(user_doc.get('created_at'), str):
         user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
@@ -371,11 +704,15 @@ async def login(login_data: LoginRequest):
         user_doc['last_seen'] = datetime.fromisoformat(user_doc['last_seen'])
     
     user = User(**user_doc)
+    invalidate_user(user.id, profile_changed=kurd_code_created)
     access_token = create_access_token(data={"sub": user.id})
     
     return LoginResponse(access_token=access_token, token_type="bearer", user=user)
 # ==================== HEALTH CHECK ====================
 
+# Indexes the startup bootstrap could not build; /health reports degraded while any exist
+index_failures: List[str] = []
+
 @api_router.get("/health")
 async def health_check():
     """Health check endpoint for monitoring and load balancers"""
@@ -384,12 +721,13 @@ async def health_check():
         await db.command("ping")
         
         # Get database statistics for persistence verification
-        messages_count = await db.messages.count_documents({})
-        conversations_count = await db.conversations.count_documents({})
-        users_count = await db.users.count_documents({})
+        # Collection metadata counts; exact counts would scan every document
+        messages_count = await db.messages.estimated_document_count()
+        conversations_count = await db.conversations.estimated_document_count()
+        users_count = await db.users.estimated_document_count()
         
         return {
-            "status": "healthy",
+            "status": "degraded" if index_failures else "healthy",
             "service": "secure-communication-api",
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "database": "connected",
@@ -398,7 +736,8 @@ async def health_check():
                 "messages": messages_count,
                 "conversations": conversations_count,
                 "users": users_count
-            }
+            },
+            "index_failures": index_failures
         }
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
@@ -413,7 +752,8 @@ async def health_check():
 # ==================== AUTH ROUTES ====================
 @api_router.post("/auth/logout")
 async def logout(current_user: User = Depends(get_current_user)):
-    await db.users.update_one({"id": current_user.id}, {"$set": {"online": False}})
+    presence.touch(current_user.id)
+    invalidate_user(current_user.id, profile_changed=False)
     return {"message": "Logged out successfully"}
 
 @api_router.get("/auth/me", response_model=User)
@@ -422,16 +762,73 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 # ==================== USER ROUTES ====================
 
-@api_router.get("/users", response_model=List[User])
-async def get_users(current_user: User = Depends(get_current_user)):
-    users = await db.users.find({}, {"_id": 0, "hashed_password": 0, "security_passphrase_hash": 0}).to_list(1000)
-    for user in users:
-        if isinstance(user.get('created_at'), str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
-        if user.get('last_seen') and isinstance(user['last_seen'], str):
-            user['last_seen'] = datetime.fromisoformat(user['last_seen'])
-        # Decrypt user profile data
-        user = decrypt_dict(user)
+USER_PAGE_DEFAULT = 200
+USER_PAGE_MAX = 1000
+# Fields a directory listing may project; id and username are always included
+DIRECTORY_FIELDS = set(User.model_fields)
+# Change with every connect/disconnect, so they are read fresh instead of cached
+PRESENCE_FIELDS = {"online", "last_seen"}
+
+@api_router.get("/users")
+async def get_users(
+    response: Response,
+    q: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(USER_PAGE_DEFAULT, ge=1, le=USER_PAGE_MAX),
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """One page of the user directory, ordered by username.
+
+    `q` filters by username prefix, `fields` is a comma-separated projection
+    and `after` takes the X-Next-Cursor header of the previous page.
+    """
+    if fields:
+        requested = {f.strip() for f in fields.split(',') if f.strip()}
+        unknown = requested - DIRECTORY_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        requested |= {"id", "username"}
+    else:
+        requested = DIRECTORY_FIELDS
+    
+    cache_key = (q or "", after or "", limit, tuple(sorted(requested)))
+    page = user_directory_cache.get(cache_key)
+    if page is None:
+        username_filter: Dict[str, Any] = {}
+        if q:
+            # Anchored, case-sensitive prefix so the username index is used
+            username_filter["$regex"] = f"^{re.escape(q)}"
+        if after:
+            username_filter["$gt"] = after
+        query = {"username": username_filter} if username_filter else {}
+        
+        users = await db.users.find(query, {"_id": 0, **{f: 1 for f in requested}}).sort(
+            "username", 1
+        ).to_list(limit + 1)
+        has_more = len(users) > limit
+        users = decrypt_many(users[:limit], "users")
+        if not fields:
+            users = [User(**user).model_dump(mode="json") for user in users]
+        page = (users, has_more)
+        user_directory_cache.set(cache_key, page)
+    
+    users, has_more = page
+    presence_fields = PRESENCE_FIELDS & requested
+    if users and presence_fields:
+        live = {
+            doc['id']: doc for doc in await db.users.find(
+                {"id": {"$in": [u['id'] for u in users]}},
+                {"_id": 0, "id": 1, **{f: 1 for f in presence_fields}}
+            ).to_list(len(users))
+        }
+        users = [
+            {**u, **{f: live[u['id']][f] for f in presence_fields if f in live.get(u['id'], {})}}
+            for u in users
+        ]
+    if has_more:
+        response.headers["X-Next-Cursor"] = users[-1]['username']
+    response.headers["X-Has-More"] = "true" if has_more else "false"
     return users
 
 @api_router.get("/users/{user_id}", response_model=User)
@@ -447,8 +844,7 @@ async def get_user_profile(user_id: str, current_user: User = Depends(get_curren
         user['last_seen'] = datetime.fromisoformat(user['last_seen'])
     
     # Decrypt user profile data
-    user = decrypt_dict(user)
-    return User(**user)
+    return User(**decrypt_fields(user, "users"))
 
 @api_router.delete("/users/{user_id}")
 async def delete_user(user_id: str, current_user: User = Depends(get_current_user)):
@@ -459,6 +855,7 @@ async def delete_user(user_id: str, current_user: User = Depends(get_current_use
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
+    invalidate_user(user_id)
     return {"message": "User deleted successfully"}
 
 @api_router.post("/users/profile-picture")
@@ -467,15 +864,14 @@ async def upload_profile_picture(file: UploadFile = File(...), current_user: Use
     filename = f"{current_user.id}.{file_ext}"
     filepath = PROFILE_PICS_DIR / filename
     
-    async with aiofiles.open(filepath, 'wb') as out_file:
-        content = await file.read()
-        await out_file.write(content)
+    await save_upload_stream(file, filepath, await get_max_upload_bytes())
     
     profile_url = f"/api/files/profiles/{filename}"
     
     # Encrypt profile URL before storing
     encrypted_url = encrypt_string(profile_url)
     await db.users.update_one({"id": current_user.id}, {"$set": {"profile_picture": encrypted_url}})
+    invalidate_user(current_user.id)
     
     return {"profile_picture": profile_url}
 
@@ -485,6 +881,7 @@ async def update_bio(bio: str, current_user: User = Depends(get_current_user)):
     # Encrypt bio before storing
     encrypted_bio = encrypt_string(sanitized_bio)
     await db.users.update_one({"id": current_user.id}, {"$set": {"bio": encrypted_bio}})
+    invalidate_user(current_user.id)
     return {"bio": sanitized_bio}
 @api_router.patch("/users/character")
 async def update_profile_character(character: str, current_user: User = Depends(get_current_user)):
@@ -494,6 +891,7 @@ async def update_profile_character(character: str, current_user: User = Depends(
         raise HTTPException(status_code=400, detail=f"Invalid character. Choose from: {', '.join(valid_characters)}")
     
     await db.users.update_one({"id": current_user.id}, {"$set": {"profile_character": character.lower()}})
+    invalidate_user(current_user.id)
     return {"profile_character": character.lower()}
 
 # ==================== KURD CODE (FRIEND ADDING) ====================
@@ -527,11 +925,15 @@ async def add_friend_by_kurd(kurd_code: str, current_user: User = Depends(get_cu
     await db.conversations.insert_one({
         "id": conversation_id,
         "participants": [current_user.id, target_user['id']],
+        "participant_usernames": [current_user.username, target_user['username']],
         "created_at": datetime.now(timezone.utc).isoformat(),
         "is_group": False,
         "messages_count": 0,
-        "last_message_at": datetime.now(timezone.utc).isoformat()
+        "last_message_at": datetime.now(timezone.utc).isoformat(),
+        "last_message": None,
+        "unread": {current_user.id: 0, target_user['id']: 0}
     })
+    invalidate_memberships([current_user.id, target_user['id']])
     
     return {
         "status": "friend_added",
@@ -547,15 +949,8 @@ async def get_admin_settings(current_user: User = Depends(get_current_user)):
     if current_user.username != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    settings = await db.admin_settings.find_one({"type": "global"})
-    if not settings:
-        # Default ayarlar döndür
-        return AdminSettings()
-    
-    del settings['_id']
-    # Decrypt settings before returning
-    decrypted_settings = decrypt_dict(settings)
-    return AdminSettings(**decrypted_settings)
+    # Default ayarlar döndür (kayıt yoksa)
+    return await load_admin_settings()
 
 @api_router.put("/admin/settings")
 async def update_admin_settings(settings: AdminSettings, current_user: User = Depends(get_current_user)):
@@ -568,25 +963,57 @@ async def update_admin_settings(settings: AdminSettings, current_user: User = De
     settings_dict["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     # Encrypt sensitive settings before storing
-    encrypted_settings = encrypt_dict(settings_dict)
+    encrypted_settings = encrypt_fields(settings_dict, "admin_settings")
     
     await db.admin_settings.update_one(
         {"type": "global"},
         {"$set": encrypted_settings},
         upsert=True
     )
+    settings_cache.clear()
     
     return {"status": "settings_updated", "settings": settings}
 
 # ==================== CONVERSATION ROUTES ====================
 
+async def backfill_conversation_summary(conv: Dict[str, Any], user_id: str):
+    """Fill in last_message / unread for conversations written before they were denormalized"""
+    if 'last_message' not in conv:
+        cipher = await cipher_for_conversation(conv)
+        latest = await db.messages.find_one(
+            {"conversation_id": conv['id']}, {"_id": 0}, sort=[("timestamp", -1), ("id", -1)]
+        )
+        preview = None
+        if latest:
+            plaintext = decrypt_tokens(cipher, [latest.get('content')])[0] if latest.get('encrypted') else latest.get('content')
+            preview = build_message_preview(latest, plaintext, cipher)
+        await db.conversations.update_one({"id": conv['id'], "last_message": {"$exists": False}},
+                                          {"$set": {"last_message": preview}})
+        conv['last_message'] = preview
+    if user_id not in (conv.get('unread') or {}):
+        watermark = await db.read_watermarks.find_one(
+            {"conversation_id": conv['id'], "user_id": user_id}, {"_id": 0, "last_read_at": 1}
+        )
+        count = await refresh_unread(conv['id'], user_id, (watermark or {}).get('last_read_at', ''))
+        conv.setdefault('unread', {})[user_id] = count
+
 @api_router.get("/conversations", response_model=List[Conversation])
 async def get_conversations(current_user: User = Depends(get_current_user)):
+    """The caller's conversations, most recently active first, with preview and unread count"""
     conversations = await db.conversations.find(
         {"participants": current_user.id}, {"_id": 0}
-    ).to_list(1000)
+    ).sort([("last_message_at", -1), ("created_at", -1)]).to_list(1000)
     
     for conv in conversations:
+        if 'last_message' not in conv or current_user.id not in (conv.get('unread') or {}):
+            await backfill_conversation_summary(conv, current_user.id)
+        conv['unread_count'] = conv.get('unread', {}).get(current_user.id, 0)
+        
+        preview = conv.get('last_message')
+        if preview and preview.get('content'):
+            cipher = await cipher_for_conversation(conv)
+            preview['content'] = decrypt_tokens(cipher, [preview['content']])[0]
+        
         if isinstance(conv.get('created_at'), str):
             conv['created_at'] = datetime.fromisoformat(conv['created_at'])
         if conv.get('last_message_at') and isinstance(conv['last_message_at'], str):
@@ -609,7 +1036,7 @@ async def find_user_by_code(username_or_code: str, security_word: str, current_u
         raise HTTPException(status_code=404, detail="Kullanıcı bulunamadı")
     
     # Verify security passphrase
-    if not verify_password(security_word, user_doc.get('security_passphrase_hash', '')):
+    if not await verify_password(security_word, user_doc.get('security_passphrase_hash', '')):
         raise HTTPException(status_code=401, detail="Güvenlik kelimesi yanlış")
     
     if isinstance(user_doc.get('created_at'), str):
@@ -641,101 +1068,440 @@ async def create_conversation(participant_ids: List[str], current_user: User = D
     conversation = Conversation(
         participants=participant_ids,
         participant_usernames=participant_usernames,
-        encryption_key=base64.b64encode(os.urandom(32)).decode('utf-8')
+        encryption_key=generate_conversation_key()
     )
     
     doc = conversation.model_dump()
+    doc['encryption_key'] = conversation.encryption_key  # excluded from model_dump
     doc['created_at'] = doc['created_at'].isoformat()
+    # Per-participant unread counters; unread_count is only the caller's view of it
+    del doc['unread_count']
+    doc['unread'] = {participant_id: 0 for participant_id in participant_ids}
     if doc.get('last_message_at'):
         doc['last_message_at'] = doc['last_message_at'].isoformat()
     
     await db.conversations.insert_one(doc)
+    invalidate_memberships(participant_ids)
     return conversation
 
 # ==================== MESSAGE ROUTES ====================
 
 @api_router.get("/conversations/{conversation_id}/messages", response_model=List[Message])
-async def get_messages(conversation_id: str, current_user: User = Depends(get_current_user)):
+async def get_messages(
+    conversation_id: str,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX),
+    current_user: User = Depends(get_current_user)
+):
+    """Get one page of messages, newest first.
+
+    Pass the X-Next-Cursor header value as `before` to page back through
+    history, or the X-Prev-Cursor value as `after` to fetch newer messages.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+    
     conversation = await db.conversations.find_one(
-        {"id": conversation_id, "participants": current_user.id}, {"_id": 0}
+        {"id": conversation_id, "participants": current_user.id}, {"_id": 0, "id": 1}
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    messages = await db.messages.find(
-        {"conversation_id": conversation_id}, {"_id": 0}
-    ).sort("timestamp", 1).to_list(1000)
+    query: Dict[str, Any] = {"conversation_id": conversation_id}
+    if before:
+        query.update(keyset_filter(before, "before"))
+    elif after:
+        query.update(keyset_filter(after, "after"))
+    
+    # Fetch one extra document to know whether another page exists
+    sort_dir = 1 if after else -1
+    messages = await db.messages.find(query, {"_id": 0, "search_tokens": 0}).sort(
+        [("timestamp", sort_dir), ("id", sort_dir)]
+    ).to_list(limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after:
+        messages.reverse()
+    
+    if messages:
+        newest, oldest = messages[0], messages[-1]
+        response.headers["X-Prev-Cursor"] = encode_cursor(newest['timestamp'], newest['id'])
+        if has_more or after:
+            response.headers["X-Next-Cursor"] = encode_cursor(oldest['timestamp'], oldest['id'])
+    response.headers["X-Has-More"] = "true" if has_more else "false"
     
-    # Decrypt messages
     for msg in messages:
         if isinstance(msg.get('timestamp'), str):
             msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
-        # Decrypt content if encrypted
-        if msg.get('encrypted', False) and msg.get('content'):
-            msg['content'] = decrypt_message(msg['content'])
+    # Decrypt the whole page at once
+    await decrypt_messages(conversation_id, messages)
     
     return messages
 
-@api_router.post("/conversations/{conversation_id}/messages", response_model=Message)
-async def send_message(
+@api_router.get("/conversations/{conversation_id}/search", response_model=List[Message])
+async def search_messages(
     conversation_id: str,
-    content: str = Form(...),
-    message_type: str = Form("text"),
-    metadata: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None),
+    response: Response,
+    q: str = Query(..., min_length=1),
+    before: Optional[str] = None,
+    limit: int = Query(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX),
     current_user: User = Depends(get_current_user)
 ):
+    """Messages containing every word of `q`, newest first.
+
+    Matches the blind search_tokens index, so only the returned page is
+    decrypted. Pass X-Next-Cursor as `before` for older results.
+    """
+    settings = await load_admin_settings()
+    if not settings.enable_message_search:
+        raise HTTPException(status_code=403, detail="Message search is disabled")
+    
     conversation = await db.conversations.find_one(
-        {"id": conversation_id, "participants": current_user.id}, {"_id": 0}
+        {"id": conversation_id, "participants": current_user.id}, {"_id": 0, "id": 1}
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    file_url = None
-    file_hash = None
-    if file:
-        content_data = await file.read()
-        file_hash = hash_file_content(content_data)  # Integrity check
-        file_path = FILES_DIR / f"{uuid.uuid4()}_{file.filename}"
-        async with aiofiles.open(file_path, 'wb') as out_file:
-            await out_file.write(content_data)
-        file_url = f"/api/files/uploads/{file_path.name}"
-    
-    metadata_dict = json.loads(metadata) if metadata else {}
-    if file_url:
-        metadata_dict['file_url'] = file_url
-        metadata_dict['filename'] = file.filename
-        metadata_dict['file_hash'] = file_hash
+    tokens = query_tokens(conversation_id, q)
+    if not tokens:
+        raise HTTPException(status_code=400, detail="Search query has no searchable words")
+    
+    query: Dict[str, Any] = {"conversation_id": conversation_id, "search_tokens": {"$all": tokens}}
+    if before:
+        query.update(keyset_filter(before, "before"))
     
-    # Sanitize and encrypt content
+    messages = await db.messages.find(query, {"_id": 0, "search_tokens": 0}).sort(
+        [("timestamp", -1), ("id", -1)]
+    ).to_list(limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    
+    if has_more:
+        oldest = messages[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(oldest['timestamp'], oldest['id'])
+    response.headers["X-Has-More"] = "true" if has_more else "false"
+    
+    for msg in messages:
+        if isinstance(msg.get('timestamp'), str):
+            msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
+    await decrypt_messages(conversation_id, messages)
+    
+    return messages
+
+SEARCH_BACKFILL_BATCH = 500
+
+def index_backfill_batch(batch: List[Dict[str, Any]], ciphers: Dict[str, Any]) -> List[UpdateOne]:
+    """Decrypt and tokenize one backfill batch (CPU-bound, runs in a worker thread)"""
+    operations = []
+    for msg in batch:
+        tokens = []
+        if msg.get('message_type', 'text') == "text":
+            content = msg.get('content')
+            if msg.get('encrypted') and content:
+                content = decrypt_tokens(ciphers[msg['conversation_id']], [content])[0]
+            tokens = message_tokens(msg['conversation_id'], content)
+        operations.append(UpdateOne({"_id": msg['_id']}, {"$set": {"search_tokens": tokens}}))
+    return operations
+
+async def backfill_search_tokens():
+    """Index text messages written before the search index existed, one batch at a time.
+    
+    Walks messages in _id order from a checkpoint in job_reports, so each
+    batch is an index range scan and a restart resumes where it stopped.
+    """
+    try:
+        checkpoint = await db.job_reports.find_one({"_id": "search_backfill"}) or {}
+        if checkpoint.get('complete'):
+            return
+        last_id = checkpoint.get('last_id')
+        while await acquire_job_lease("search_backfill", 300):
+            query: Dict[str, Any] = {"search_tokens": {"$exists": False}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await db.messages.find(
+                query, {"_id": 1, "conversation_id": 1, "content": 1, "encrypted": 1, "message_type": 1}
+            ).sort("_id", 1).to_list(SEARCH_BACKFILL_BATCH)
+            if not batch:
+                # Everything written since has tokens, so there is nothing left to find later
+                await db.job_reports.update_one({"_id": "search_backfill"}, {"$set": {"complete": True}}, upsert=True)
+                logger.info("Search index backfill complete")
+                return
+            
+            ciphers = {
+                conversation_id: await get_conversation_cipher(conversation_id)
+                for conversation_id in {msg['conversation_id'] for msg in batch if msg.get('encrypted')}
+            }
+            operations = await asyncio.to_thread(index_backfill_batch, batch, ciphers)
+            await db.messages.bulk_write(operations, ordered=False)
+            last_id = batch[-1]['_id']
+            await db.job_reports.update_one(
+                {"_id": "search_backfill"},
+                {"$set": {"last_id": last_id, "updated_at": datetime.now(timezone.utc).isoformat()}},
+                upsert=True
+            )
+    except Exception as e:
+        # Resumes from the checkpoint on the next restart
+        logger.error(f"Search index backfill failed: {str(e)}")
+
+def parse_write_concern(value: str) -> WriteConcern:
+    """MESSAGE_WRITE_CONCERN: a number of nodes (0 = fire-and-forget, 1 = primary) or 'majority'"""
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+# Group commit window for new messages; 0 writes each message on its own
+MESSAGE_BATCH_WINDOW = float(os.environ.get('MESSAGE_BATCH_WINDOW_MS', 5)) / 1000
+MESSAGE_BATCH_MAX = int(os.environ.get('MESSAGE_BATCH_MAX', 500))
+MESSAGE_WRITE_CONCERN = parse_write_concern(os.environ.get('MESSAGE_WRITE_CONCERN', '1'))
+# false: answer the sender once the message is queued, before it is stored;
+# the room is told about a message only after it has been stored either way
+MESSAGE_WAIT_FOR_COMMIT = os.environ.get('MESSAGE_WAIT_FOR_COMMIT', 'true').lower() != 'false'
+
+class MessageIngest:
+    """Write-behind group commit for new messages.
+
+    Messages queued within one window are stored with a single insert_many,
+    and each conversation's preview, ordering and unread counters are
+    folded into one update per conversation in a single bulk write.
+    """
+    
+    def __init__(self, window: float, max_batch: int, write_concern: WriteConcern):
+        self.window = window
+        self.max_batch = max_batch
+        self.write_concern = write_concern
+        self._pending: List[tuple] = []  # (doc, preview, participants, future)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.messages = 0
+        self.batches = 0
+        self.failed = 0
+        self.largest_batch = 0
+    
+    def submit(self, doc: Dict[str, Any], preview: Dict[str, Any], participants: List[str]) -> asyncio.Future:
+        """Queue a message; the future resolves once it is stored (or fails)"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="message_ingest")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((doc, preview, participants, future))
+        self._wakeup.set()
+        return future
+    
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self.window:
+                await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            await self._commit(batch)
+    
+    @staticmethod
+    def conversation_update(entries: List[tuple]) -> UpdateOne:
+        """Fold a conversation's queued messages, in order, into one guarded pipeline update"""
+        doc, preview, participants, _ = entries[-1]
+        timestamp = doc['timestamp']
+        # Unread per participant: their own message resets it, everyone else's adds one
+        resets, increments = set(), {}
+        for message, _, _, _ in entries:
+            for participant in participants:
+                if participant == message['sender_id']:
+                    resets.add(participant)
+                    increments[participant] = 0
+                else:
+                    increments[participant] = increments.get(participant, 0) + 1
+        
+        is_newer = {"$gt": [timestamp, {"$ifNull": ["$last_message_at", ""]}]}
+        fields: Dict[str, Any] = {
+            "last_message": {"$cond": [is_newer, {"$literal": preview}, "$last_message"]},
+            "last_message_at": {"$max": [timestamp, {"$ifNull": ["$last_message_at", ""]}]}
+        }
+        for participant, count in increments.items():
+            current = 0 if participant in resets else {"$ifNull": [f"$unread.{participant}", 0]}
+            fields[f"unread.{participant}"] = {"$add": [current, count]}
+        return UpdateOne({"id": doc['conversation_id']}, [{"$set": fields}])
+    
+    async def _commit(self, batch: List[tuple]):
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        failed: Dict[int, Exception] = {}
+        try:
+            await db.messages.with_options(write_concern=self.write_concern).insert_many(
+                [entry[0] for entry in batch], ordered=False
+            )
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                # 11000: a client retried a message id that is already stored
+                error_type = DuplicateKeyError if error.get('code') == 11000 else Exception
+                failed[error['index']] = error_type(error.get('errmsg', 'write failed'))
+        except Exception as e:
+            failed = {i: e for i in range(len(batch))}
+        
+        stored = [entry for i, entry in enumerate(batch) if i not in failed]
+        by_conversation: Dict[str, List[tuple]] = {}
+        for entry in stored:
+            by_conversation.setdefault(entry[0]['conversation_id'], []).append(entry)
+        if by_conversation:
+            try:
+                await db.conversations.bulk_write(
+                    [self.conversation_update(entries) for entries in by_conversation.values()], ordered=False
+                )
+            except Exception as e:
+                # Messages are stored; summaries catch up with the next message or read
+                logger.error(f"Conversation summary update failed: {str(e)}")
+        
+        self.messages += len(stored)
+        self.failed += len(failed)
+        for i, (_, _, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(True)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window * 1000,
+            "write_concern": self.write_concern.document,
+            "wait_for_commit": MESSAGE_WAIT_FOR_COMMIT,
+            "queued": len(self._pending),
+            "messages": self.messages,
+            "batches": self.batches,
+            "avg_batch": round(self.messages / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "failed": self.failed
+        }
+
+message_ingest = MessageIngest(MESSAGE_BATCH_WINDOW, MESSAGE_BATCH_MAX, MESSAGE_WRITE_CONCERN)
+
+def _retrieve_exception(future: asyncio.Future):
+    # Nobody awaits commits when MESSAGE_WAIT_FOR_COMMIT is off; failures are counted in stats
+    if not future.cancelled():
+        future.exception()
+
+# Broadcasts waiting on a group commit nobody else awaits (kept referenced until done)
+pending_broadcasts: Set[asyncio.Task] = set()
+
+async def broadcast_when_committed(commit: asyncio.Future, conversation_id: str, payload: Dict[str, Any],
+                                   blob: Optional[str] = None):
+    try:
+        await commit
+    except Exception:
+        # Never stored (or a duplicate id): the room never hears of it and nothing holds its blob
+        if blob:
+            await blob_store.release(blob)
+        return
+    await sio.emit('new_message', payload, room=conversation_id)
+
+# Attachment fields are set by the server from the stored upload, never taken from clients
+SERVER_METADATA_FIELDS = {"file_url", "file_hash"}
+
+def client_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in metadata.items() if key not in SERVER_METADATA_FIELDS}
+
+async def can_forward_blob(user_id: str, digest: str) -> bool:
+    """True if the user can see a message that carries the blob `digest`"""
+    if not DIGEST_RE.fullmatch(digest or ""):
+        return False
+    conversation_ids = await db.messages.distinct("conversation_id", {"blob": digest})
+    return await sees_any_conversation(user_id, conversation_ids)
+
+async def publish_message(conversation_id: str, participants: List[str], sender: User, content: str,
+                          message_type: str, metadata: Dict[str, Any],
+                          message_id: Optional[str] = None, blob: Optional[str] = None) -> Dict[str, Any]:
+    """Encrypt and queue a new message, broadcasting it once stored; returns it as sent to clients.
+    
+    `message_id` lets a client choose the id so retries are idempotent; a
+    retry of an already stored message is answered with the stored copy,
+    without storing or broadcasting it twice.
+    """
     sanitized_content = sanitize_input(content) if message_type == "text" else content
-    encrypted_content = encrypt_message(sanitized_content)
+    cipher = await get_conversation_cipher(conversation_id)
     
-    message = Message(
+    doc = Message(
+        **({"id": message_id} if message_id else {}),
         conversation_id=conversation_id,
-        sender_id=current_user.id,
-        sender_username=current_user.username,
-        content=encrypted_content,
+        sender_id=sender.id,
+        sender_username=sender.username,
+        content=encrypt_message(sanitized_content, cipher),
         message_type=message_type,
-        metadata=metadata_dict,
+        metadata=metadata,
         encrypted=True
-    )
-    
-    doc = message.model_dump()
+    ).model_dump()
     doc['timestamp'] = doc['timestamp'].isoformat()
     
-    await db.messages.insert_one(doc)
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {"$set": {"last_message_at": datetime.now(timezone.utc).isoformat()}}
-    )
-    
-    # Return decrypted content for immediate display
-    message.content = sanitized_content
+    # Clients get the plaintext, but only after the group commit has accepted the id
+    payload = {**doc, "content": sanitized_content}
+    
+    doc['search_tokens'] = message_tokens(conversation_id, sanitized_content) if message_type == "text" else []
+    if blob:
+        doc['blob'] = blob  # the reference this message holds; retention releases exactly this
+    commit = message_ingest.submit(doc, build_message_preview(doc, sanitized_content, cipher), participants)
+    if MESSAGE_WAIT_FOR_COMMIT:
+        try:
+            await commit
+        except DuplicateKeyError:
+            # Fine if it is this sender's retry (already broadcast); anything else is an id collision
+            stored = await db.messages.find_one(
+                {"id": doc['id'], "sender_id": sender.id, "conversation_id": conversation_id},
+                {"_id": 0, "search_tokens": 0, "blob": 0}
+            )
+            if not stored:
+                raise HTTPException(status_code=409, detail="Message id already in use")
+            if blob:
+                await blob_store.release(blob)  # the stored copy already holds its own reference
+            await decrypt_messages(conversation_id, [stored])
+            return stored
+        except Exception as e:
+            logger.error(f"Message {doc['id']} was not stored: {str(e)}")
+            raise HTTPException(status_code=503, detail="Message could not be stored, please retry")
+        await sio.emit('new_message', payload, room=conversation_id)
+    else:
+        commit.add_done_callback(_retrieve_exception)
+        task = asyncio.create_task(broadcast_when_committed(commit, conversation_id, payload, blob))
+        pending_broadcasts.add(task)
+        task.add_done_callback(pending_broadcasts.discard)
+    return payload
+
+@api_router.post("/conversations/{conversation_id}/messages", response_model=Message)
+async def send_message(
+    conversation_id: str,
+    content: str = Form(...),
+    message_type: str = Form("text"),
+    metadata: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    blob: Optional[str] = Form(None),
+    current_user: User = Depends(get_current_user)
+):
+    """Send a message; attach a new `file`, or re-send a stored attachment by its `blob` hash"""
+    participants = await get_conversation_participants(conversation_id)
+    if not participants or current_user.id not in participants:
+        raise HTTPException(status_code=404, detail="Conversation not found")
     
-    await sio.emit('new_message', message.model_dump(mode='json'), room=conversation_id)
+    metadata_dict = client_metadata(json.loads(metadata) if metadata else {})
+    if file:
+        _, blob = await store_upload(file)
+        metadata_dict['filename'] = file.filename
+    elif blob:
+        # Forwarding: no upload, just another reference to content the sender can already see
+        if not await can_forward_blob(current_user.id, blob) or not await blob_store.add_ref(blob):
+            raise HTTPException(status_code=404, detail="Attachment not found")
+    if blob:
+        metadata_dict['file_hash'] = blob
+        metadata_dict['file_url'] = f"/api/files/uploads/{blob_filename(blob, metadata_dict.get('filename'))}"
     
-    return message
+    try:
+        return await publish_message(conversation_id, participants, current_user, content, message_type,
+                                     metadata_dict, blob=blob)
+    except Exception:
+        if blob:
+            await blob_store.release(blob)  # no message was stored to hold the reference
+        raise
 
 @api_router.patch("/messages/{message_id}/pin")
 async def pin_message(message_id: str, current_user: User = Depends(get_current_user)):
@@ -772,61 +1538,239 @@ async def edit_message(message_id: str, content: str, current_user: User = Depen
         raise HTTPException(status_code=404, detail="Message not found or not authorized")
     
     sanitized_content = sanitize_input(content)
+    cipher = await get_conversation_cipher(message['conversation_id'])
     await db.messages.update_one(
         {"id": message_id},
-        {"$set": {"content": sanitized_content, "edited": True}}
+        {"$set": {
+            "content": encrypt_message(sanitized_content, cipher),
+            "encrypted": True,
+            "edited": True,
+            # Only text is searchable, as on send and in the backfill
+            "search_tokens": (message_tokens(message['conversation_id'], sanitized_content)
+                              if message.get('message_type', 'text') == "text" else [])
+        }}
+    )
+    await db.conversations.update_one(
+        {"id": message['conversation_id'], "last_message.id": message_id},
+        {"$set": {"last_message.content": encrypt_message(sanitized_content[:MESSAGE_PREVIEW_CHARS], cipher)}}
     )
     
     return {"message": "Message updated"}
 
+READ_RECEIPT_FLUSH_SECONDS = float(os.environ.get('READ_RECEIPT_FLUSH_SECONDS', 1.0))
+
+class ReadReceiptBuffer:
+    """Per-user, per-conversation read watermarks coalesced in memory.
+
+    Only the furthest (timestamp, message id) per pair is kept between
+    flushes, so a client marking hundreds of messages costs one write.
+    """
+    
+    def __init__(self):
+        self._pending: Dict[tuple, tuple] = {}
+        self.marked = 0
+        self.flushed = 0
+        self.flushes = 0
+    
+    def mark(self, conversation_id: str, user_id: str, timestamp: str, message_id: str):
+        self.marked += 1
+        key = (conversation_id, user_id)
+        current = self._pending.get(key)
+        if current is None or (timestamp, message_id) > current:
+            self._pending[key] = (timestamp, message_id)
+    
+    def drain(self) -> Dict[tuple, tuple]:
+        pending, self._pending = self._pending, {}
+        return pending
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "marked": self.marked,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "coalesced": self.marked - self.flushed - len(self._pending)
+        }
+
+read_receipts = ReadReceiptBuffer()
+
+async def refresh_unread(conversation_id: str, user_id: str, last_read_at: str) -> int:
+    """Recount a participant's unread messages after their watermark and store it"""
+    count = 0
+    for _ in range(3):
+        conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0, "last_message_at": 1})
+        if not conv:
+            return 0
+        count = await db.messages.count_documents({
+            "conversation_id": conversation_id,
+            "timestamp": {"$gt": last_read_at},
+            "sender_id": {"$ne": user_id}
+        })
+        # Only store the count if no message arrived while counting; otherwise recount
+        result = await db.conversations.update_one(
+            {"id": conversation_id, "last_message_at": conv.get('last_message_at')},
+            {"$set": {f"unread.{user_id}": count}}
+        )
+        if result.matched_count:
+            break
+    return count
+
+async def flush_read_receipts():
+    """Write buffered watermarks in one bulk write and broadcast them per conversation"""
+    pending = read_receipts.drain()
+    if not pending:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    by_conversation: Dict[str, list] = {}
+    for (conversation_id, user_id), (timestamp, message_id) in pending.items():
+        # Pipeline update so the watermark only ever moves forward, even across workers
+        operations.append(UpdateOne(
+            {"conversation_id": conversation_id, "user_id": user_id},
+            [{"$set": {
+                "last_read_message_id": {"$cond": [
+                    {"$gt": [timestamp, {"$ifNull": ["$last_read_at", ""]}]},
+                    message_id, "$last_read_message_id"
+                ]},
+                "last_read_at": {"$max": [timestamp, {"$ifNull": ["$last_read_at", ""]}]},
+                "updated_at": now
+            }}],
+            upsert=True
+        ))
+        by_conversation.setdefault(conversation_id, []).append(
+            {"user_id": user_id, "message_id": message_id, "read_at": timestamp}
+        )
+    
+    await db.read_watermarks.bulk_write(operations, ordered=False)
+    read_receipts.flushed += len(operations)
+    read_receipts.flushes += 1
+    
+    # Recount unread badges from the stored watermarks, which may be ahead of ours
+    watermarks = await db.read_watermarks.find(
+        {"$or": [{"conversation_id": c, "user_id": u} for c, u in pending]},
+        {"_id": 0, "conversation_id": 1, "user_id": 1, "last_read_at": 1}
+    ).to_list(len(pending))
+    for watermark in watermarks:
+        count = await refresh_unread(watermark['conversation_id'], watermark['user_id'], watermark['last_read_at'])
+        await sio.emit('conversation_unread', {"conversation_id": watermark['conversation_id'], "unread_count": count},
+                       room=user_room(watermark['user_id']))
+    
+    settings = await load_admin_settings()
+    if settings.enable_read_receipts:
+        for conversation_id, receipts in by_conversation.items():
+            await sio.emit('read_receipts', {"conversation_id": conversation_id, "receipts": receipts},
+                           room=conversation_id)
+
+@api_router.post("/conversations/{conversation_id}/read")
+async def mark_conversation_read(conversation_id: str, message_id: str, current_user: User = Depends(get_current_user)):
+    """Mark everything up to and including message_id in the conversation as read"""
+    conversation = await db.conversations.find_one(
+        {"id": conversation_id, "participants": current_user.id}, {"_id": 0, "id": 1}
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    message = await db.messages.find_one(
+        {"id": message_id, "conversation_id": conversation_id}, {"_id": 0, "timestamp": 1}
+    )
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    read_receipts.mark(conversation_id, current_user.id, message['timestamp'], message_id)
+    return {"success": True, "last_read_message_id": message_id, "last_read_at": message['timestamp']}
+
+@api_router.get("/conversations/{conversation_id}/read")
+async def get_read_watermarks(conversation_id: str, current_user: User = Depends(get_current_user)):
+    """Latest flushed read position of every participant"""
+    conversation = await db.conversations.find_one(
+        {"id": conversation_id, "participants": current_user.id}, {"_id": 0, "id": 1}
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    return await db.read_watermarks.find(
+        {"conversation_id": conversation_id},
+        {"_id": 0, "user_id": 1, "last_read_message_id": 1, "last_read_at": 1}
+    ).to_list(1000)
+
 @api_router.post("/messages/{message_id}/read")
 async def mark_as_read(message_id: str, current_user: User = Depends(get_current_user)):
-    """Mark message as read"""
-    await db.messages.update_one(
-        {"id": message_id},
-        {"$addToSet": {"read_by": current_user.id}}
-    )
+    """Mark message as read (moves the conversation read watermark)"""
+    message = await db.messages.find_one({"id": message_id}, {"_id": 0, "conversation_id": 1, "timestamp": 1})
+    participants = await get_conversation_participants(message['conversation_id']) if message else None
+    if not participants or current_user.id not in participants:
+        raise HTTPException(status_code=404, detail="Message not found")
+    read_receipts.mark(message['conversation_id'], current_user.id, message['timestamp'], message_id)
     return {"success": True}
 
+REACTION_MAX_LENGTH = 32
+
 @api_router.post("/messages/{message_id}/react")
 async def react_to_message(message_id: str, emoji: str, current_user: User = Depends(get_current_user)):
-    message = await db.messages.find_one({"id": message_id}, {"_id": 0})
-    if not message:
+    """Toggle the caller's reaction in a single atomic update"""
+    # The emoji becomes a field name, so keep it out of Mongo's path syntax
+    if not emoji or len(emoji) > REACTION_MAX_LENGTH or '.' in emoji or emoji.startswith('$'):
+        raise HTTPException(status_code=400, detail="Invalid reaction")
+    
+    target = await db.messages.find_one({"id": message_id}, {"_id": 0, "conversation_id": 1})
+    participants = await get_conversation_participants(target['conversation_id']) if target else None
+    if not participants or current_user.id not in participants:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    reactions = message.get('reactions', {})
-    if emoji not in reactions:
-        reactions[emoji] = []
-    
-    if current_user.id in reactions[emoji]:
-        reactions[emoji].remove(current_user.id)
-    else:
-        reactions[emoji].append(current_user.id)
+    users_path = f"reactions.{emoji}"
+    users = {"$ifNull": [f"$reactions.{emoji}", []]}
+    message = await db.messages.find_one_and_update(
+        {"id": message_id},
+        [
+            {"$set": {users_path: {"$cond": [
+                {"$in": [current_user.id, users]},
+                {"$setDifference": [users, [current_user.id]]},
+                {"$concatArrays": [users, [current_user.id]]}
+            ]}}},
+            # Materialize the count and drop emojis nobody uses any more
+            {"$set": {
+                f"reaction_counts.{emoji}": {"$cond": [
+                    {"$gt": [{"$size": f"${users_path}"}, 0]}, {"$size": f"${users_path}"}, "$$REMOVE"
+                ]},
+                users_path: {"$cond": [
+                    {"$gt": [{"$size": f"${users_path}"}, 0]}, f"${users_path}", "$$REMOVE"
+                ]}
+            }}
+        ],
+        projection={"_id": 0, "conversation_id": 1, "reactions": 1, "reaction_counts": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
     
-    await db.messages.update_one({"id": message_id}, {"$set": {"reactions": reactions}})
+    reactions = message.get('reactions') or {}
+    reaction_counts = message.get('reaction_counts') or {}
+    await sio.emit('message_reaction', {
+        "message_id": message_id,
+        "conversation_id": message['conversation_id'],
+        "emoji": emoji,
+        "user_id": current_user.id,
+        "added": current_user.id in reactions.get(emoji, []),
+        "count": reaction_counts.get(emoji, 0)
+    }, room=message['conversation_id'])
     
-    return {"reactions": reactions}
+    return {"reactions": reactions, "reaction_counts": reaction_counts}
 
 # ==================== STICKER ROUTES ====================
 
 @api_router.post("/stickers/upload")
 async def upload_sticker(file: UploadFile = File(...), name: str = Form(...), current_user: User = Depends(get_current_user)):
-    file_ext = file.filename.split('.')[-1]
-    filename = f"{uuid.uuid4()}.{file_ext}"
-    filepath = STICKERS_DIR / filename
-    
-    async with aiofiles.open(filepath, 'wb') as out_file:
-        content = await file.read()
-        await out_file.write(content)
+    _, file_hash = await store_upload(file)
     
     sticker = Sticker(
         name=sanitize_input(name),
-        filepath=f"/api/files/stickers/{filename}",
+        filepath=f"/api/files/stickers/{blob_filename(file_hash, file.filename)}",
         created_by=current_user.id
     )
     
     doc = sticker.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc['blob'] = file_hash
     
     await db.stickers.insert_one(doc)
     return sticker
@@ -850,19 +1794,17 @@ async def upload_nas_file(
 ):
     """Upload file to NAS - any user can upload"""
     
+    # The URL stays unique per NAS entry (own permissions and download count); the bytes are shared
     filename = f"{uuid.uuid4()}_{file.filename}"
-    filepath = NAS_DIR / filename
-    
-    async with aiofiles.open(filepath, 'wb') as out_file:
-        content = await file.read()
-        await out_file.write(content)
+    file_size, file_hash = await store_upload(file)
     
     allowed_user_list = [u.strip() for u in allowed_users.split(',') if u.strip()] if allowed_users else []
     
     nas_file = NASFile(
         filename=file.filename,
         filepath=f"/api/files/nas/{filename}",
-        size=filepath.stat().st_size,
+        size=file_size,
+        file_hash=file_hash,
         mime_type=file.content_type or "application/octet-stream",
         uploaded_by=current_user.id,
         allowed_users=allowed_user_list,
@@ -873,9 +1815,10 @@ async def upload_nas_file(
     doc['uploaded_at'] = doc['uploaded_at'].isoformat()
     doc['uploaded_by_username'] = current_user.username  # Add uploader username
     doc['download_count'] = 0  # Track downloads
+    doc['blob'] = file_hash
     
     # Encrypt sensitive file metadata
-    encrypted_doc = encrypt_dict(doc)
+    encrypted_doc = encrypt_fields(doc, "nas_files")
     
     await db.nas_files.insert_one(encrypted_doc)
     return nas_file
@@ -892,15 +1835,11 @@ async def get_nas_files(current_user: User = Depends(get_current_user)):
         {"_id": 0}
     ).to_list(1000)
     
-    decrypted_files = []
     for f in files:
         if isinstance(f.get('uploaded_at'), str):
             f['uploaded_at'] = datetime.fromisoformat(f['uploaded_at'])
-        # Decrypt file metadata
-        decrypted_file = decrypt_dict(f)
-        decrypted_files.append(decrypted_file)
-    
-    return decrypted_files
+    # Decrypt file metadata
+    return decrypt_many(files, "nas_files")
 
 @api_router.delete("/nas/files/{file_id}")
 async def delete_nas_file(file_id: str, current_user: User = Depends(get_current_user)):
@@ -912,15 +1851,196 @@ async def delete_nas_file(file_id: str, current_user: User = Depends(get_current
     if file_doc['uploaded_by'] != current_user.id and current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to delete this file")
     
-    filepath = NAS_DIR / file_doc['filepath'].split('/')[-1]
-    if filepath.exists():
-        filepath.unlink()
-    
-    await db.nas_files.delete_one({"id": file_id})
+    result = await db.nas_files.delete_one({"id": file_id})
+    if result.deleted_count:
+        if file_doc.get('blob'):
+            await blob_store.release(file_doc['blob'])
+        else:
+            (NAS_DIR / file_doc['filepath'].split('/')[-1]).unlink(missing_ok=True)
     return {"message": "File deleted"}
 
 # ==================== FILE SERVING ====================
 
+# file_url -> SHA-256 recorded when the attachment was uploaded
+file_hash_cache = TTLCache(maxsize=int(os.environ.get('FILE_HASH_CACHE_SIZE', 10000)), ttl=3600)
+# (user id, file_url) pairs the user may fetch; denials are not cached, the message may land any moment
+file_access_cache = TTLCache(maxsize=int(os.environ.get('FILE_ACCESS_CACHE_SIZE', 10000)), ttl=60)
+# <img>/<audio>/<video> cannot send the bearer token, so clients load files through
+# signed URLs (HMAC over path and expiry) that stay valid for one to two TTLs
+FILE_URL_TTL_SECONDS = int(os.environ.get('FILE_URL_TTL_SECONDS', 3600))
+FILE_SIGN_MAX_PATHS = 200
+
+async def sees_any_conversation(user_id: str, conversation_ids: List[str]) -> bool:
+    for conversation_id in conversation_ids:
+        participants = await get_conversation_participants(conversation_id)
+        if participants and user_id in participants:
+            return True
+    return False
+
+async def can_access_attachment(user_id: str, file_url: str) -> bool:
+    """True if a message linking `file_url` is in one of the user's conversations"""
+    key = (user_id, file_url)
+    if file_access_cache.get(key):
+        return True
+    conversation_ids = await db.messages.distinct("conversation_id", {"metadata.file_url": file_url})
+    allowed = await sees_any_conversation(user_id, conversation_ids)
+    if allowed:
+        file_access_cache.set(key, True)
+    return allowed
+
+async def can_read_file(user: User, path: str) -> bool:
+    """Whether the user may fetch the upload, sticker or NAS file served at `path`"""
+    if path.startswith("/api/files/uploads/"):
+        return await can_access_attachment(user.id, path)
+    if path.startswith("/api/files/stickers/"):
+        return await db.stickers.find_one({"filepath": path}, {"_id": 1}) is not None
+    if path.startswith("/api/files/nas/"):
+        file_doc = await db.nas_files.find_one({"filepath": path}, {"_id": 0, "is_public": 1, "allowed_users": 1})
+        return file_doc is not None and (
+            user.role == "admin" or file_doc.get('is_public') or user.id in file_doc.get('allowed_users', [])
+        )
+    return False
+
+def file_signature(path: str, expires: int) -> str:
+    mac = hmac.new(SECRET_KEY.encode(), f"{path}\n{expires}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip('=')
+
+def sign_file_path(path: str) -> str:
+    # Expiry is rounded up to the TTL so a file keeps one URL for a while and stays cacheable
+    expires = (int(time.time()) // FILE_URL_TTL_SECONDS + 2) * FILE_URL_TTL_SECONDS
+    return f"{path}?exp={expires}&sig={file_signature(path, expires)}"
+
+async def authorize_file(request: Request, path: str, credentials: Optional[HTTPAuthorizationCredentials]):
+    """Admit a valid signed URL, or a bearer token whose user may read `path`"""
+    expires, signature = request.query_params.get('exp'), request.query_params.get('sig')
+    if expires or signature:
+        if not (expires and expires.isdigit() and int(expires) > time.time() and signature
+                and hmac.compare_digest(signature, file_signature(path, int(expires)))):
+            raise HTTPException(status_code=403, detail="Link expired or invalid")
+        return
+    user = await user_from_token(credentials.credentials) if credentials else None
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    if not await can_read_file(user, path):
+        # 404 rather than 403, so probing hashes does not reveal which files exist
+        raise HTTPException(status_code=404, detail="File not found")
+
+@api_router.post("/files/sign")
+async def sign_file_urls(request: FileSignRequest, current_user: User = Depends(get_current_user)):
+    """Short-lived URLs for the given file paths that media elements can stream and seek"""
+    if len(request.paths) > FILE_SIGN_MAX_PATHS:
+        raise HTTPException(status_code=400, detail=f"At most {FILE_SIGN_MAX_PATHS} paths per request")
+    urls = {}
+    for path in dict.fromkeys(request.paths):
+        if await can_read_file(current_user, path):
+            urls[path] = sign_file_path(path)
+    return {"urls": urls, "ttl_seconds": FILE_URL_TTL_SECONDS}
+
+def etag_matches(header_value: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our (strong) ETag"""
+    if header_value.strip() == "*":
+        return True
+    candidates = [c.strip() for c in header_value.split(',')]
+    return any(c.removeprefix('W/').strip('"') == etag for c in candidates)
+
+def if_range_matches(header_value: str, etag: str) -> bool:
+    """Strong comparison for If-Range (RFC 9110 13.1.5): a weak tag or a date never matches"""
+    return header_value.strip() == f'"{etag}"'
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[tuple]:
+    """Parse a single 'bytes=start-end' range into inclusive offsets.
+
+    Returns None when the header should be ignored (malformed or multiple
+    ranges) so the whole file is served; raises 416 if it cannot be satisfied.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition('-')
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+        else:
+            # Suffix range: last N bytes
+            suffix = int(end_str)
+            if suffix <= 0:
+                raise ValueError
+            start = max(file_size - suffix, 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    
+    if start >= file_size or start > end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, min(end, file_size - 1)
+
+async def iter_file_range(filepath: Path, start: int, end: int):
+    async with aiofiles.open(filepath, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def serve_file(request: Request, filepath: Path, etag: Optional[str] = None,
+               media_type: Optional[str] = None, cache_control: Optional[str] = None) -> Response:
+    """Serve a file with conditional GET (ETag/304) and single byte-range (206) support"""
+    headers = {"Accept-Ranges": "bytes"}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if etag:
+        headers["ETag"] = f'"{etag}"'
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    stat_result = filepath.stat()
+    media_type = media_type or mimetypes.guess_type(filepath.name)[0] or "application/octet-stream"
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header:
+        # If-Range: only honour the range if the client's copy is still current
+        if_range = request.headers.get("if-range")
+        if not if_range or (etag and if_range_matches(if_range, etag)):
+            byte_range = parse_byte_range(range_header, stat_result.st_size)
+    
+    if byte_range is None:
+        return FileResponse(filepath, media_type=media_type, headers=headers, stat_result=stat_result)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(filepath, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers
+    )
+
+def is_new_download(response: Response) -> bool:
+    """Count full downloads and the first chunk of ranged ones, not resumes or revalidations"""
+    if response.status_code == status.HTTP_200_OK:
+        return True
+    return (response.status_code == status.HTTP_206_PARTIAL_CONTENT
+            and response.headers.get("content-range", "").startswith("bytes 0-"))
+
+async def get_attachment_hash(file_url: str) -> Optional[str]:
+    file_hash = file_hash_cache.get(file_url)
+    if file_hash is None:
+        msg = await db.messages.find_one({"metadata.file_url": file_url}, {"_id": 0, "metadata.file_hash": 1})
+        file_hash = ((msg or {}).get('metadata') or {}).get('file_hash') or ""
+        file_hash_cache.set(file_url, file_hash)
+    return file_hash or None
+
 @api_router.get("/files/profiles/{filename}")
 async def get_profile_picture(filename: str):
     """Public access - no auth required"""
@@ -930,78 +2050,179 @@ async def get_profile_picture(filename: str):
     return FileResponse(filepath)
 
 @api_router.get("/files/uploads/{filename}")
-async def get_uploaded_file(filename: str):
-    """Public access - no auth required for uploaded files"""
-    filepath = FILES_DIR / filename
+async def get_uploaded_file(filename: str, request: Request,
+                            credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Attachments are served to participants of a conversation with a message that links them"""
+    await authorize_file(request, f"/api/files/uploads/{filename}", credentials)
+    filepath = resolve_upload_path(FILES_DIR, filename)
     if not filepath.exists():
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(filepath)
+    if filepath.parent != FILES_DIR:
+        file_hash = filepath.name  # content-addressed: the name is the hash
+    else:
+        file_hash = await get_attachment_hash(f"/api/files/uploads/{filename}")
+    return serve_file(request, filepath, etag=file_hash, media_type=mimetypes.guess_type(filename)[0],
+                      cache_control="private, max-age=86400")
 
 @api_router.get("/files/stickers/{filename}")
-async def get_sticker(filename: str):
-    """Public access - no auth required"""
-    filepath = STICKERS_DIR / filename
+async def get_sticker(filename: str, request: Request,
+                      credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Stickers are shared with every user, but only files registered as stickers are served here"""
+    await authorize_file(request, f"/api/files/stickers/{filename}", credentials)
+    filepath = resolve_upload_path(STICKERS_DIR, filename)
     if not filepath.exists():
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(filepath)
+    return FileResponse(filepath, media_type=mimetypes.guess_type(filename)[0])
 
 @api_router.get("/files/nas/{filename}")
-async def get_nas_file(filename: str, current_user: User = Depends(get_current_user)):
-    file_doc = await db.nas_files.find_one({"filepath": f"/api/files/nas/{filename}"}, {"_id": 0})
+async def get_nas_file(filename: str, request: Request,
+                       credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    await authorize_file(request, f"/api/files/nas/{filename}", credentials)
+    file_doc = await db.nas_files.find_one(
+        {"filepath": f"/api/files/nas/{filename}"},
+        {"_id": 0, "file_hash": 1, "mime_type": 1, "blob": 1}
+    )
     if not file_doc:
         raise HTTPException(status_code=404, detail="File not found")
     
-    if current_user.role != "admin" and not file_doc.get('is_public') and current_user.id not in file_doc.get('allowed_users', []):
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    filepath = NAS_DIR / filename
+    filepath = blob_store.path_for(file_doc['blob']) if file_doc.get('blob') else NAS_DIR / filename
     if not filepath.exists():
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Increment download count
-    await db.nas_files.update_one(
-        {"filepath": f"/api/files/nas/{filename}"},
-        {"$inc": {"download_count": 1}}
+    response = serve_file(
+        request, filepath,
+        etag=file_doc.get('file_hash'),
+        media_type=file_doc.get('mime_type'),
+        cache_control="private, no-cache"
     )
     
-    return FileResponse(filepath)
+    # Increment download count
+    if is_new_download(response):
+        await db.nas_files.update_one(
+            {"filepath": f"/api/files/nas/{filename}"},
+            {"$inc": {"download_count": 1}}
+        )
+    
+    return response
 
 # ==================== ADMIN ROUTES ====================
 
+ADMIN_METADATA_PAGE_MAX = 200
+# 0 disables the materialized conversation_summaries collection
+ADMIN_SUMMARY_REFRESH_SECONDS = int(os.environ.get('ADMIN_SUMMARY_REFRESH_SECONDS', 0))
+
+def conversation_summary_stages() -> List[Dict[str, Any]]:
+    """Per-conversation message count and latest message (uses messages_conversation_timestamp)"""
+    return [
+        {"$sort": {"conversation_id": 1, "timestamp": -1}},
+        {"$group": {
+            "_id": "$conversation_id",
+            "message_count": {"$sum": 1},
+            "last_message_time": {"$first": "$timestamp"},
+            "last_message_type": {"$first": "$message_type"},
+            "last_sender": {"$first": "$sender_username"}
+        }}
+    ]
+
+async def refresh_conversation_summaries():
+    """Rebuild conversation_summaries from messages in one server-side $merge"""
+    if not await acquire_job_lease("conversation_summaries", ADMIN_SUMMARY_REFRESH_SECONDS):
+        return
+    started = time.monotonic()
+    pipeline = conversation_summary_stages() + [
+        {"$set": {"refreshed_at": datetime.now(timezone.utc).isoformat()}},
+        {"$merge": {"into": "conversation_summaries", "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+    await db.messages.aggregate(pipeline).to_list(None)
+    logger.info(f"Refreshed conversation summaries in {time.monotonic() - started:.2f}s")
+
 @api_router.get("/admin/metadata")
-async def get_admin_metadata(current_user: User = Depends(get_current_user)):
+async def get_admin_metadata(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=ADMIN_METADATA_PAGE_MAX),
+    source: Optional[str] = Query(None, pattern="^(live|summary)$"),
+    current_user: User = Depends(get_current_user)
+):
+    """Platform totals plus one page of per-conversation statistics.
+
+    `source=summary` reads the periodically refreshed conversation_summaries
+    collection (default when ADMIN_SUMMARY_REFRESH_SECONDS is set); `live`
+    aggregates the page's messages on demand.
+    """
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    conversations = await db.conversations.find({}, {"_id": 0}).to_list(1000)
-    messages_count = await db.messages.count_documents({})
-    users_count = await db.users.count_documents({})
-    nas_files_count = await db.nas_files.count_documents({})
+    if source is None:
+        source = "summary" if ADMIN_SUMMARY_REFRESH_SECONDS > 0 else "live"
+    
+    conversations = await db.conversations.find(
+        {}, {"_id": 0, "id": 1, "participant_usernames": 1}
+    ).sort([("created_at", -1), ("id", -1)]).skip(offset).to_list(limit + 1)
+    has_more = len(conversations) > limit
+    conversations = conversations[:limit]
+    conversation_ids = [conv['id'] for conv in conversations]
+    
+    # Collection metadata counts - no collection scans
+    messages_count = await db.messages.estimated_document_count()
+    users_count = await db.users.estimated_document_count()
+    conversations_count = await db.conversations.estimated_document_count()
+    nas_files_count = await db.nas_files.estimated_document_count()
+    
+    if source == "summary":
+        summaries = await db.conversation_summaries.find(
+            {"_id": {"$in": conversation_ids}}
+        ).to_list(len(conversation_ids))
+    else:
+        pipeline = [{"$match": {"conversation_id": {"$in": conversation_ids}}}] + conversation_summary_stages()
+        summaries = await db.messages.aggregate(pipeline).to_list(len(conversation_ids))
+    summary_by_id = {summary['_id']: summary for summary in summaries}
     
     conversation_metadata = []
     for conv in conversations:
-        msg_count = await db.messages.count_documents({"conversation_id": conv['id']})
-        last_msg = await db.messages.find_one(
-            {"conversation_id": conv['id']},
-            {"_id": 0, "timestamp": 1, "message_type": 1, "sender_username": 1},
-            sort=[("timestamp", -1)]
-        )
-        
+        summary = summary_by_id.get(conv['id'], {})
         conversation_metadata.append({
             "conversation_id": conv['id'],
             "participants": conv.get('participant_usernames', []),
-            "message_count": msg_count,
-            "last_message_time": last_msg.get('timestamp') if last_msg else None,
-            "last_message_type": last_msg.get('message_type') if last_msg else None,
-            "last_sender": last_msg.get('sender_username') if last_msg else None
+            "message_count": summary.get('message_count', 0),
+            "last_message_time": summary.get('last_message_time'),
+            "last_message_type": summary.get('last_message_type'),
+            "last_sender": summary.get('last_sender')
         })
     
     return {
         "total_users": users_count,
-        "total_conversations": len(conversations),
+        "total_conversations": conversations_count,
         "total_messages": messages_count,
         "total_nas_files": nas_files_count,
-        "conversation_metadata": conversation_metadata
+        "conversation_metadata": conversation_metadata,
+        "source": source,
+        "offset": offset,
+        "limit": limit,
+        "has_more": has_more
+    }
+
+@api_router.get("/admin/runtime")
+async def get_runtime_stats(current_user: User = Depends(get_current_user)):
+    """In-process cache and worker statistics for this API worker"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "pid": os.getpid(),
+        "user_cache": user_cache.stats(),
+        "user_directory_cache": user_directory_cache.stats(),
+        "blob_store": blob_store.stats(),
+        "settings_cache": settings_cache.stats(),
+        "conversation_ciphers": conversation_ciphers.stats(),
+        "call_signals": call_signals.stats(),
+        "read_receipts": read_receipts.stats(),
+        "presence": presence.stats(),
+        "typing": typing_tracker.stats(),
+        "membership_cache": membership_cache.stats(),
+        "message_ingest": message_ingest.stats(),
+        "client_message_acks": client_message_acks.stats(),
+        "retention": retention_stats,
+        "password_pool": password_pool.stats()
     }
 
 # ==================== CALL ROUTES (HTTP-based signaling) ====================
@@ -1018,12 +2239,120 @@ class CallSession(BaseModel):
     signal_data: Optional[Dict[str, Any]] = None
     answer_data: Optional[Dict[str, Any]] = None
     ice_candidates: List[Dict[str, Any]] = []
+    version: int = 0  # bumped on every change; pass back as `since` when long-polling
+
+# Only the most recent candidates are kept on the call document
+CALL_ICE_BUFFER = int(os.environ.get('CALL_ICE_BUFFER', 64))
+CALL_LONG_POLL_MAX = 25
+CALL_EVENTS = ('call_start', 'call_signal', 'call_accepted', 'call_ice_candidate', 'call_ended', 'call_rejected')
+
+class CallSignalHub:
+    """In-memory call state for this worker: latest call documents plus
+    wake-ups for long-polling HTTP clients waiting on a call or conversation.
+    
+    Changes made here wake waiters directly; changes made on other workers
+    arrive as call_* Socket.IO emits over the message queue (on_remote_emit).
+    """
+    
+    def __init__(self):
+        self.calls = TTLCache(maxsize=1000, ttl=3600)
+        self._waiters: Dict[str, list] = {}  # key -> [event, waiter_count]
+        self.remote_wakeups = 0
+    
+    def publish(self, call: Dict[str, Any]):
+        self.calls.set(call['id'], call)
+        self.wake(call['id'], call['conversation_id'])
+    
+    def wake(self, call_id: Optional[str], conversation_id: Optional[str]):
+        for key in (call_id, f"conversation:{conversation_id}" if conversation_id else None):
+            entry = self._waiters.pop(key, None) if key else None
+            if entry:
+                entry[0].set()
+    
+    def on_remote_event(self, event: str, data: Any):
+        if event in CALL_EVENTS and isinstance(data, dict):
+            # Our cached copy is stale now; waiters re-read the call from Mongo
+            self.calls.invalidate(data.get('call_id'))
+            self.remote_wakeups += 1
+            self.wake(data.get('call_id'), data.get('conversation_id'))
+    
+    def watch(self, key: str) -> list:
+        """Register interest before reading state, so a change in between is not missed"""
+        entry = self._waiters.setdefault(key, [asyncio.Event(), 0])
+        entry[1] += 1
+        return entry
+    
+    def unwatch(self, key: str, entry: list):
+        entry[1] -= 1
+        if entry[1] == 0 and self._waiters.get(key) is entry:
+            del self._waiters[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached_calls": len(self.calls),
+            "waiting_keys": len(self._waiters),
+            "waiters": sum(entry[1] for entry in self._waiters.values()),
+            "remote_wakeups": self.remote_wakeups
+        }
+
+call_signals = CallSignalHub()
+on_remote_emit(sio.manager, call_signals.on_remote_event)
+
+async def require_conversation_participant(conversation_id: str, user: User):
+    participants = await get_conversation_participants(conversation_id)
+    if not participants or user.id not in participants:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+async def require_call_participant(call_id: str, user: User):
+    """404 unless the call exists and the user is in its conversation"""
+    call = call_signals.calls.get(call_id) or await db.calls.find_one(
+        {"id": call_id}, {"_id": 0, "conversation_id": 1}
+    )
+    if not call:
+        raise HTTPException(status_code=404, detail="Call not found")
+    participants = await get_conversation_participants(call['conversation_id'])
+    if not participants or user.id not in participants:
+        raise HTTPException(status_code=404, detail="Call not found")
+
+async def update_call(call_id: str, update: Dict[str, Any], event: Optional[str] = None,
+                      payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Apply an update to a call, wake local long-pollers and push `event` to the conversation room"""
+    update.setdefault("$inc", {})["version"] = 1
+    call = await db.calls.find_one_and_update(
+        {"id": call_id}, update, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    if not call:
+        raise HTTPException(status_code=404, detail="Call not found")
+    
+    call_signals.publish(call)
+    if event:
+        await sio.emit(event, {"call_id": call_id, "conversation_id": call['conversation_id'],
+                               "status": call['status'], "version": call['version'], **(payload or {})},
+                       room=call['conversation_id'])
+    return call
+
+async def long_poll(key: str, fetch, is_ready, wait: float):
+    """Call fetch() until is_ready(result) or `wait` seconds pass; re-reads only when a call event wakes us"""
+    deadline = time.monotonic() + wait
+    while True:
+        entry = call_signals.watch(key)
+        try:
+            result = await fetch()
+            remaining = deadline - time.monotonic()
+            if is_ready(result) or remaining <= 0:
+                return result
+            try:
+                await asyncio.wait_for(entry[0].wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            call_signals.unwatch(key, entry)
 
 @api_router.post("/calls/start")
 async def start_call(conversation_id: str = Form(...), call_type: str = Form("audio"), current_user: User = Depends(get_current_user)):
     """Start a new call"""
     conversation = await db.conversations.find_one(
-        {"id": conversation_id, "participants": current_user.id}, {"_id": 0}
+        {"id": conversation_id, "participants": current_user.id}, {"_id": 0, "id": 1}
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
@@ -1031,7 +2360,7 @@ async def start_call(conversation_id: str = Form(...), call_type: str = Form("au
     # End any existing pending calls
     await db.calls.update_many(
         {"conversation_id": conversation_id, "status": "pending"},
-        {"$set": {"status": "ended"}}
+        {"$set": {"status": "ended", **await call_expiry()}, "$inc": {"version": 1}}
     )
     
     call = CallSession(
@@ -1044,47 +2373,90 @@ async def start_call(conversation_id: str = Form(...), call_type: str = Form("au
     doc = call.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.calls.insert_one(doc)
+    doc.pop('_id', None)
+    call_signals.publish(doc)
+    
+    await sio.emit('call_start', {
+        "call_id": call.id,
+        "conversation_id": conversation_id,
+        "caller_id": current_user.id,
+        "caller_username": current_user.username,
+        "call_type": call_type
+    }, room=conversation_id)
     
     return {"call_id": call.id, "status": "pending"}
 
 @api_router.get("/calls/pending/{conversation_id}")
-async def get_pending_call(conversation_id: str, current_user: User = Depends(get_current_user)):
-    """Check for pending incoming calls"""
-    call = await db.calls.find_one(
-        {
-            "conversation_id": conversation_id,
-            "status": "pending",
-            "caller_id": {"$ne": current_user.id}
-        },
-        {"_id": 0}
-    )
-    if call:
-        if isinstance(call.get('created_at'), str):
-            call['created_at'] = datetime.fromisoformat(call['created_at'])
-    return call
+async def get_pending_call(
+    conversation_id: str,
+    wait: float = Query(0, ge=0, le=CALL_LONG_POLL_MAX),
+    current_user: User = Depends(get_current_user)
+):
+    """Check for pending incoming calls, optionally waiting up to `wait` seconds for one"""
+    await require_conversation_participant(conversation_id, current_user)
+    
+    async def fetch():
+        call = await db.calls.find_one(
+            {
+                "conversation_id": conversation_id,
+                "status": "pending",
+                "caller_id": {"$ne": current_user.id}
+            },
+            {"_id": 0}
+        )
+        if call:
+            if isinstance(call.get('created_at'), str):
+                call['created_at'] = datetime.fromisoformat(call['created_at'])
+        return call
+    
+    return await long_poll(f"conversation:{conversation_id}", fetch, lambda call: call is not None, wait)
 
 @api_router.post("/calls/{call_id}/signal")
 async def send_signal(call_id: str, signal_data: Dict[str, Any], current_user: User = Depends(get_current_user)):
     """Send WebRTC signal data"""
-    await db.calls.update_one(
-        {"id": call_id},
-        {"$set": {"signal_data": signal_data}}
+    await require_call_participant(call_id, current_user)
+    await update_call(
+        call_id, {"$set": {"signal_data": signal_data}},
+        event="call_signal", payload={"from_user_id": current_user.id, "signal_data": signal_data}
     )
     return {"success": True}
 
 @api_router.post("/calls/{call_id}/answer")
 async def answer_call(call_id: str, answer_data: Dict[str, Any], current_user: User = Depends(get_current_user)):
     """Answer a call with WebRTC answer"""
-    await db.calls.update_one(
-        {"id": call_id},
-        {"$set": {"status": "accepted", "answer_data": answer_data}}
+    await require_call_participant(call_id, current_user)
+    await update_call(
+        call_id, {"$set": {"status": "accepted", "answer_data": answer_data}},
+        event="call_accepted", payload={"from_user_id": current_user.id, "answer_data": answer_data}
     )
     return {"success": True}
 
 @api_router.get("/calls/{call_id}/status")
-async def get_call_status(call_id: str, current_user: User = Depends(get_current_user)):
-    """Get call status and signal data"""
-    call = await db.calls.find_one({"id": call_id}, {"_id": 0})
+async def get_call_status(
+    call_id: str,
+    since: Optional[int] = None,
+    wait: float = Query(0, ge=0, le=CALL_LONG_POLL_MAX),
+    current_user: User = Depends(get_current_user)
+):
+    """Get call status and signal data.
+
+    With `since` (a previously seen version) and `wait`, the request is held
+    until the call changes or the wait expires.
+    """
+    await require_call_participant(call_id, current_user)
+    if since is not None:
+        # A newer state already seen by this worker can be answered from memory
+        cached = call_signals.calls.get(call_id)
+        if cached and cached.get('version', 0) > since:
+            return cached
+    
+    async def fetch():
+        return await db.calls.find_one({"id": call_id}, {"_id": 0})
+    
+    def is_ready(call):
+        return call is None or since is None or call.get('version', 0) > since
+    
+    call = await long_poll(call_id, fetch, is_ready, wait)
     if not call:
         raise HTTPException(status_code=404, detail="Call not found")
     return call
@@ -1092,102 +2464,440 @@ async def get_call_status(call_id: str, current_user: User = Depends(get_current
 @api_router.post("/calls/{call_id}/ice")
 async def add_ice_candidate(call_id: str, candidate: Dict[str, Any], current_user: User = Depends(get_current_user)):
     """Add ICE candidate"""
-    await db.calls.update_one(
-        {"id": call_id},
-        {"$push": {"ice_candidates": {"user_id": current_user.id, "candidate": candidate}}}
+    await require_call_participant(call_id, current_user)
+    entry = {"user_id": current_user.id, "candidate": candidate}
+    await update_call(
+        call_id,
+        {"$push": {"ice_candidates": {"$each": [entry], "$slice": -CALL_ICE_BUFFER}}},
+        event="call_ice_candidate", payload=entry
     )
     return {"success": True}
 
+async def call_expiry() -> Dict[str, Any]:
+    """expires_at for a call that just finished; the calls TTL index removes it then"""
+    settings = await load_admin_settings()
+    if RETENTION_INTERVAL_SECONDS <= 0 or settings.retention_days <= 0:
+        return {}
+    return {"expires_at": datetime.now(timezone.utc) + timedelta(days=settings.retention_days)}
+
 @api_router.post("/calls/{call_id}/end")
 async def end_call(call_id: str, current_user: User = Depends(get_current_user)):
     """End a call"""
-    await db.calls.update_one(
-        {"id": call_id},
-        {"$set": {"status": "ended"}}
-    )
+    await require_call_participant(call_id, current_user)
+    await update_call(call_id, {"$set": {"status": "ended", **await call_expiry()}}, event="call_ended",
+                      payload={"from_user_id": current_user.id})
     return {"success": True}
 
 @api_router.post("/calls/{call_id}/reject")
 async def reject_call(call_id: str, current_user: User = Depends(get_current_user)):
     """Reject a call"""
-    await db.calls.update_one(
-        {"id": call_id},
-        {"$set": {"status": "rejected"}}
-    )
+    await require_call_participant(call_id, current_user)
+    await update_call(call_id, {"$set": {"status": "rejected", **await call_expiry()}}, event="call_rejected",
+                      payload={"from_user_id": current_user.id})
     return {"success": True}
 
+# ==================== PRESENCE ====================
+
+PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', 2.0))
+# A worker that has not flushed for this long is presumed dead and its sessions dropped
+PRESENCE_WORKER_TIMEOUT = 60
+
+presence = PresenceService(WORKER_ID)
+
+async def broadcast_presence(changes: List[Dict[str, Any]]):
+    """Send presence deltas to the conversations of the users that changed, one event per room"""
+    if not changes:
+        return
+    by_user = {change['id']: change for change in changes}
+    for user_id in by_user:
+        invalidate_user(user_id, profile_changed=False)
+    async for conv in db.conversations.find(
+        {"participants": {"$in": list(by_user)}}, {"_id": 0, "id": 1, "participants": 1}
+    ):
+        deltas = [by_user[p] for p in conv['participants'] if p in by_user]
+        await sio.emit('presence', {"conversation_id": conv['id'], "users": deltas}, room=conv['id'])
+
+async def flush_presence():
+    """Write coalesced presence changes, heartbeat this worker and broadcast flips"""
+    await broadcast_presence(await presence.flush(db.users))
+    await db.presence_workers.update_one(
+        {"_id": WORKER_ID}, {"$set": {"seen_at": datetime.now(timezone.utc).isoformat()}}, upsert=True
+    )
+
+async def reap_dead_workers():
+    """Take users offline whose only sessions were on a worker that stopped heartbeating"""
+    if not await acquire_job_lease("presence_reaper", PRESENCE_WORKER_TIMEOUT):
+        return
+    stale_before = (datetime.now(timezone.utc) - timedelta(seconds=PRESENCE_WORKER_TIMEOUT)).isoformat()
+    async for worker in db.presence_workers.find({"seen_at": {"$lt": stale_before}}):
+        await broadcast_presence(await PresenceService.drop_worker(db.users, worker['_id']))
+        await db.presence_workers.delete_one({"_id": worker['_id'], "seen_at": worker['seen_at']})
+
+# ==================== TYPING INDICATORS ====================
+
+TYPING_TICK_SECONDS = float(os.environ.get('TYPING_TICK_SECONDS', 0.5))
+# A typist who sends nothing for this long is considered to have stopped
+TYPING_TTL_SECONDS = 5.0
+
+class TypingTracker:
+    """Who is typing where, on this worker.
+
+    Keystroke events only refresh an expiry. Once per tick, each conversation
+    whose typists changed gets a single typing_update with the users that
+    started and stopped, so a room sees at most one frame per tick however
+    many people type. Deltas (not full lists) keep workers from overwriting
+    each other's typists.
+    
+    Typists are tracked per (username, sid), so one tab stopping or closing
+    does not hide the same user typing in another. Deltas are the difference
+    between who types now and what the room was last told, so every start
+    that went out is eventually matched by a stop. Ongoing typists are
+    re-announced every half TTL, which lets clients expire indicators whose
+    stop got lost.
+    """
+    
+    def __init__(self):
+        self._expires: Dict[str, Dict[tuple, float]] = {}  # conversation -> (username, sid) -> deadline
+        self._by_sid: Dict[str, set] = {}  # sid -> {conversation}
+        self._announced: Dict[str, set] = {}  # conversation -> usernames the room was last told are typing
+        self._announced_at: Dict[str, float] = {}
+        self._dirty: set = set()  # conversations whose typists changed since the last drain
+        self.updates = 0
+        self.events = 0
+    
+    def update(self, sid: str, conversation_id: str, username: str, active: bool):
+        self.updates += 1
+        key = (username, sid)
+        if active:
+            typists = self._expires.setdefault(conversation_id, {})
+            if key not in typists:
+                self._dirty.add(conversation_id)
+            typists[key] = time.monotonic() + TYPING_TTL_SECONDS
+            self._by_sid.setdefault(sid, set()).add(conversation_id)
+        else:
+            self._stop(conversation_id, key)
+    
+    def _stop(self, conversation_id: str, key: tuple):
+        typists = self._expires.get(conversation_id)
+        if not typists or typists.pop(key, None) is None:
+            return
+        if not typists:
+            del self._expires[conversation_id]
+        self._dirty.add(conversation_id)
+    
+    def drop_sid(self, sid: str):
+        for conversation_id in self._by_sid.pop(sid, ()):
+            for key in [key for key in self._expires.get(conversation_id, ()) if key[1] == sid]:
+                self._stop(conversation_id, key)
+    
+    def expire(self):
+        now = time.monotonic()
+        for conversation_id, typists in list(self._expires.items()):
+            for key, deadline in list(typists.items()):
+                if deadline < now:
+                    self._stop(conversation_id, key)
+    
+    def drain(self) -> Dict[str, Dict[str, List[str]]]:
+        """Per-conversation started/stopped deltas since the last drain"""
+        changes = {}
+        now = time.monotonic()
+        stale = {conversation_id for conversation_id, at in self._announced_at.items()
+                 if now - at >= TYPING_TTL_SECONDS / 2}
+        for conversation_id in self._dirty | stale:
+            typing_now = {username for username, _ in self._expires.get(conversation_id, ())}
+            announced = self._announced.pop(conversation_id, set())
+            self._announced_at.pop(conversation_id, None)
+            if typing_now:
+                self._announced[conversation_id] = typing_now
+                self._announced_at[conversation_id] = now
+            refresh = typing_now if conversation_id in stale else typing_now - announced
+            started = sorted(refresh)
+            stopped = sorted(announced - typing_now)
+            if started or stopped:
+                changes[conversation_id] = {"started": started, "stopped": stopped}
+        self._dirty.clear()
+        return changes
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conversations": len(self._expires),
+            "typists": sum(len(t) for t in self._expires.values()),
+            "updates": self.updates,
+            "events": self.events
+        }
+
+typing_tracker = TypingTracker()
+
+async def flush_typing():
+    typing_tracker.expire()
+    for conversation_id, delta in typing_tracker.drain().items():
+        typing_tracker.events += 1
+        await sio.emit('typing_update', {"conversation_id": conversation_id, **delta}, room=conversation_id)
+
 # ==================== SOCKET.IO EVENTS ====================
 
+def socket_token(environ: Dict[str, Any], auth: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Access token from the Socket.IO auth payload, falling back to an Authorization header"""
+    if isinstance(auth, dict) and auth.get('token'):
+        return auth['token']
+    header = environ.get('HTTP_AUTHORIZATION', '')
+    if header.lower().startswith('bearer '):
+        return header[7:]
+    return None
+
 @sio.event
-async def connect(sid, environ):
-    print(f"Client connected: {sid}")
+async def connect(sid, environ, auth=None):
+    """Reject sockets without a valid access token; the user is then bound to the session"""
+    token = socket_token(environ, auth)
+    user = await user_from_token(token) if token else None
+    if user is None:
+        raise socketio.exceptions.ConnectionRefusedError("unauthorized")
+    
+    await sio.save_session(sid, {"user_id": user.id, "username": user.username})
+    presence.connect(sid, user.id)
+    await sio.enter_room(sid, user_room(user.id))
+    # Warm the membership cache so the client's room joins need no lookups
+    if membership_cache.get(user.id) is None:
+        await load_memberships(user.id)
 
 @sio.event
 async def disconnect(sid):
-    print(f"Client disconnected: {sid}")
-    for user_id, socket_id in list(active_connections.items()):
-        if socket_id == sid:
-            del active_connections[user_id]
-            await db.users.update_one({"id": user_id}, {"$set": {"online": False}})
-            break
+    presence.disconnect(sid)
+    typing_tracker.drop_sid(sid)
+
+def invalid_payload() -> Dict[str, Any]:
+    """Ack for an event whose payload is not the object the handler expects"""
+    return {"ok": False, "status": 400, "error": "Invalid payload"}
 
 @sio.event
 async def join_conversation(sid, data):
+    """Join one (`conversation_id`) or many (`conversation_ids`) rooms the user belongs to"""
+    if not isinstance(data, dict):
+        return invalid_payload()
+    requested = data.get('conversation_ids') or [data.get('conversation_id')]
+    if not isinstance(requested, list):
+        return invalid_payload()
+    session = await sio.get_session(sid)
+    joined, denied = [], []
+    for conversation_id in filter(None, requested):
+        if not isinstance(conversation_id, str):
+            denied.append(conversation_id)
+            continue
+        if await is_conversation_member(session['user_id'], conversation_id):
+            await sio.enter_room(sid, conversation_id)
+            joined.append(conversation_id)
+        else:
+            denied.append(conversation_id)
+    return {"joined": joined, "denied": denied}
+
+# (user id, client message id) -> future of the ack, so retries reuse the first send
+client_message_acks = TTLCache(maxsize=int(os.environ.get('CLIENT_MESSAGE_CACHE_SIZE', 10000)), ttl=300)
+
+async def socket_send(session: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate and publish one socket message; errors become acks with an HTTP-like status"""
     conversation_id = data.get('conversation_id')
-    user_id = data.get('user_id')
-    if conversation_id:
-        await sio.enter_room(sid, conversation_id)
-        if user_id:
-            active_connections[user_id] = sid
+    content = data.get('content')
+    message_type = data.get('message_type', 'text')
+    metadata = data.get('metadata') or {}
+    if not conversation_id or not isinstance(content, str) or not content:
+        return {"ok": False, "status": 400, "error": "conversation_id and content are required"}
+    if message_type not in ('text', 'sticker') or not isinstance(metadata, dict):
+        # Attachments still go through the HTTP route (multipart upload)
+        return {"ok": False, "status": 400, "error": "Only text and sticker messages can be sent over the socket"}
+    
+    participants = await get_conversation_participants(conversation_id)
+    if not participants or session['user_id'] not in participants:
+        return {"ok": False, "status": 404, "error": "Conversation not found"}
+    
+    sender = await get_cached_user(session['user_id'])
+    if sender is None:
+        return {"ok": False, "status": 401, "error": "User not found"}
+    try:
+        message = await publish_message(conversation_id, participants, sender, content, message_type,
+                                        client_metadata(metadata), message_id=data.get('id'))
+    except HTTPException as e:
+        return {"ok": False, "status": e.status_code, "error": e.detail}
+    return {"ok": True, "message": message}
+
+@sio.on('send_message')
+async def socket_send_message(sid, data):
+    """Send a text or sticker message on the socket's session; the reply is the ack.
+    
+    Clients pass their own UUID as `id` and resend with the same id until an
+    ack arrives. Retries on this worker get the original ack; elsewhere the
+    unique message id keeps the message from being stored twice.
+    """
+    session = await sio.get_session(sid)
+    if not isinstance(data, dict):
+        return invalid_payload()
+    
+    key = None
+    if data.get('id') is not None:
+        try:
+            data['id'] = str(uuid.UUID(str(data['id'])))
+        except ValueError:
+            return {"ok": False, "status": 400, "error": "id must be a UUID"}
+        key = (session['user_id'], data['id'])
+    
+    pending = client_message_acks.get(key) if key else None
+    if pending is None:
+        pending = asyncio.ensure_future(socket_send(session, data))
+        if key:
+            client_message_acks.set(key, pending)
+    try:
+        ack = await asyncio.shield(pending)
+    except Exception as e:
+        logger.error(f"Socket send_message failed: {str(e)}")
+        ack = {"ok": False, "status": 500, "error": "Message could not be sent"}
+    if key and not ack['ok'] and ack['status'] >= 500:
+        # Let the client's retry try again instead of replaying the failure
+        client_message_acks.invalidate(key)
+    return ack
 
 @sio.event
 async def leave_conversation(sid, data):
+    if not isinstance(data, dict):
+        return invalid_payload()
     conversation_id = data.get('conversation_id')
     if conversation_id:
         await sio.leave_room(sid, conversation_id)
 
 @sio.event
 async def typing(sid, data):
+    """Client says it is (or, with typing=false, stopped) typing; broadcast happens on the next tick"""
+    if not isinstance(data, dict):
+        return invalid_payload()
+    session = await sio.get_session(sid)
     conversation_id = data.get('conversation_id')
-    username = data.get('username')
-    await sio.emit('user_typing', {"username": username}, room=conversation_id, skip_sid=sid)
+    if not conversation_id or not isinstance(conversation_id, str):
+        return invalid_payload()
+    if await is_conversation_member(session['user_id'], conversation_id):
+        typing_tracker.update(sid, conversation_id, session['username'], data.get('typing', True) is not False)
 
 @sio.event
 async def webrtc_offer(sid, data):
+    if not isinstance(data, dict):
+        return invalid_payload()
     target_user_id = data.get('target_user_id')
-    if target_user_id in active_connections:
-        await sio.emit('webrtc_offer', data, room=active_connections[target_user_id])
+    if target_user_id and isinstance(target_user_id, str):
+        session = await sio.get_session(sid)
+        await sio.emit('webrtc_offer', {**data, "from_user_id": session['user_id']}, room=user_room(target_user_id))
 
 @sio.event
 async def webrtc_answer(sid, data):
+    if not isinstance(data, dict):
+        return invalid_payload()
     target_user_id = data.get('target_user_id')
-    if target_user_id in active_connections:
-        await sio.emit('webrtc_answer', data, room=active_connections[target_user_id])
+    if target_user_id and isinstance(target_user_id, str):
+        session = await sio.get_session(sid)
+        await sio.emit('webrtc_answer', {**data, "from_user_id": session['user_id']}, room=user_room(target_user_id))
 
 @sio.event
 async def webrtc_ice_candidate(sid, data):
+    if not isinstance(data, dict):
+        return invalid_payload()
     target_user_id = data.get('target_user_id')
-    if target_user_id in active_connections:
-        await sio.emit('webrtc_ice_candidate', data, room=active_connections[target_user_id])
-
-app.include_router(api_router)
+    if target_user_id and isinstance(target_user_id, str):
+        session = await sio.get_session(sid)
+        await sio.emit('webrtc_ice_candidate', {**data, "from_user_id": session['user_id']}, room=user_room(target_user_id))
 
-# Middleware stack
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# ==================== BACKUP & EXPORT ====================
 
-app = socketio.ASGIApp(sio, app)
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_BATCH_SIZE = 500
+# The wrapped conversation key and other participants' unread counters stay server-side
+EXPORT_CONVERSATION_PROJECTION = {"_id": 0, "encryption_key": 0, "retired_keys": 0, "unread": 0}
+
+async def stream_user_export(user: User, since: Optional[str]):
+    """Yield the user's conversations and messages as NDJSON records, one cursor at a time"""
+    yield {
+        "type": "export",
+        "user_id": user.id,
+        "username": user.username,
+        "export_timestamp": datetime.now(timezone.utc).isoformat(),
+        "since": since
+    }
+    
+    conversation_ids = []
+    async for conv in db.conversations.find({"participants": user.id}, EXPORT_CONVERSATION_PROJECTION):
+        conversation_ids.append(conv['id'])
+        yield {"type": "conversation", "data": conv}
+    
+    since_filter = keyset_filter(since, "after") if since else {}
+    newest = tuple(decode_cursor(since)) if since else None
+    message_count = 0
+    # Per conversation so every cursor walks the (conversation_id, timestamp, id) index in order
+    for conversation_id in conversation_ids:
+        cursor = db.messages.find(
+            {"conversation_id": conversation_id, **since_filter}, {"_id": 0, "search_tokens": 0}
+        ).sort([("timestamp", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+        async for msg in cursor:
+            message_count += 1
+            position = (msg['timestamp'], msg['id'])
+            if newest is None or position > newest:
+                newest = position
+            yield {"type": "message", "data": msg}
+    
+    yield {
+        "type": "end",
+        "conversations": len(conversation_ids),
+        "messages": message_count,
+        # Pass as `since` next time to export only newer messages
+        "next_since": encode_cursor(*newest) if newest else None
+    }
 
-# ==================== BACKUP & EXPORT ====================
+async def ndjson_chunks(records):
+    """Serialize records as newline-delimited JSON, buffered into ~64 KB chunks"""
+    buffer = []
+    size = 0
+    async for record in records:
+        line = (json.dumps(record, default=str, ensure_ascii=False) + "\n").encode()
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 @api_router.post("/backup/export")
-async def export_user_data(current_user: User = Depends(get_current_user)):
-    """Export user's messages and conversations for backup"""
+async def export_user_data(
+    export_format: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+    compress: bool = False,
+    since: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Export user's messages and conversations for backup.
+
+    `format=ndjson` streams one JSON record per line with bounded memory
+    (optionally gzip-compressed with `compress=true`); the final record
+    carries `next_since` for incremental backups.
+    """
+    if export_format == "ndjson":
+        if since:
+            decode_cursor(since)  # reject a bad cursor before streaming starts
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+        filename = f"encryptalk-backup-{current_user.username}-{stamp}.ndjson"
+        body = ndjson_chunks(stream_user_export(current_user, since))
+        media_type = "application/x-ndjson"
+        if compress:
+            body = gzip_chunks(body)
+            filename += ".gz"
+            media_type = "application/gzip"
+        return StreamingResponse(
+            body,
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    
     try:
         backup_data = {
             "user_id": current_user.id,
@@ -1200,7 +2910,7 @@ async def export_user_data(current_user: User = Depends(get_current_user)):
         # Get all conversations this user is in
         conversations = await db.conversations.find(
             {"participants": current_user.id},
-            {"_id": 0}
+            EXPORT_CONVERSATION_PROJECTION
         ).to_list(1000)
         
         for conv in conversations:
@@ -1209,7 +2919,7 @@ async def export_user_data(current_user: User = Depends(get_current_user)):
             # Get all messages in this conversation
             messages = await db.messages.find(
                 {"conversation_id": conv["id"]},
-                {"_id": 0, "hashed_password": 0}
+                {"_id": 0, "search_tokens": 0}
             ).to_list(10000)
             
             backup_data["messages"].extend(messages)
@@ -1238,6 +2948,238 @@ async def get_backup_status(current_user: User = Depends(get_current_user)):
         logger.error(f"Backup status check failed: {str(e)}")
         raise HTTPException(status_code=500, detail="Status check failed")
 
+# ==================== RETENTION ====================
+
+# Retention is opt-in: the worker only runs when this is set (> 0) and
+# AdminSettings.retention_days is above 0, so an upgrade never purges history
+RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', 0))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 500))
+# Pause between delete batches so purges never saturate Mongo or the disk
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', 0.2))
+# Staged uploads and trashed blobs older than this were left behind by a crash
+RETENTION_STALE_FILE_SECONDS = 24 * 3600
+
+retention_stats: Dict[str, Any] = {
+    "runs": 0,
+    "running": False,
+    "messages_deleted": 0,
+    "calls_deleted": 0,
+    "blobs_released": 0,
+    "files_deleted": 0,
+    "last_run": None
+}
+
+async def purge_messages_before(cutoff: str, report: Dict[str, Any]):
+    """Delete messages older than cutoff batch by batch, releasing their attachments"""
+    while True:
+        batch = await db.messages.find(
+            {"timestamp": {"$lt": cutoff}},
+            {"_id": 0, "id": 1, "blob": 1, "metadata.file_url": 1}
+        ).to_list(RETENTION_BATCH_SIZE)
+        if not batch:
+            return
+        
+        ids = [msg['id'] for msg in batch]
+        result = await db.messages.delete_many({"id": {"$in": ids}})
+        report["messages_deleted"] += result.deleted_count
+        report["batches"] += 1
+        
+        legacy_urls = set()
+        for msg in batch:
+            if msg.get('blob'):
+                # Only the reference the server recorded at send time; metadata is client-visible
+                await blob_store.release(msg['blob'])
+                report["blobs_released"] += 1
+                continue
+            file_url = (msg.get('metadata') or {}).get('file_url')
+            if file_url and file_url.startswith("/api/files/uploads/"):
+                legacy_urls.add(file_url)
+        
+        for file_url in legacy_urls:
+            filepath = resolve_upload_path(FILES_DIR, file_url.rsplit('/', 1)[-1])
+            # Pre-blob-store upload: remove it once no remaining message links it
+            if filepath.parent != FILES_DIR or await db.messages.find_one({"metadata.file_url": file_url}, {"_id": 1}):
+                continue
+            if filepath.is_file():
+                filepath.unlink(missing_ok=True)
+                report["files_deleted"] += 1
+        
+        # Don't leave previews or pins pointing at deleted messages
+        await db.conversations.update_many({"last_message.id": {"$in": ids}}, {"$set": {"last_message": None}})
+        await db.conversations.update_many({"pinned_messages": {"$in": ids}},
+                                           {"$pull": {"pinned_messages": {"$in": ids}}})
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+
+async def purge_calls_before(cutoff: str, report: Dict[str, Any]):
+    """Delete finished calls the TTL index does not cover (ended before expires_at existed)"""
+    while True:
+        batch = await db.calls.find(
+            {"status": {"$in": ["ended", "rejected"]}, "created_at": {"$lt": cutoff}}, {"_id": 0, "id": 1}
+        ).to_list(RETENTION_BATCH_SIZE)
+        if not batch:
+            return
+        result = await db.calls.delete_many({"id": {"$in": [call['id'] for call in batch]}})
+        report["calls_deleted"] += result.deleted_count
+        report["batches"] += 1
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+
+def purge_stale_blob_files(report: Dict[str, Any]):
+    """Remove staged uploads and trashed blobs abandoned by a crashed worker"""
+    stale_before = time.time() - RETENTION_STALE_FILE_SECONDS
+    for directory in (blob_store.staging_dir, blob_store.trash_dir):
+        for path in directory.iterdir():
+            if path.stat().st_mtime < stale_before:
+                path.unlink(missing_ok=True)
+                report["files_deleted"] += 1
+
+async def run_retention():
+    """Enforce AdminSettings.retention_days on messages, calls and upload files"""
+    if not await acquire_job_lease("retention", RETENTION_INTERVAL_SECONDS):
+        return
+    settings = await load_admin_settings()
+    if settings.retention_days <= 0:
+        return
+    
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=settings.retention_days)).isoformat()
+    report = {
+        "worker": WORKER_ID,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "retention_days": settings.retention_days,
+        "cutoff": cutoff,
+        "messages_deleted": 0,
+        "calls_deleted": 0,
+        "blobs_released": 0,
+        "files_deleted": 0,
+        "batches": 0
+    }
+    retention_stats["running"] = True
+    started = time.monotonic()
+    try:
+        await purge_messages_before(cutoff, report)
+        await purge_calls_before(cutoff, report)
+        await asyncio.to_thread(purge_stale_blob_files, report)
+    finally:
+        elapsed = time.monotonic() - started
+        report["finished_at"] = datetime.now(timezone.utc).isoformat()
+        report["seconds"] = round(elapsed, 2)
+        report["docs_per_second"] = round((report["messages_deleted"] + report["calls_deleted"]) / elapsed, 1) if elapsed else 0.0
+        
+        retention_stats["running"] = False
+        retention_stats["runs"] += 1
+        for key in ("messages_deleted", "calls_deleted", "blobs_released", "files_deleted"):
+            retention_stats[key] += report[key]
+        retention_stats["last_run"] = report
+        # Shared with every worker through GET /admin/retention
+        await db.job_reports.replace_one({"_id": "retention"}, report, upsert=True)
+    
+    if report["messages_deleted"] or report["calls_deleted"]:
+        logger.info(f"Retention: removed {report['messages_deleted']} messages and {report['calls_deleted']} calls "
+                    f"older than {settings.retention_days} days in {report['seconds']}s")
+
+@api_router.get("/admin/retention")
+async def get_retention_report(current_user: User = Depends(get_current_user)):
+    """Settings and result of the most recent retention run, whichever worker ran it"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    settings = await load_admin_settings()
+    return {
+        "retention_days": settings.retention_days,
+        "interval_seconds": RETENTION_INTERVAL_SECONDS,
+        "batch_size": RETENTION_BATCH_SIZE,
+        "last_run": await db.job_reports.find_one({"_id": "retention"}, {"_id": 0})
+    }
+
+# ==================== STARTUP ====================
+
+background_tasks: List[asyncio.Task] = []
+
+async def acquire_job_lease(name: str, ttl_seconds: float) -> bool:
+    """Claim a cluster-wide lease so only one worker runs a periodic job per interval"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now.isoformat()}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": (now + timedelta(seconds=ttl_seconds)).isoformat()}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+def start_periodic_task(name: str, interval: float, job):
+    """Run `job` every `interval` seconds for the lifetime of the worker"""
+    async def runner():
+        while True:
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Background job {name} failed: {str(e)}")
+            await asyncio.sleep(interval)
+    
+    background_tasks.append(asyncio.create_task(runner(), name=name))
+
+@app.on_event("startup")
+async def start_background_jobs():
+    if ADMIN_SUMMARY_REFRESH_SECONDS > 0:
+        start_periodic_task("conversation_summaries", ADMIN_SUMMARY_REFRESH_SECONDS, refresh_conversation_summaries)
+    start_periodic_task("read_receipts", READ_RECEIPT_FLUSH_SECONDS, flush_read_receipts)
+    start_periodic_task("presence", PRESENCE_FLUSH_SECONDS, flush_presence)
+    start_periodic_task("typing", TYPING_TICK_SECONDS, flush_typing)
+    start_periodic_task("presence_reaper", PRESENCE_WORKER_TIMEOUT, reap_dead_workers)
+    if RETENTION_INTERVAL_SECONDS > 0:
+        start_periodic_task("retention", RETENTION_INTERVAL_SECONDS, run_retention)
+    background_tasks.append(asyncio.create_task(backfill_search_tokens(), name="search_backfill"))
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    # Don't lose buffered writes on a graceful restart
+    await message_ingest.flush()
+    await flush_read_receipts()
+    presence.release_all()
+    await flush_presence()
+    await db.presence_workers.delete_one({"_id": WORKER_ID})
+
+@app.on_event("startup")
+async def bootstrap_indexes():
+    """Create any missing MongoDB indexes before serving traffic"""
+    try:
+        report = await ensure_indexes(db)
+    except Exception as e:
+        logger.error(f"Index bootstrap failed: {str(e)}")
+        index_failures.append(f"bootstrap: {str(e)}")
+        return
+    logger.info(f"Index bootstrap: {format_index_report(report)}")
+    for name in report["created"]:
+        logger.info(f"Created index {name}")
+    for failure in report["failed"]:
+        logger.warning(f"Index not created - {failure}")
+    for name in report["failed_unique"]:
+        # Duplicate ids, usernames or codes are no longer rejected until this is fixed
+        logger.error(f"Unique index {name} is missing; clean up duplicates and restart")
+    index_failures.extend(report["failed"])
+
+app.include_router(api_router)
+
+# Middleware stack
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Prev-Cursor", "X-Has-More"],
+)
+
+app = socketio.ASGIApp(sio, app)
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -1247,8 +3189,13 @@ if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8001))
     workers = int(os.environ.get('WORKERS', 4))
     
+    # Workers on one host share Socket.IO rooms over a local IPC bus unless a broker is configured
+    if workers > 1 and not os.environ.get('SOCKETIO_MESSAGE_QUEUE'):
+        os.environ['SOCKETIO_MESSAGE_QUEUE'] = f"ipc://{UPLOAD_DIR / '.socketio.sock'}"
+    
+    # uvicorn needs an import string to spawn multiple workers
     uvicorn.run(
-        app,
+        "server:app" if workers > 1 else app,
         host=host,
         port=port,
         workers=workers,
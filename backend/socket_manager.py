@@ -0,0 +1,193 @@
+"""
+Socket.IO client managers for EncrypTalk
+Lets room emits reach sockets held by other workers or nodes
+
+SOCKETIO_MESSAGE_QUEUE selects the backend:
+  (unset)               in-process only (single worker)
+  memory://             in-process pub/sub bus (tests, single process)
+  ipc:///path/to.sock   Unix socket bus shared by workers on one host
+  redis://host:6379/0   Redis pub/sub across nodes (needs `redis`)
+  amqp://user:pw@host/  RabbitMQ across nodes (needs `aio_pika`)
+"""
+
+import asyncio
+import fcntl
+import logging
+import json
+import os
+import struct
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct(">I")
+RECONNECT_DELAY = 0.5
+
+
+class AsyncMemoryManager(AsyncPubSubManager):
+    """Pub/sub over an in-process bus; stands in for a broker in tests"""
+    name = 'memory'
+
+    # channel -> subscriber queues of every manager in this process
+    _subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue: Optional[asyncio.Queue] = None
+        if not write_only:
+            self.queue = asyncio.Queue()
+            self._subscribers.setdefault(channel, []).append(self.queue)
+
+    async def _publish(self, data):
+        # Serialize as JSON, which is what the base listener decodes (as on a real broker)
+        payload = json.dumps(data)
+        for queue in self._subscribers.get(self.channel, []):
+            if queue is not self.queue:
+                queue.put_nowait(payload)
+
+    async def _listen(self):
+        while True:
+            yield await self.queue.get()
+
+
+class AsyncUnixSocketManager(AsyncPubSubManager):
+    """Pub/sub between workers on one host over a Unix domain socket.
+
+    The first worker to take the lock file runs a small relay hub on the
+    socket; every worker (the hub's own included) connects to it as a
+    client. If the hub worker exits, its lock is released and the remaining
+    workers elect a new hub on reconnect.
+    """
+    name = 'ipc'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.socket_path = urlparse(url).path
+        if not self.socket_path:
+            raise ValueError("ipc:// message queue URL needs a socket path, e.g. ipc:///tmp/encryptalk.sock")
+        self.lock_path = self.socket_path + ".lock"
+        self._lock_fd = None
+        self._hub = None
+        self._hub_clients = set()
+        self._reader = None
+        self._writer = None
+        self._connect_lock = asyncio.Lock()
+
+    async def _become_hub(self) -> bool:
+        if self._hub is not None:
+            return True
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        # We hold the lock, so any existing socket file belongs to a dead hub
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._hub = await asyncio.start_unix_server(self._relay, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        logger.info(f"Socket.IO IPC hub listening on {self.socket_path} (pid {os.getpid()})")
+        return True
+
+    async def _relay(self, reader, writer):
+        """Hub side: forward every frame from one worker to all the others"""
+        self._hub_clients.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                payload = await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+                for client in list(self._hub_clients):
+                    if client is writer:
+                        continue
+                    try:
+                        client.write(header + payload)
+                    except (ConnectionError, RuntimeError):
+                        self._hub_clients.discard(client)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._hub_clients.discard(writer)
+            writer.close()
+
+    async def _connect(self):
+        async with self._connect_lock:
+            while self._writer is None:
+                try:
+                    await self._become_hub()
+                    self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+                except (FileNotFoundError, ConnectionError) as e:
+                    # Hub not listening yet (election in progress) - retry shortly
+                    logger.debug(f"Socket.IO IPC bus not reachable: {e}")
+                    await asyncio.sleep(RECONNECT_DELAY)
+            return self._reader, self._writer
+
+    def _drop_connection(self, writer):
+        # Only reset if nobody has reconnected in the meantime
+        writer.close()
+        if self._writer is writer:
+            self._reader = self._writer = None
+
+    async def _publish(self, data):
+        payload = json.dumps(data).encode()
+        _, writer = await self._connect()
+        try:
+            writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+            await writer.drain()
+        except ConnectionError:
+            self._drop_connection(writer)
+            raise
+
+    async def _listen(self):
+        while True:
+            reader, writer = await self._connect()
+            try:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                yield await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning("Socket.IO IPC hub connection lost, reconnecting")
+                self._drop_connection(writer)
+                await asyncio.sleep(RECONNECT_DELAY)
+
+
+def on_remote_emit(manager: Optional[socketio.AsyncManager], callback: Callable[[str, Any], None]):
+    """Call `callback(event, data)` for every emit that arrives from another worker.
+
+    Lets server-side state (e.g. long-poll waiters) react to events published
+    elsewhere without polling the database. No-op without a pub/sub manager.
+    """
+    if not isinstance(manager, AsyncPubSubManager):
+        return
+    handle_emit = manager._handle_emit
+
+    async def _handle_emit(message):
+        if message.get('host_id') != manager.host_id:
+            data = message.get('data')
+            try:
+                callback(message['event'], data[0] if isinstance(data, list) and data else data)
+            except Exception:
+                logger.exception("Remote emit listener failed")
+        await handle_emit(message)
+
+    manager._handle_emit = _handle_emit
+
+
+def create_client_manager(url: Optional[str], channel: str = 'encryptalk') -> Optional[socketio.AsyncManager]:
+    """Build the client manager for a SOCKETIO_MESSAGE_QUEUE URL (None = default in-process manager)"""
+    if not url:
+        return None
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return AsyncMemoryManager(channel=channel)
+    if scheme == 'ipc':
+        return AsyncUnixSocketManager(url, channel=channel)
+    if scheme in ('redis', 'rediss'):
+        return socketio.AsyncRedisManager(url, channel=channel)
+    if scheme in ('amqp', 'amqps'):
+        return socketio.AsyncAioPikaManager(url, channel=channel)
+    raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE scheme: {scheme}")
@@ -0,0 +1,12 @@
+import React from 'react';
+import { useAuthorizedFile } from '@/hooks/useAuthorizedFile';
+
+/**
+ * <img>, <audio> or <video> for a protected file, loaded through a signed URL
+ * so the browser can stream and seek it. Renders nothing until the URL is known.
+ */
+export default function AuthorizedMedia({ as: Tag = 'img', path, ...props }) {
+  const url = useAuthorizedFile(path);
+  if (!url) return null;
+  return <Tag src={url} {...props} />;
+}
@@ -8,6 +8,7 @@ import { ScrollArea } from '@/components/ui/scroll-area';
 import { Switch } from '@/components/ui/switch';
 import axios from 'axios';
 import { toast } from 'sonner';
+import { downloadAuthorizedFile, getSignedFileUrl } from '@/hooks/useAuthorizedFile';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -79,14 +80,27 @@ export default function NASModal({ onClose, user, config }) {
     }
   };
 
-  const handleCopyDownloadLink = (filepath) => {
-    const fullUrl = BACKEND_URL + filepath;
+  const handleCopyDownloadLink = async (filepath) => {
+    // Giriş yapmadan açılabilen, kısa süreli imzalı link
+    const fullUrl = await getSignedFileUrl(filepath).catch(() => null);
+    if (!fullUrl) {
+      toast.error('Link oluşturulamadı');
+      return;
+    }
     navigator.clipboard.writeText(fullUrl);
     setCopiedLink({ ...copiedLink, [filepath]: true });
     toast.success('📋 Link kopyalandı');
     setTimeout(() => setCopiedLink({ ...copiedLink, [filepath]: false }), 2000);
   };
 
+  const handleDownload = async (file) => {
+    try {
+      await downloadAuthorizedFile(file.filepath, file.filename);
+    } catch (error) {
+      toast.error('İndirme başarısız');
+    }
+  };
+
   const handleDelete = async (fileId) => {
     if (!window.confirm('Bu dosyayı silmek istediğinize emin misiniz?')) return;
 
@@ -230,15 +244,14 @@ export default function NASModal({ onClose, user, config }) {
                           )}
                         </Button>
 
-                        <a href={BACKEND_URL + file.filepath} download target="_blank" rel="noopener noreferrer">
-                          <Button
-                            size="sm"
-                            variant="ghost"
-                            className="h-8 w-8 p-0 text-slate-400 hover:text-[#22c55e]"
-                          >
-                            <Download className="w-4 h-4" />
-                          </Button>
-                        </a>
+                        <Button
+                          size="sm"
+                          variant="ghost"
+                          onClick={() => handleDownload(file)}
+                          className="h-8 w-8 p-0 text-slate-400 hover:text-[#22c55e]"
+                        >
+                          <Download className="w-4 h-4" />
+                        </Button>
 
                         {(user.role === 'admin' || user.id === file.uploaded_by) && (
                           <Button
@@ -5,6 +5,7 @@ import { Button } from '@/components/ui/button';
 import { ScrollArea } from '@/components/ui/scroll-area';
 import axios from 'axios';
 import { toast } from 'sonner';
+import AuthorizedMedia from '@/components/AuthorizedMedia';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -162,8 +163,8 @@ export default function StickerPicker({ onClose, onSelectSticker, config }) {
                       }}
                       className="p-2 bg-slate-800 rounded-lg hover:bg-slate-700 transition-colors"
                     >
-                      <img
-                        src={BACKEND_URL + sticker.filepath}
+                      <AuthorizedMedia
+                        path={sticker.filepath}
                         alt={sticker.name}
                         className="w-full h-20 object-contain"
                       />
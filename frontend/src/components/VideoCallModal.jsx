@@ -8,18 +8,22 @@ import { toast } from 'sonner';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
-export default function VideoCallModal({ conversation, user, onClose, incomingCall = null }) {
+const CALL_EVENTS = ['call_accepted', 'call_ice_candidate', 'call_ended', 'call_rejected'];
+
+export default function VideoCallModal({ conversation, user, socket, onClose, incomingCall = null }) {
   const [localStream, setLocalStream] = useState(null);
   const [remoteStream, setRemoteStream] = useState(null);
   const [videoEnabled, setVideoEnabled] = useState(true);
   const [audioEnabled, setAudioEnabled] = useState(true);
   const [callStatus, setCallStatus] = useState(incomingCall ? 'incoming' : 'connecting');
-  const [callId, setCallId] = useState(incomingCall?.id || null);
   
   const localVideoRef = useRef(null);
   const remoteVideoRef = useRef(null);
   const peerRef = useRef(null);
-  const pollingRef = useRef(null);
+  const callIdRef = useRef(incomingCall?.id || null);
+  const unwatchRef = useRef(null);
+  const seenCandidatesRef = useRef(new Set());
+  const pendingCandidatesRef = useRef([]);
   const token = localStorage.getItem('token');
   const config = { headers: { Authorization: `Bearer ${token}` } };
 
@@ -33,9 +37,9 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
   };
 
   const cleanup = useCallback(() => {
-    if (pollingRef.current) {
-      clearInterval(pollingRef.current);
-      pollingRef.current = null;
+    if (unwatchRef.current) {
+      unwatchRef.current();
+      unwatchRef.current = null;
     }
     if (localStream) {
       localStream.getTracks().forEach(track => track.stop());
@@ -106,9 +110,9 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
 
     // Handle ICE candidates
     pc.onicecandidate = async (event) => {
-      if (event.candidate && callId) {
+      if (event.candidate && callIdRef.current) {
         try {
-          await axios.post(`${API}/calls/${callId}/ice`, 
+          await axios.post(`${API}/calls/${callIdRef.current}/ice`, 
             { candidate: event.candidate.toJSON() }, 
             config
           );
@@ -128,6 +132,108 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
     return pc;
   };
 
+  // Remote ends: the other side already closed the call on the server
+  const finishCall = () => {
+    cleanup();
+    onClose();
+  };
+
+  const addRemoteCandidates = async (pc, entries) => {
+    for (const ice of entries || []) {
+      if (ice.user_id === user.id || !ice.candidate) continue;
+      if (!pc.remoteDescription) {
+        // Cevap gelmeden önce gelen adaylar bekletilir
+        pendingCandidatesRef.current.push(ice);
+        continue;
+      }
+      const key = JSON.stringify(ice.candidate);
+      if (seenCandidatesRef.current.has(key)) continue;
+      seenCandidatesRef.current.add(key);
+      try {
+        await pc.addIceCandidate(new RTCIceCandidate(ice.candidate));
+      } catch (e) {
+        console.log('ICE candidate error:', e);
+      }
+    }
+  };
+
+  // Apply a full call document (status endpoint) or a partial one built from a socket event
+  const applyCallState = async (pc, call) => {
+    if (call.status === 'rejected' || call.status === 'ended') {
+      if (call.status === 'rejected') toast.error('Arama reddedildi');
+      finishCall();
+      return;
+    }
+    if (call.status === 'accepted' && call.answer_data && pc.signalingState === 'have-local-offer') {
+      await pc.setRemoteDescription(new RTCSessionDescription({
+        type: 'answer',
+        sdp: call.answer_data.sdp
+      }));
+      setCallStatus('connected');
+      const queued = pendingCandidatesRef.current;
+      pendingCandidatesRef.current = [];
+      await addRemoteCandidates(pc, queued);
+    }
+    await addRemoteCandidates(pc, call.ice_candidates);
+  };
+
+  // Call state comes from call_* socket events; /status is long-polled only while the socket is down
+  const watchCall = (id, pc) => {
+    let active = true;
+    let polling = false;
+    let version = null;
+
+    const sync = async (wait = 0) => {
+      const params = wait && version !== null ? { since: version, wait } : {};
+      const res = await axios.get(`${API}/calls/${id}/status`, { ...config, params });
+      if (!active) return;
+      version = res.data.version;
+      await applyCallState(pc, res.data);
+    };
+
+    const pollWhileDisconnected = async () => {
+      if (polling) return;
+      polling = true;
+      while (active && !socket?.connected) {
+        try {
+          await sync(20);
+        } catch (_) {
+          await new Promise((resolve) => setTimeout(resolve, 2000));
+        }
+      }
+      polling = false;
+    };
+
+    const onCallEvent = (data) => {
+      if (!active || data.call_id !== id) return;
+      version = Math.max(version ?? 0, data.version ?? 0);
+      applyCallState(pc, {
+        status: data.status,
+        answer_data: data.answer_data,
+        ice_candidates: data.candidate ? [{ user_id: data.user_id, candidate: data.candidate }] : [],
+      });
+    };
+    // Bağlantı geri gelince kaçırılan değişiklikleri tek sorguyla al
+    const onConnect = () => { sync().catch(() => {}); };
+
+    if (socket) {
+      CALL_EVENTS.forEach((event) => socket.on(event, onCallEvent));
+      socket.on('connect', onConnect);
+      socket.on('disconnect', pollWhileDisconnected);
+    }
+    sync().catch(() => {});
+    if (!socket?.connected) pollWhileDisconnected();
+
+    unwatchRef.current = () => {
+      active = false;
+      if (socket) {
+        CALL_EVENTS.forEach((event) => socket.off(event, onCallEvent));
+        socket.off('connect', onConnect);
+        socket.off('disconnect', pollWhileDisconnected);
+      }
+    };
+  };
+
   // Start outgoing call
   const startCall = async () => {
     const stream = await initMedia(true);
@@ -147,12 +253,13 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
         headers: { ...config.headers, 'Content-Type': 'application/x-www-form-urlencoded' }
       });
       const newCallId = response.data.call_id;
-      setCallId(newCallId);
+      callIdRef.current = newCallId;
       
       toast.success('📞 Arama başlatılıyor...');
 
       // Create peer connection and offer
       const pc = createPeerConnection(stream, true);
+      watchCall(newCallId, pc);
       const offer = await pc.createOffer();
       await pc.setLocalDescription(offer);
 
@@ -162,47 +269,8 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
         config
       );
 
-      setCallStatus('ringing');
-
-      // Poll for answer
-      pollingRef.current = setInterval(async () => {
-        try {
-          const statusRes = await axios.get(`${API}/calls/${newCallId}/status`, config);
-          const call = statusRes.data;
-
-          if (call.status === 'rejected' || call.status === 'ended') {
-            toast.error('Arama reddedildi');
-            handleEndCall();
-            return;
-          }
-
-          if (call.status === 'accepted' && call.answer_data) {
-            // Set remote description
-            await pc.setRemoteDescription(new RTCSessionDescription({
-              type: 'answer',
-              sdp: call.answer_data.sdp
-            }));
-
-            // Process ICE candidates
-            if (call.ice_candidates) {
-              for (const ice of call.ice_candidates) {
-                if (ice.user_id !== user.id && ice.candidate) {
-                  try {
-                    await pc.addIceCandidate(new RTCIceCandidate(ice.candidate));
-                  } catch (e) {
-                    console.log('ICE candidate error:', e);
-                  }
-                }
-              }
-            }
-
-            clearInterval(pollingRef.current);
-            setCallStatus('connected');
-          }
-        } catch (err) {
-          console.error('Polling error:', err);
-        }
-      }, 500);
+      // Cevap soketten bu istek bitmeden gelmiş olabilir
+      setCallStatus((status) => (status === 'connected' ? status : 'ringing'));
 
     } catch (error) {
       console.error('Call start error:', error);
@@ -250,38 +318,9 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
         config
       );
 
-      // Process existing ICE candidates
-      if (call.ice_candidates) {
-        for (const ice of call.ice_candidates) {
-          if (ice.user_id !== user.id && ice.candidate) {
-            try {
-              await pc.addIceCandidate(new RTCIceCandidate(ice.candidate));
-            } catch (e) {
-              console.log('ICE candidate error:', e);
-            }
-          }
-        }
-      }
-
-      // Poll for new ICE candidates
-      pollingRef.current = setInterval(async () => {
-        try {
-          const res = await axios.get(`${API}/calls/${incomingCall.id}/status`, config);
-          if (res.data.status === 'ended') {
-            handleEndCall();
-            return;
-          }
-          if (res.data.ice_candidates) {
-            for (const ice of res.data.ice_candidates) {
-              if (ice.user_id !== user.id && ice.candidate) {
-                try {
-                  await pc.addIceCandidate(new RTCIceCandidate(ice.candidate));
-                } catch (e) {}
-              }
-            }
-          }
-        } catch (err) {}
-      }, 1000);
+      // Mevcut ve yeni ICE adayları / aramanın bitişi soketten gelir
+      await addRemoteCandidates(pc, call.ice_candidates);
+      watchCall(incomingCall.id, pc);
 
       setCallStatus('connected');
 
@@ -305,9 +344,9 @@ export default function VideoCallModal({ conversation, user, onClose, incomingCa
 
   // End call
   const handleEndCall = async () => {
-    if (callId) {
+    if (callIdRef.current) {
       try {
-        await axios.post(`${API}/calls/${callId}/end`, {}, config);
+        await axios.post(`${API}/calls/${callIdRef.current}/end`, {}, config);
       } catch (err) {}
     }
     cleanup();
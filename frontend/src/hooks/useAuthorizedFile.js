@@ -0,0 +1,104 @@
+import { useState, useEffect } from 'react';
+import axios from 'axios';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
+const API = `${BACKEND_URL}/api`;
+
+// Dosya yolu -> { url, expiresAt }; imzalı URL'ler küçük metinlerdir, en eskiler atılır
+const MAX_SIGNED_URLS = 500;
+// Süresi bu kadar içinde dolacak URL'ler yeniden imzalatılır (ms)
+const RENEW_BEFORE_MS = 5 * 60 * 1000;
+const signedUrls = new Map();
+
+// Aynı render turunda istenen yollar tek /files/sign isteğinde toplanır (istek başına en fazla 200)
+const MAX_PATHS_PER_REQUEST = 200;
+let queued = new Map();
+let flushTimer = null;
+
+const flushQueue = async () => {
+  const batch = new Map([...queued].slice(0, MAX_PATHS_PER_REQUEST));
+  batch.forEach((_, path) => queued.delete(path));
+  flushTimer = queued.size ? setTimeout(flushQueue, 0) : null;
+  try {
+    const response = await axios.post(
+      `${API}/files/sign`,
+      { paths: [...batch.keys()] },
+      { headers: { Authorization: `Bearer ${localStorage.getItem('token')}` } }
+    );
+    batch.forEach((waiters, path) => {
+      const signed = response.data.urls[path];
+      if (signed) {
+        const expires = Number(new URL(BACKEND_URL + signed).searchParams.get('exp')) * 1000;
+        signedUrls.delete(path);
+        signedUrls.set(path, { url: BACKEND_URL + signed, expiresAt: expires });
+        if (signedUrls.size > MAX_SIGNED_URLS) {
+          signedUrls.delete(signedUrls.keys().next().value);
+        }
+      }
+      waiters.forEach(({ resolve }) => resolve(signed ? BACKEND_URL + signed : null));
+    });
+  } catch (error) {
+    batch.forEach((waiters) => waiters.forEach(({ reject }) => reject(error)));
+  }
+};
+
+/**
+ * Short-lived signed URL for a protected file.
+ * <img>/<audio>/<video> cannot send an Authorization header; a signed URL lets
+ * them load the file directly, so media still streams and seeks with Range requests.
+ * @param {string} path - API path such as /api/files/uploads/<hash>.png
+ * @returns {Promise<string|null>} Signed URL, or null if the file is not accessible
+ */
+export const getSignedFileUrl = (path) => {
+  const cached = signedUrls.get(path);
+  if (cached && cached.expiresAt - Date.now() > RENEW_BEFORE_MS) {
+    return Promise.resolve(cached.url);
+  }
+  return new Promise((resolve, reject) => {
+    if (!queued.has(path)) queued.set(path, []);
+    queued.get(path).push({ resolve, reject });
+    if (!flushTimer) flushTimer = setTimeout(flushQueue, 0);
+  });
+};
+
+/**
+ * Open a protected file for download
+ * @param {string} path - API path of the file
+ * @param {string} filename - Name offered to the browser
+ */
+export const downloadAuthorizedFile = async (path, filename) => {
+  const url = await getSignedFileUrl(path);
+  if (!url) throw new Error('File not accessible');
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = filename || 'download';
+  link.target = '_blank';
+  document.body.appendChild(link);
+  link.click();
+  document.body.removeChild(link);
+};
+
+/**
+ * Hook returning a signed URL for a protected file (null while loading or on error)
+ * @param {string|null} path - API path of the file
+ * @returns {string|null} Signed URL
+ */
+export const useAuthorizedFile = (path) => {
+  const [url, setUrl] = useState(null);
+
+  useEffect(() => {
+    if (!path) {
+      setUrl(null);
+      return undefined;
+    }
+    let active = true;
+    getSignedFileUrl(path)
+      .then((signed) => active && setUrl(signed))
+      .catch(() => active && setUrl(null));
+    return () => {
+      active = false;
+    };
+  }, [path]);
+
+  return url;
+};
@@ -31,8 +31,15 @@ export default function AdminDashboard() {
 
   const fetchUsers = async () => {
     try {
-      const response = await axios.get(`${API}/users`, config);
-      setUsers(response.data);
+      // The directory is paginated; follow X-Next-Cursor until the last page
+      const allUsers = [];
+      let after = null;
+      do {
+        const response = await axios.get(`${API}/users`, { ...config, params: after ? { after } : {} });
+        allUsers.push(...response.data);
+        after = response.headers['x-next-cursor'] || null;
+      } while (after);
+      setUsers(allUsers);
     } catch (error) {
       toast.error('Kullanıcılar yüklenemedi');
     }
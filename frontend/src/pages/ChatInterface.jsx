@@ -24,9 +24,13 @@ import VideoCallModal from '@/components/VideoCallModal';
 import MobileMenu from '@/components/MobileMenu';
 import { requestNotificationPermission, notifyNewMessage, notifyIncomingCall } from '@/utils/notifications';
 import { useUser } from '@/contexts/UserContext';
+import AuthorizedMedia from '@/components/AuthorizedMedia';
+import { downloadAuthorizedFile } from '@/hooks/useAuthorizedFile';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 const API = `${BACKEND_URL}/api`;
+// Sunucudaki TYPING_TTL_SECONDS ile aynı
+const TYPING_TTL_MS = 5000;
 
 export default function ChatInterface() {
   const { user, logout } = useUser();
@@ -37,6 +41,8 @@ export default function ChatInterface() {
   const [conversations, setConversations] = useState([]);
   const [selectedConversation, setSelectedConversation] = useState(null);
   const [messages, setMessages] = useState([]);
+  const [olderCursor, setOlderCursor] = useState(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const [messageInput, setMessageInput] = useState('');
   const [users, setUsers] = useState([]);
   const [showNewConversation, setShowNewConversation] = useState(false);
@@ -44,8 +50,9 @@ export default function ChatInterface() {
   const [selectedUserIds, setSelectedUserIds] = useState([]);
   const [groupName, setGroupName] = useState('');
   const [socket, setSocket] = useState(null);
+  const [socketConnected, setSocketConnected] = useState(false);
   const [isTyping, setIsTyping] = useState(false);
-  const [typingUser, setTypingUser] = useState(null);
+  const [typingByConversation, setTypingByConversation] = useState({});
   const [selectedFile, setSelectedFile] = useState(null);
   const [messageType, setMessageType] = useState('text');
   const [showProfile, setShowProfile] = useState(false);
@@ -66,8 +73,11 @@ export default function ChatInterface() {
   const messagesEndRef = useRef(null);
   const fileInputRef = useRef(null);
   const typingTimeoutRef = useRef(null);
+  const conversationIdsRef = useRef([]);
+  const lastTypingEmitRef = useRef(0);
   const recordingIntervalRef = useRef(null);
-  const pollingIntervalRef = useRef(null);
+  const selectedConversationRef = useRef(null);
+  const lastMarkedReadRef = useRef(null);
 
   const token = localStorage.getItem('token');
   const config = { headers: { Authorization: `Bearer ${token}` } };
@@ -95,6 +105,7 @@ export default function ChatInterface() {
 
   const initSocket = () => {
     const newSocket = io(BACKEND_URL, {
+      auth: { token },
       transports: ['websocket', 'polling'],
       reconnection: true,
       reconnectionDelay: 1000,
@@ -102,14 +113,45 @@ export default function ChatInterface() {
     });
 
     newSocket.on('connect', () => {
+      setSocketConnected(true);
       toast.success('🟢 Bağlantı kuruldu');
+      // Yeniden bağlanınca odalar sıfırlanır; hepsine tek olayla yeniden katıl
+      if (conversationIdsRef.current.length > 0) {
+        newSocket.emit('join_conversation', { conversation_ids: conversationIdsRef.current });
+      }
+      // Bağlantı kopukken kaçırılan mesajları tamamla
+      if (selectedConversationRef.current) {
+        fetchMessages(selectedConversationRef.current.id);
+      }
     });
 
     newSocket.on('disconnect', () => {
+      setSocketConnected(false);
       toast.error('🔴 Bağlantı kesildi');
     });
 
     newSocket.on('new_message', (message) => {
+      const isOpen = message.conversation_id === selectedConversationRef.current?.id;
+      // Kenar çubuğu: önizleme, sıralama ve (açık olmayan konuşmalar için) okunmamış sayısı
+      setConversations((prev) => {
+        const updated = prev.map((c) => (c.id !== message.conversation_id ? c : {
+          ...c,
+          last_message_at: message.timestamp,
+          last_message: {
+            id: message.id,
+            sender_id: message.sender_id,
+            sender_username: message.sender_username,
+            message_type: message.message_type,
+            content: (message.content || '').slice(0, 120),
+            timestamp: message.timestamp,
+          },
+          unread_count: !isOpen && message.sender_id !== user.id ? (c.unread_count || 0) + 1 : c.unread_count,
+        }));
+        return updated.sort((a, b) => (
+          Date.parse(b.last_message_at || b.created_at) - Date.parse(a.last_message_at || a.created_at)
+        ));
+      });
+      if (!isOpen) return;
       setMessages((prev) => {
         // Duplicate check
         if (prev.some(m => m.id === message.id)) return prev;
@@ -122,17 +164,38 @@ export default function ChatInterface() {
       }
     });
 
-    newSocket.on('user_typing', (data) => {
-      setTypingUser(data.username);
-      setTimeout(() => setTypingUser(null), 3000);
+    newSocket.on('presence', (data) => {
+      const changes = Object.fromEntries(data.users.map((u) => [u.id, u]));
+      setUsers((prev) => prev.map((u) => (changes[u.id] ? { ...u, ...changes[u.id] } : u)));
+    });
+
+    newSocket.on('typing_update', (data) => {
+      // Sunucu yazmaya devam edenleri yarım TTL'de bir yeniden bildirir; yenilenmeyen gösterge kendiliğinden söner
+      const expiresAt = Date.now() + TYPING_TTL_MS;
+      setTypingByConversation((prev) => {
+        const current = { ...(prev[data.conversation_id] || {}) };
+        data.started.forEach((name) => { current[name] = expiresAt; });
+        data.stopped.forEach((name) => { delete current[name]; });
+        return { ...prev, [data.conversation_id]: current };
+      });
     });
 
     newSocket.on('call_start', (data) => {
       if (data.caller_id !== user.id) {
+        // Sunucu aramayı anında iletir; bekleyen arama sorgusu yalnızca yedek
         notifyIncomingCall(data.caller_username, data.call_type);
-        if (window.confirm(`${data.caller_username} sizi arıyor. Kabul ediyor musunuz?`)) {
-          setShowVideoCall(true);
-        }
+        setIncomingCall((prev) => {
+          if (prev && prev.id === data.call_id) return prev;
+          return {
+            id: data.call_id,
+            conversation_id: data.conversation_id,
+            caller_id: data.caller_id,
+            caller_username: data.caller_username,
+            call_type: data.call_type,
+            status: 'pending',
+          };
+        });
+        setShowVideoCall(true);
       }
     });
 
@@ -141,29 +204,23 @@ export default function ChatInterface() {
     return () => newSocket.disconnect();
   };
 
+  const conversationIdsKey = conversations.map((c) => c.id).sort().join(',');
+
   useEffect(() => {
+    conversationIdsRef.current = conversations.map((c) => c.id);
+    // Tüm odalara katıl ki kenar çubuğu önizlemeleri ve rozetler canlı güncellensin
+    if (socket && conversationIdsRef.current.length > 0) {
+      socket.emit('join_conversation', { conversation_ids: conversationIdsRef.current });
+    }
+  }, [conversationIdsKey, socket]);
+
+  useEffect(() => {
+    selectedConversationRef.current = selectedConversation;
     if (selectedConversation && socket) {
-      socket.emit('join_conversation', {
-        conversation_id: selectedConversation.id,
-        user_id: user.id,
-      });
-      fetchMessages(selectedConversation.id);
-      
-      // POLLING - 250ms'de bir mesaj kontrol et
-      if (pollingIntervalRef.current) {
-        clearInterval(pollingIntervalRef.current);
-      }
-      
-      pollingIntervalRef.current = setInterval(() => {
-        fetchMessages(selectedConversation.id);
-      }, 250);
+      // Yeni mesajlar soketten gelir; polling yok
+      socket.emit('join_conversation', { conversation_id: selectedConversation.id });
+      fetchMessages(selectedConversation.id, { reset: true });
     }
-    
-    return () => {
-      if (pollingIntervalRef.current) {
-        clearInterval(pollingIntervalRef.current);
-      }
-    };
   }, [selectedConversation]);
 
   const scrollToBottom = () => {
@@ -175,18 +232,42 @@ export default function ChatInterface() {
     });
   };
 
+  const newestMessageId = messages.length > 0 ? messages[messages.length - 1].id : null;
+
   useEffect(() => {
-    // Mesaj sayısı değiştiğinde scroll
-    if (messages.length > 0) {
+    // En yeni mesaj değiştiğinde scroll (eski sayfa yüklenince değil)
+    if (newestMessageId) {
       scrollToBottom();
     }
     setLastMessageCount(messages.length);
-  }, [messages.length]);
+  }, [newestMessageId]);
+
+  // Açık konuşmanın en yeni mesajını okundu işaretle (açılınca ve yeni mesaj gelince)
+  useEffect(() => {
+    if (!selectedConversation || !newestMessageId) return;
+    if (messages[messages.length - 1].conversation_id !== selectedConversation.id) return;
+    if (lastMarkedReadRef.current === newestMessageId) return;
+    lastMarkedReadRef.current = newestMessageId;
+    axios.post(`${API}/conversations/${selectedConversation.id}/read`, null, {
+      ...config,
+      params: { message_id: newestMessageId },
+    }).catch(() => {});
+    setConversations((prev) => prev.map((c) => (
+      c.id === selectedConversation.id ? { ...c, unread_count: 0 } : c
+    )));
+  }, [newestMessageId, selectedConversation]);
 
   const fetchUsers = async () => {
     try {
-      const response = await axios.get(`${API}/users`, config);
-      setUsers(response.data.filter((u) => u.id !== user.id));
+      // The directory is paginated; follow X-Next-Cursor until the last page
+      const allUsers = [];
+      let after = null;
+      do {
+        const response = await axios.get(`${API}/users`, { ...config, params: after ? { after } : {} });
+        allUsers.push(...response.data);
+        after = response.headers['x-next-cursor'] || null;
+      } while (after);
+      setUsers(allUsers.filter((u) => u.id !== user.id));
     } catch (error) {
       toast.error('❌ Kullanıcılar yüklenemedi');
     }
@@ -210,19 +291,48 @@ export default function ChatInterface() {
     }
   };
 
-  const fetchMessages = async (conversationId) => {
+  // Aynı id'li mesajları güncelle, yenileri ekle; eskiden yeniye sırala
+  const mergeMessages = (prev, incoming) => {
+    const byId = new Map(prev.map((m) => [m.id, m]));
+    incoming.forEach((m) => byId.set(m.id, m));
+    return [...byId.values()].sort(
+      (a, b) => Date.parse(a.timestamp) - Date.parse(b.timestamp) || a.id.localeCompare(b.id)
+    );
+  };
+
+  const nextCursorFrom = (response) => (
+    response.headers['x-has-more'] === 'true' ? response.headers['x-next-cursor'] || null : null
+  );
+
+  // En yeni sayfayı yükle; reset=false ise daha önce yüklenmiş eski sayfaları koru
+  const fetchMessages = async (conversationId, { reset = false } = {}) => {
     try {
       const response = await axios.get(`${API}/conversations/${conversationId}/messages`, config);
-      // Sadece yeni mesaj varsa güncelle (gereksiz render'ı önle)
-      setMessages(prev => {
-        const newData = response.data;
-        if (JSON.stringify(prev.map(m => m.id)) !== JSON.stringify(newData.map(m => m.id))) {
-          return newData;
-        }
-        return prev;
+      // API en yeni mesajı önce döndürür; ekranda eskiden yeniye göster
+      const page = [...response.data].reverse();
+      setMessages(prev => (reset ? page : mergeMessages(prev, page)));
+      if (reset) {
+        setOlderCursor(nextCursorFrom(response));
+      }
+    } catch (_) {
+      if (reset) toast.error('❌ Mesajlar yüklenemedi');
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (!selectedConversation || !olderCursor || loadingOlder) return;
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`${API}/conversations/${selectedConversation.id}/messages`, {
+        ...config,
+        params: { before: olderCursor },
       });
+      setMessages(prev => mergeMessages(prev, response.data));
+      setOlderCursor(nextCursorFrom(response));
     } catch (_) {
-      // Sessiz hata - polling'de sürekli toast gösterme
+      toast.error('❌ Eski mesajlar yüklenemedi');
+    } finally {
+      setLoadingOlder(false);
     }
   };
 
@@ -267,31 +377,63 @@ export default function ChatInterface() {
     }
   };
 
+  // Soket üzerinden gönder; onay gelmezse aynı id ile yeniden dene (sunucu tekrarı bir kez kaydeder)
+  const sendOverSocket = async (payload) => {
+    let lastError;
+    for (let attempt = 0; attempt < 3; attempt += 1) {
+      let ack;
+      try {
+        ack = await socket.timeout(5000).emitWithAck('send_message', payload);
+      } catch (err) {
+        lastError = err;
+        continue;
+      }
+      if (ack.ok) return ack.message;
+      lastError = new Error(ack.error);
+      if (ack.status < 500) break;
+    }
+    throw lastError;
+  };
+
   const handleSendMessage = async (e) => {
     e.preventDefault();
     if (!messageInput.trim() && !selectedFile) return;
 
     try {
-      const formData = new FormData();
-      formData.append('content', messageInput || 'Dosya paylaşıldı');
-      formData.append('message_type', messageType);
-      
-      if (replyingTo) {
-        formData.append('metadata', JSON.stringify({ reply_to: replyingTo.id, reply_content: replyingTo.content }));
-      }
+      const metadata = replyingTo ? { reply_to: replyingTo.id, reply_content: replyingTo.content } : null;
+      let message;
+
+      if (!selectedFile && socket?.connected && ['text', 'sticker'].includes(messageType)) {
+        message = await sendOverSocket({
+          id: crypto.randomUUID(),
+          conversation_id: selectedConversation.id,
+          content: messageInput,
+          message_type: messageType,
+          metadata,
+        });
+      } else {
+        const formData = new FormData();
+        formData.append('content', messageInput || 'Dosya paylaşıldı');
+        formData.append('message_type', messageType);
+        
+        if (metadata) {
+          formData.append('metadata', JSON.stringify(metadata));
+        }
 
-      if (selectedFile) {
-        formData.append('file', selectedFile);
-      }
+        if (selectedFile) {
+          formData.append('file', selectedFile);
+        }
 
-      const response = await axios.post(
-        `${API}/conversations/${selectedConversation.id}/messages`,
-        formData,
-        { ...config, headers: { ...config.headers, 'Content-Type': 'multipart/form-data' } }
-      );
+        const response = await axios.post(
+          `${API}/conversations/${selectedConversation.id}/messages`,
+          formData,
+          { ...config, headers: { ...config.headers, 'Content-Type': 'multipart/form-data' } }
+        );
+        message = response.data;
+      }
 
-      // Lokal güncelleme
-      setMessages(prev => [...prev, response.data]);
+      // Lokal güncelleme (new_message olayı önce gelmiş olabilir)
+      setMessages(prev => (prev.some(m => m.id === message.id) ? prev : [...prev, message]));
       setMessageInput('');
       setSelectedFile(null);
       setMessageType('text');
@@ -319,17 +461,41 @@ export default function ChatInterface() {
     } catch (_) {}
   };
 
+  // Durdurma olayı kaybolsa bile süresi dolan yazma göstergelerini temizle
+  useEffect(() => {
+    const deadlines = Object.values(typingByConversation).flatMap((typists) => Object.values(typists));
+    if (deadlines.length === 0) return undefined;
+    const timer = setTimeout(() => {
+      const now = Date.now();
+      setTypingByConversation((prev) => Object.fromEntries(
+        Object.entries(prev).map(([id, typists]) => [
+          id,
+          Object.fromEntries(Object.entries(typists).filter(([, expiresAt]) => expiresAt > now)),
+        ])
+      ));
+    }, Math.max(Math.min(...deadlines) - Date.now(), 0) + 50);
+    return () => clearTimeout(timer);
+  }, [typingByConversation]);
+
+  const typingUsers = Object.keys(typingByConversation[selectedConversation?.id] || {}).filter((name) => name !== user.username);
+
   const handleTyping = () => {
-    if (!isTyping && socket && selectedConversation) {
+    if (!socket || !selectedConversation) return;
+    const typingPayload = { conversation_id: selectedConversation.id, username: user.username };
+
+    // Sunucu 5 sn yenilenmeyen yazma durumunu düşürür; yazarken 2 sn'de bir hatırlat
+    const now = Date.now();
+    if (!isTyping || now - lastTypingEmitRef.current > 2000) {
       setIsTyping(true);
-      socket.emit('typing', {
-        conversation_id: selectedConversation.id,
-        username: user.username,
-      });
+      lastTypingEmitRef.current = now;
+      socket.emit('typing', typingPayload);
     }
 
     if (typingTimeoutRef.current) clearTimeout(typingTimeoutRef.current);
-    typingTimeoutRef.current = setTimeout(() => setIsTyping(false), 2000);
+    typingTimeoutRef.current = setTimeout(() => {
+      setIsTyping(false);
+      socket.emit('typing', { ...typingPayload, typing: false });
+    }, 2000);
   };
 
   const handleFileSelect = (type) => {
@@ -345,14 +511,12 @@ export default function ChatInterface() {
     }
   };
 
-  const handleDownloadFile = (fileUrl, filename) => {
-    const link = document.createElement('a');
-    link.href = BACKEND_URL + fileUrl;
-    link.download = filename || 'download';
-    link.target = '_blank';
-    document.body.appendChild(link);
-    link.click();
-    document.body.removeChild(link);
+  const handleDownloadFile = async (fileUrl, filename) => {
+    try {
+      await downloadAuthorizedFile(fileUrl, filename);
+    } catch (error) {
+      toast.error('Dosya indirilemedi');
+    }
   };
 
   const startVoiceRecording = async () => {
@@ -399,26 +563,34 @@ export default function ChatInterface() {
     setShowVideoCall(true);
   };
 
-  // Gelen aramaları kontrol et
+  // Gelen aramalar call_start ile gelir; yalnızca socket kopukken uzun sorgu (sunucu 20 sn'ye kadar bekletir)
   useEffect(() => {
-    if (!selectedConversation) return;
+    if (!selectedConversation || showVideoCall || socketConnected) return;
+    let cancelled = false;
     
-    const checkIncomingCalls = async () => {
-      try {
-        const response = await axios.get(`${API}/calls/pending/${selectedConversation.id}`, config);
-        if (response.data && response.data.id && !showVideoCall) {
-          setIncomingCall(response.data);
-          notifyIncomingCall(response.data.caller_username, response.data.call_type);
-          setShowVideoCall(true);
+    const waitForIncomingCall = async () => {
+      while (!cancelled) {
+        try {
+          const response = await axios.get(`${API}/calls/pending/${selectedConversation.id}`, {
+            ...config,
+            params: { wait: 20 },
+          });
+          if (!cancelled && response.data && response.data.id) {
+            setIncomingCall(response.data);
+            notifyIncomingCall(response.data.caller_username, response.data.call_type);
+            setShowVideoCall(true);
+            return;
+          }
+        } catch (error) {
+          // Sessiz hata - kısa bekleyip tekrar dene
+          await new Promise((resolve) => setTimeout(resolve, 2000));
         }
-      } catch (error) {
-        // Sessiz hata
       }
     };
 
-    const callPollInterval = setInterval(checkIncomingCalls, 2000);
-    return () => clearInterval(callPollInterval);
-  }, [selectedConversation, showVideoCall]);
+    waitForIncomingCall();
+    return () => { cancelled = true; };
+  }, [selectedConversation, showVideoCall, socketConnected]);
 
   const handleLogout = async () => {
     try {
@@ -528,32 +700,34 @@ export default function ChatInterface() {
                   <span className="text-sm">Sesli mesaj</span>
                 </div>
                 {message.metadata?.file_url && (
-                  <audio controls style={{ maxWidth: '250px', height: '40px' }}>
-                    <source src={BACKEND_URL + message.metadata.file_url} type="audio/webm" />
-                    <source src={BACKEND_URL + message.metadata.file_url} type="audio/mp3" />
-                  </audio>
+                  <AuthorizedMedia
+                    as="audio"
+                    path={message.metadata.file_url}
+                    controls
+                    style={{ maxWidth: '250px', height: '40px' }}
+                  />
                 )}
               </div>
             )}
             {(message.message_type === 'image' || message.message_type === 'video' || message.message_type === 'file') && (
               <div className="space-y-2">
                 {message.message_type === 'image' && message.metadata?.file_url && (
-                  <img 
-                    src={BACKEND_URL + message.metadata.file_url} 
+                  <AuthorizedMedia
+                    path={message.metadata.file_url}
                     alt="shared" 
                     style={{ maxWidth: '200px', maxHeight: '200px', width: 'auto', height: 'auto' }}
                     className="rounded-lg cursor-pointer object-contain"
-                    onClick={() => window.open(BACKEND_URL + message.metadata.file_url, '_blank')}
+                    onClick={(e) => window.open(e.currentTarget.src, '_blank')}
                   />
                 )}
                 {message.message_type === 'video' && message.metadata?.file_url && (
-                  <video 
+                  <AuthorizedMedia
+                    as="video"
+                    path={message.metadata.file_url}
                     controls
                     style={{ maxWidth: '250px', maxHeight: '250px' }}
                     className="rounded-lg"
-                  >
-                    <source src={BACKEND_URL + message.metadata.file_url} />
-                  </video>
+                  />
                 )}
                 <div className="flex items-center gap-2">
                   {message.message_type === 'image' && <ImageIcon className="w-4 h-4" />}
@@ -724,8 +898,13 @@ export default function ChatInterface() {
                           : 'bg-slate-800/50 hover:bg-slate-800'
                       }`}
                     >
-                      <p className="font-medium text-slate-100 truncate">{conv.participant_usernames[0] || 'Konuşma'}</p>
-                      <p className="text-xs text-slate-400 line-clamp-1">Son mesaj...</p>
+                      <div className="flex items-center justify-between gap-2">
+                        <p className="font-medium text-slate-100 truncate">{conv.participant_usernames[0] || 'Konuşma'}</p>
+                        {conv.unread_count > 0 && (
+                          <span className="min-w-5 px-1.5 rounded-full bg-[#22c55e] text-black text-xs text-center">{conv.unread_count}</span>
+                        )}
+                      </div>
+                      <p className="text-xs text-slate-400 line-clamp-1">{conv.last_message?.content || 'Henüz mesaj yok'}</p>
                     </div>
                   ))
                 )}
@@ -1123,10 +1302,17 @@ export default function ChatInterface() {
 
             <ScrollArea className="flex-1 p-4 message-scroll">
               <div className="space-y-2">
+                {olderCursor && (
+                  <div className="flex justify-center">
+                    <Button variant="ghost" size="sm" onClick={loadOlderMessages} disabled={loadingOlder}>
+                      {loadingOlder ? 'Yükleniyor...' : 'Daha eski mesajları yükle'}
+                    </Button>
+                  </div>
+                )}
                 {messages.map(renderMessage)}
-                {typingUser && (
+                {typingUsers.length > 0 && (
                   <motion.div initial={{ opacity: 0 }} animate={{ opacity: 1 }} className="text-xs text-slate-500 italic flex items-center gap-2">
-                    <span>{typingUser} yazıyor</span>
+                    <span>{typingUsers.join(', ')} yazıyor</span>
                     <span className="flex gap-1">
                       <motion.span animate={{ opacity: [0,1,0] }} transition={{ repeat: Infinity, duration: 1 }}>.</motion.span>
                       <motion.span animate={{ opacity: [0,1,0] }} transition={{ repeat: Infinity, duration: 1, delay: 0.2 }}>.</motion.span>
@@ -7,6 +7,7 @@ import requests
 import os
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://encryptalk-22.preview.emergentagent.com').rstrip('/')
 
@@ -115,6 +116,25 @@ class TestAuthenticatedEndpoints:
             assert "user_code" in user or user.get("user_code") is None
             print(f"Sample user: {user['username']}")
     
+    def test_get_users_prefix_and_projection(self):
+        """Test username prefix search with a projected, single-user page"""
+        response = requests.get(
+            f"{BASE_URL}/api/users",
+            params={"q": ADMIN_USERNAME[:3], "fields": "bio", "limit": 1},
+            headers=self.headers
+        )
+        assert response.status_code == 200, f"Get users failed: {response.text}"
+        users = response.json()
+        assert len(users) <= 1
+        for user in users:
+            assert user["username"].startswith(ADMIN_USERNAME[:3])
+            assert set(user) <= {"id", "username", "bio"}
+        if response.headers.get("X-Has-More") == "true":
+            assert response.headers["X-Next-Cursor"] == users[-1]["username"]
+        
+        invalid = requests.get(f"{BASE_URL}/api/users", params={"fields": "hashed_password"}, headers=self.headers)
+        assert invalid.status_code == 400
+    
     def test_get_conversations(self):
         """Test getting conversations list"""
         response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
@@ -128,7 +148,33 @@ class TestAuthenticatedEndpoints:
             conv = conversations[0]
             assert "id" in conv
             assert "participants" in conv
+            assert conv["unread_count"] >= 0
             print(f"Sample conversation ID: {conv['id']}")
+        
+        # Most recently active conversations come first
+        activity = [c["last_message_at"] for c in conversations if c.get("last_message_at")]
+        assert activity == sorted(activity, reverse=True)
+        
+        # Previews are decrypted for the client
+        for conv in conversations:
+            preview = conv.get("last_message")
+            if preview and preview.get("content"):
+                assert not preview["content"].startswith("gAAAAA"), "Preview should be decrypted"
+    
+    def test_export_omits_server_secrets(self):
+        """Test that backups never contain conversation keys or others' unread counters"""
+        for params in ({"format": "json"}, {"format": "ndjson"}):
+            response = requests.post(f"{BASE_URL}/api/backup/export", params=params, headers=self.headers)
+            assert response.status_code == 200, f"Export failed: {response.text}"
+            if params["format"] == "json":
+                conversations = response.json()["conversations"]
+            else:
+                records = [json.loads(line) for line in response.text.splitlines() if line]
+                conversations = [r["data"] for r in records if r["type"] == "conversation"]
+            for conv in conversations:
+                assert "encryption_key" not in conv
+                assert "retired_keys" not in conv
+                assert "unread" not in conv
     
     def test_logout(self):
         """Test logout"""
@@ -245,6 +291,237 @@ class TestConversationAndMessages:
                 print(f"Message content (decrypted): {content[:50]}...")
         
         print("Messages are properly decrypted in API response")
+    
+    def test_message_pagination_cursor(self):
+        """Test newest-first message pages linked by cursor headers"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        first_page = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            params={"limit": 2},
+            headers=self.headers
+        )
+        assert first_page.status_code == 200
+        messages = first_page.json()
+        assert len(messages) <= 2
+        if first_page.headers.get("X-Has-More") != "true":
+            pytest.skip("Not enough messages to paginate")
+        
+        timestamps = [m["timestamp"] for m in messages]
+        assert timestamps == sorted(timestamps, reverse=True), "Page should be newest first"
+        
+        next_cursor = first_page.headers["X-Next-Cursor"]
+        second_page = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            params={"limit": 2, "before": next_cursor},
+            headers=self.headers
+        )
+        assert second_page.status_code == 200
+        first_ids = {m["id"] for m in messages}
+        assert not first_ids & {m["id"] for m in second_page.json()}, "Pages must not overlap"
+        print(f"Paginated {len(messages)} + {len(second_page.json())} messages")
+    
+    def test_message_pagination_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        response = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            params={"before": "not-a-cursor"},
+            headers=self.headers
+        )
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+    
+    def test_mark_conversation_read(self):
+        """Test that marking a conversation read moves the caller's watermark"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        messages = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            params={"limit": 1},
+            headers=self.headers
+        ).json()
+        if not messages:
+            pytest.skip("No messages to mark read")
+        
+        response = requests.post(
+            f"{BASE_URL}/api/conversations/{conv_id}/read",
+            params={"message_id": messages[0]["id"]},
+            headers=self.headers
+        )
+        assert response.status_code == 200, f"Mark read failed: {response.text}"
+        assert response.json()["last_read_message_id"] == messages[0]["id"]
+        
+        # Watermarks are flushed in the background
+        time.sleep(2)
+        watermarks = requests.get(f"{BASE_URL}/api/conversations/{conv_id}/read", headers=self.headers)
+        assert watermarks.status_code == 200
+        assert any(w["last_read_message_id"] == messages[0]["id"] for w in watermarks.json())
+    
+    def test_reaction_toggle(self):
+        """Test that reacting twice adds then removes the caller's reaction"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        messages = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            params={"limit": 1},
+            headers=self.headers
+        ).json()
+        if not messages:
+            pytest.skip("No messages to react to")
+        
+        url = f"{BASE_URL}/api/messages/{messages[0]['id']}/react"
+        added = requests.post(url, params={"emoji": "🧪"}, headers=self.headers)
+        assert added.status_code == 200, f"React failed: {added.text}"
+        assert added.json()["reaction_counts"]["🧪"] == len(added.json()["reactions"]["🧪"])
+        
+        removed = requests.post(url, params={"emoji": "🧪"}, headers=self.headers)
+        assert removed.status_code == 200
+        assert "🧪" not in removed.json()["reaction_counts"]
+        
+        invalid = requests.post(url, params={"emoji": "$bad"}, headers=self.headers)
+        assert invalid.status_code == 400
+    
+    def test_search_messages(self):
+        """Test that a sent message is found by a word it contains"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        keyword = f"searchable{int(time.time())}"
+        sent = requests.post(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            data={"content": f"TEST {keyword.upper()} message", "message_type": "text"},
+            headers=self.headers
+        )
+        assert sent.status_code == 200, f"Send message failed: {sent.text}"
+        
+        response = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/search",
+            params={"q": keyword},
+            headers=self.headers
+        )
+        if response.status_code == 403:
+            pytest.skip("Message search disabled by admin")
+        assert response.status_code == 200, f"Search failed: {response.text}"
+        results = response.json()
+        assert [m["id"] for m in results] == [sent.json()["id"]]
+        assert keyword.upper() in results[0]["content"], "Results should be decrypted"
+        assert "search_tokens" not in results[0]
+    
+    def test_concurrent_messages_are_stored(self):
+        """Test that a burst of sends is stored and reflected in the conversation summary"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        
+        def send(i):
+            return requests.post(
+                f"{BASE_URL}/api/conversations/{conv_id}/messages",
+                data={"content": f"TEST burst {i}", "message_type": "text"},
+                headers=self.headers
+            )
+        
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(send, range(8)))
+        assert all(r.status_code == 200 for r in responses), [r.text for r in responses]
+        sent_ids = {r.json()["id"] for r in responses}
+        
+        messages = requests.get(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            params={"limit": 50},
+            headers=self.headers
+        ).json()
+        assert sent_ids <= {m["id"] for m in messages}
+        
+        newest = max(responses, key=lambda r: r.json()["timestamp"]).json()
+        conversation = next(c for c in requests.get(f"{BASE_URL}/api/conversations", headers=self.headers).json()
+                            if c["id"] == conv_id)
+        assert conversation["last_message"]["id"] == newest["id"]
+    
+    def test_duplicate_attachments_share_storage(self):
+        """Test that identical uploads resolve to one content-addressed file"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        payload = f"TEST attachment {time.time()}".encode()
+        urls = []
+        for name in ("first.txt", "second.txt"):
+            response = requests.post(
+                f"{BASE_URL}/api/conversations/{conv_id}/messages",
+                data={"content": "TEST attachment", "message_type": "file"},
+                files={"file": (name, payload, "text/plain")},
+                headers=self.headers
+            )
+            assert response.status_code == 200, f"Send failed: {response.text}"
+            urls.append(response.json()["metadata"]["file_url"])
+        assert urls[0] == urls[1], "Same content should map to the same file"
+        
+        # Forwarding by hash needs no upload
+        file_hash = urls[0].rsplit("/", 1)[-1].split(".")[0]
+        forwarded = requests.post(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            data={"content": "TEST forward", "message_type": "file", "blob": file_hash,
+                  "metadata": json.dumps({"filename": "first.txt"})},
+            headers=self.headers
+        )
+        assert forwarded.status_code == 200, f"Forward failed: {forwarded.text}"
+        assert forwarded.json()["metadata"]["file_url"] == urls[0]
+        
+        download = requests.get(f"{BASE_URL}{urls[0]}", headers=self.headers)
+        assert download.status_code == 200
+        assert download.content == payload
+        assert requests.get(f"{BASE_URL}{urls[0]}").status_code in (401, 403)
+        
+        # Media elements load through signed URLs, which support ranges without the token
+        signed = requests.post(f"{BASE_URL}/api/files/sign", json={"paths": [urls[0]]}, headers=self.headers)
+        assert signed.status_code == 200, f"Sign failed: {signed.text}"
+        signed_url = signed.json()["urls"][urls[0]]
+        ranged = requests.get(f"{BASE_URL}{signed_url}", headers={"Range": "bytes=0-3"})
+        assert ranged.status_code == 206
+        assert ranged.content == payload[:4]
+        assert requests.get(f"{BASE_URL}{signed_url}x").status_code == 403
+    
+    def test_attachment_fields_come_from_server(self):
+        """Test that clients cannot point a message at content they never uploaded or saw"""
+        conv_response = requests.get(f"{BASE_URL}/api/conversations", headers=self.headers)
+        if conv_response.status_code != 200 or not conv_response.json():
+            pytest.skip("No conversations available")
+        
+        conv_id = conv_response.json()[0]["id"]
+        forged = requests.post(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            data={"content": "TEST forged", "message_type": "file",
+                  "metadata": json.dumps({"file_url": "/api/files/uploads/" + "0" * 64, "file_hash": "0" * 64})},
+            headers=self.headers
+        )
+        assert forged.status_code == 200, f"Send failed: {forged.text}"
+        assert "file_url" not in forged.json()["metadata"]
+        assert "file_hash" not in forged.json()["metadata"]
+        
+        unseen = requests.post(
+            f"{BASE_URL}/api/conversations/{conv_id}/messages",
+            data={"content": "TEST forward", "message_type": "file", "blob": "f" * 64},
+            headers=self.headers
+        )
+        assert unseen.status_code == 404
 
 
 class TestAdminFeatures:
@@ -279,6 +556,17 @@ class TestAdminFeatures:
         assert "total_messages" in data
         print(f"Admin stats - Users: {data['total_users']}, Conversations: {data['total_conversations']}, Messages: {data['total_messages']}")
     
+    def test_admin_retention_report(self):
+        """Test retention settings and last-run report endpoint"""
+        response = requests.get(f"{BASE_URL}/api/admin/retention", headers=self.headers)
+        assert response.status_code == 200, f"Retention report failed: {response.text}"
+        
+        data = response.json()
+        assert data["retention_days"] >= 0
+        if data["last_run"]:
+            assert data["last_run"]["messages_deleted"] >= 0
+            assert "docs_per_second" in data["last_run"]
+    
     def test_nas_files_access(self):
         """Test NAS files endpoint"""
         response = requests.get(f"{BASE_URL}/api/nas/files", headers=self.headers)
@@ -0,0 +1,70 @@
+"""
+Socket.IO client manager tests - emits must cross between manager instances
+(as they do between workers) with the pinned python-socketio version.
+"""
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+socketio = pytest.importorskip("socketio")
+from socket_manager import AsyncMemoryManager, AsyncUnixSocketManager, on_remote_emit  # noqa: E402
+
+
+async def deliver_emit(sender, receiver):
+    """Emit through `sender` and return what `receiver` hands to its local sockets"""
+    received = asyncio.Queue()
+    
+    async def handle_emit(message):
+        await received.put(message)
+    
+    receiver._handle_emit = handle_emit
+    for manager in (sender, receiver):
+        socketio.AsyncServer(client_manager=manager)
+    receiver.initialize()
+    try:
+        await asyncio.sleep(0.1)  # let the listener subscribe / connect
+        await sender.emit('new_message', {"id": "m1", "content": "merhaba"}, room='conv-1', namespace='/')
+        return await asyncio.wait_for(received.get(), timeout=5)
+    finally:
+        receiver.thread.cancel()
+
+
+def test_memory_manager_fans_out_between_instances():
+    channel = f"test-{uuid.uuid4().hex}"
+    message = asyncio.run(deliver_emit(AsyncMemoryManager(channel=channel), AsyncMemoryManager(channel=channel)))
+    assert message["event"] == "new_message"
+    assert message["data"] == [{"id": "m1", "content": "merhaba"}]
+    assert message["room"] == "conv-1"
+
+
+def test_ipc_manager_fans_out_between_instances(tmp_path):
+    url = f"ipc://{tmp_path / 'bus.sock'}"
+    message = asyncio.run(deliver_emit(AsyncUnixSocketManager(url), AsyncUnixSocketManager(url)))
+    assert message["event"] == "new_message"
+    assert message["data"] == [{"id": "m1", "content": "merhaba"}]
+
+
+def test_remote_emit_listener_sees_only_other_workers():
+    async def run():
+        channel = f"test-{uuid.uuid4().hex}"
+        sender, receiver = AsyncMemoryManager(channel=channel), AsyncMemoryManager(channel=channel)
+        seen = []
+        on_remote_emit(receiver, lambda event, data: seen.append((event, data)))
+        for manager in (sender, receiver):
+            socketio.AsyncServer(client_manager=manager)
+        receiver.initialize()
+        try:
+            await asyncio.sleep(0.1)
+            await receiver.emit('call_ended', {"call_id": "local"}, room='conv-1', namespace='/')
+            await sender.emit('call_ended', {"call_id": "c1"}, room='conv-1', namespace='/')
+            await asyncio.sleep(0.1)
+        finally:
+            receiver.thread.cancel()
+        return seen
+    
+    assert asyncio.run(run()) == [('call_ended', {"call_id": "c1"})]